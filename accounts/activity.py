@@ -0,0 +1,134 @@
+"""
+Per-user recent activity
+
+マイページ・送金フォーム・/api/v1/accounts/ で使うアカウント (残高) と直近の送金を
+ユーザーごとに Django のキャッシュに ACTIVITY_CACHE_TTL 秒保持する読み取りモデル。
+キャッシュの値は世代番号付きで保存し、残高が変わるトランザクションは関係するユーザーの
+世代番号をトランザクション内と commit 後に進める (古い値を読んだ並行リクエストがキャッシュに
+書き戻しても、世代番号が一致しないため使われない)。世代番号と値は1回の get_many で取得する。
+"""
+import threading
+import time
+from typing import List, NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from . import history
+from .models import Account, Transaction
+
+
+class Activity(NamedTuple):
+    """
+    ユーザーのアカウントと直近の送金
+    """
+    generation: int
+    account: Optional[Account]
+    recent: List[Transaction]
+
+
+class ActivityStats:
+    """
+    キャッシュのヒット数
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, hits=0, misses=0, invalidations=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.invalidations += invalidations
+
+    def snapshot(self):
+        """
+        :return dict: {'hits', 'misses', 'hit_rate', 'invalidations'}
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'invalidations': self.invalidations,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.invalidations = 0
+
+
+stats = ActivityStats()
+
+
+def cache_key(user_id):
+    return f'activity:{user_id}'
+
+
+def generation_key(user_id):
+    return f'activity_generation:{user_id}'
+
+
+def load(user_id, generation):
+    """
+    DB からアカウントと直近の送金を取得
+    :param int user_id:
+    :param int generation:
+    :return Activity:
+    """
+    account = Account.objects.filter(user_id=user_id).first()
+    if account is None:
+        return Activity(generation, None, [])
+    recent = history.page(Transaction.objects.all(), account.address, limit=settings.ACTIVITY_RECENT_SIZE)
+    return Activity(generation, account, recent)
+
+
+def get(user):
+    """
+    :param User user: 認証済みのユーザー
+    :return Activity: account.user には user を設定済み
+    """
+    keys = [generation_key(user.id), cache_key(user.id)]
+    cached = cache.get_many(keys)
+    generation = cached.get(keys[0])
+    activity = cached.get(keys[1])
+    if generation is None or activity is None or activity.generation != generation:
+        stats.record(misses=1)
+        if generation is None:
+            # 世代番号が追い出された後に古い番号を再利用しないよう、時刻から始める
+            cache.add(keys[0], int(time.time() * 1000000), timeout=None)
+            generation = cache.get(keys[0])
+        activity = load(user.id, generation)
+        cache.set(keys[1], activity, settings.ACTIVITY_CACHE_TTL)
+    else:
+        stats.record(hits=1)
+
+    if activity.account is not None:
+        activity.account.user = user
+    return activity
+
+
+def bump(user_ids):
+    for user_id in user_ids:
+        try:
+            cache.incr(generation_key(user_id))
+        except ValueError:
+            # 世代番号がない場合はキャッシュの値も使われない
+            pass
+    stats.record(invalidations=len(user_ids))
+
+
+def invalidate(*user_ids):
+    """
+    残高・送金履歴が変わるユーザーのキャッシュを無効化 (トランザクション内で呼び出す)
+    :param int user_ids:
+    """
+    user_ids = sorted({user_id for user_id in user_ids if user_id is not None})
+    bump(user_ids)
+    # commit 前に古い残高を読んだリクエストの書き込みを無効にする
+    transaction.on_commit(lambda: bump(user_ids))
@@ -0,0 +1,163 @@
+import re
+import threading
+import time
+
+import pylru
+from django.conf import settings
+from eth_utils import is_checksum_address
+
+from .models import Account, Contract, EthAccount
+
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+UT_ADDRESS_RE = re.compile(r'^UT[' + BASE58_ALPHABET + r']{40}$')
+ETH_ADDRESS_RE = re.compile(r'^0x[0-9a-fA-F]{40}$')
+
+UT = 'ut'
+ETH = 'eth'
+
+
+def is_ut_address_format(address):
+    """
+    UTアドレスの形式か (UT + base58 40文字)
+    :param str address:
+    :return bool:
+    """
+    return isinstance(address, str) and UT_ADDRESS_RE.match(address) is not None
+
+
+def is_eth_address(address):
+    """
+    Ethereum アドレスの形式か (0x + 16進数 40文字、大文字小文字混在の場合は EIP-55 チェックサム)
+    :param str address:
+    :return bool:
+    """
+    if not isinstance(address, str) or ETH_ADDRESS_RE.match(address) is None:
+        return False
+    body = address[2:]
+    if body.islower() or body.isupper() or body.isdigit():
+        return True
+    return is_checksum_address(address)
+
+
+def address_type(address):
+    """
+    :param str address:
+    :return str: UT, ETH または None (不正な形式)
+    """
+    if is_ut_address_format(address):
+        return UT
+    if is_eth_address(address):
+        return ETH
+    return None
+
+
+def address_types(addresses):
+    """
+    address_type の一括版
+    :param list addresses:
+    :return list: UT, ETH または None
+    """
+    return [address_type(address) for address in addresses]
+
+
+class UTAddressCache:
+    """
+    UTアドレスの存在確認結果のプロセス内キャッシュ
+
+    存在するアドレスは Account の削除時まで、存在しないアドレスは Account の作成時か
+    ttl 秒経過まで (他のプロセスで作成された場合に備えて) 保持する。
+    """
+
+    def __init__(self, size, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = pylru.lrucache(size)
+
+    def get(self, address):
+        """
+        :return bool: キャッシュされていない場合は None
+        """
+        with self._lock:
+            try:
+                exists, expires_at = self._entries[address]
+            except KeyError:
+                return None
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[address]
+                return None
+            return exists
+
+    def set(self, address, exists):
+        with self._lock:
+            self._entries[address] = (exists, None if exists else time.monotonic() + self.ttl)
+
+    def discard(self, address):
+        with self._lock:
+            if address in self._entries:
+                del self._entries[address]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+ut_address_cache = UTAddressCache(settings.UT_ADDRESS_CACHE_SIZE, settings.UT_ADDRESS_CACHE_TTL)
+
+
+def existing_ut_addresses(addresses):
+    """
+    存在するUTアドレスを返す (形式が不正なアドレスは DB に問い合わせない)
+    :param iterable addresses:
+    :return set:
+    """
+    existing = set()
+    unknown = set()
+    for address in addresses:
+        if not is_ut_address_format(address):
+            continue
+        cached = ut_address_cache.get(address)
+        if cached is None:
+            unknown.add(address)
+        elif cached:
+            existing.add(address)
+
+    if unknown:
+        found = set(Account.objects.filter(address__in=unknown).values_list('address', flat=True))
+        for address in unknown:
+            ut_address_cache.set(address, address in found)
+        existing |= found
+    return existing
+
+
+def is_ut_address(address):
+    """
+    存在するUTアドレスか
+    :param str address:
+    :return bool:
+    """
+    return address in existing_ut_addresses([address])
+
+
+def account_saved(sender, instance, created, **kwargs):
+    if created:
+        ut_address_cache.set(instance.address, True)
+
+
+def account_deleted(sender, instance, **kwargs):
+    ut_address_cache.discard(instance.address)
+
+
+def is_registered_address(address):
+    """
+    UTpay に登録されたアドレスか (UTアドレス、ETH アカウントまたはコントラクトのアドレス)
+    :param str address:
+    :return bool:
+    """
+    kind = address_type(address)
+    if kind == UT:
+        return is_ut_address(address)
+    if kind == ETH:
+        return EthAccount.objects.filter(address=address).exists() or \
+            Contract.objects.filter(address=address).exists()
+    return False
@@ -8,7 +8,7 @@ UserAdmin.ordering = ('id',)
 
 
 class ActivateAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user', 'key', 'is_used', 'created_at')
+    list_display = ('id', 'user', 'key', 'is_used', 'email_sent_at', 'created_at')
     list_filter = ('user', 'is_used', 'created_at')
     ordering = ('id',)
 
@@ -33,10 +33,56 @@ class TransactionAdmin(admin.ModelAdmin):
 
 class EthTransactionAdmin(admin.ModelAdmin):
     list_display = (
-        'id', 'tx_hash', 'from_address', 'to_address', 'amount', 'gas', 'gas_price', 'value', 'network_id', 'is_active',
-        'created_at')
+        'id', 'tx_hash', 'from_address', 'to_address', 'amount', 'gas', 'gas_price', 'value', 'network_id', 'status',
+        'block_number', 'gas_used', 'is_active', 'created_at')
     list_filter = (
-        'from_address', 'to_address', 'amount', 'gas', 'gas_price', 'value', 'network_id', 'is_active', 'created_at')
+        'from_address', 'to_address', 'amount', 'gas', 'gas_price', 'value', 'network_id', 'status', 'is_active',
+        'created_at')
+    ordering = ('id',)
+
+
+class PostingAdmin(admin.ModelAdmin):
+    list_display = ('id', 'transaction', 'eth_transaction', 'address', 'amount', 'created_at')
+    list_select_related = ('transaction', 'eth_transaction')
+    list_filter = ('created_at',)
+    search_fields = ('address',)
+    ordering = ('id',)
+
+
+class BalanceCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('id', 'address', 'posting_id', 'balance', 'as_of', 'created_at')
+    list_filter = ('as_of', 'created_at')
+    search_fields = ('address',)
+    ordering = ('id',)
+
+
+class CursorAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'position', 'modified_at')
+    ordering = ('id',)
+
+
+class EthKeyAdmin(admin.ModelAdmin):
+    list_display = ('id', 'address', 'assigned_at', 'created_at')
+    list_filter = ('assigned_at', 'created_at')
+    ordering = ('id',)
+
+
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'status', 'attempts', 'run_at', 'created_at', 'modified_at')
+    list_filter = ('name', 'status', 'created_at')
+    ordering = ('id',)
+
+
+class EthOutboxAdmin(admin.ModelAdmin):
+    list_display = ('id', 'account', 'from_address', 'to_address', 'amount', 'status', 'nonce', 'attempts',
+                    'created_at', 'modified_at')
+    list_select_related = ('account',)
+    list_filter = ('status', 'created_at')
+    ordering = ('id',)
+
+
+class EthNonceAdmin(admin.ModelAdmin):
+    list_display = ('id', 'address', 'nonce', 'modified_at')
     ordering = ('id',)
 
 
@@ -45,6 +91,35 @@ class ContractAdmin(admin.ModelAdmin):
         'id', 'user', 'address', 'name', 'is_active', 'is_verified', 'is_banned', 'verified_at', 'created_at',
         'modified_at')
     list_filter = ('user', 'is_active', 'is_verified', 'is_banned', 'verified_at', 'created_at', 'modified_at')
+    readonly_fields = ('locked_until',)
+    ordering = ('id',)
+
+
+class TransferEventAdmin(admin.ModelAdmin):
+    list_display = ('id', 'transaction', 'tx_hash', 'from_address', 'to_address', 'amount', 'created_at')
+    list_select_related = ('transaction',)
+    list_filter = ('created_at',)
+    search_fields = ('from_address', 'to_address')
+    ordering = ('id',)
+
+
+class ContractDeliveryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'contract', 'event', 'status', 'attempts', 'run_at', 'created_at', 'modified_at')
+    list_select_related = ('contract', 'event')
+    list_filter = ('contract', 'status', 'created_at')
+    ordering = ('id',)
+
+
+class ContractDeadLetterAdmin(admin.ModelAdmin):
+    list_display = ('id', 'contract', 'event', 'attempts', 'last_error', 'created_at')
+    list_select_related = ('contract', 'event')
+    list_filter = ('contract', 'created_at')
+    ordering = ('id',)
+
+
+class IdempotencyKeyAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'key', 'status_code', 'created_at', 'expires_at')
+    list_filter = ('status_code', 'created_at')
     ordering = ('id',)
 
 
@@ -56,3 +131,14 @@ admin.site.register(EthAccount, EthAccountAdmin)
 admin.site.register(Transaction, TransactionAdmin)
 admin.site.register(EthTransaction, EthTransactionAdmin)
 admin.site.register(Contract, ContractAdmin)
+admin.site.register(EthOutbox, EthOutboxAdmin)
+admin.site.register(EthNonce, EthNonceAdmin)
+admin.site.register(Posting, PostingAdmin)
+admin.site.register(BalanceCheckpoint, BalanceCheckpointAdmin)
+admin.site.register(Cursor, CursorAdmin)
+admin.site.register(EthKey, EthKeyAdmin)
+admin.site.register(Task, TaskAdmin)
+admin.site.register(TransferEvent, TransferEventAdmin)
+admin.site.register(ContractDelivery, ContractDeliveryAdmin)
+admin.site.register(ContractDeadLetter, ContractDeadLetterAdmin)
+admin.site.register(IdempotencyKey, IdempotencyKeyAdmin)
@@ -1,5 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete
 
 
 class AccountsConfig(AppConfig):
     name = 'accounts'
+
+    def ready(self):
+        from . import addresses
+        from .models import Account
+
+        post_save.connect(addresses.account_saved, sender=Account)
+        post_delete.connect(addresses.account_deleted, sender=Account)
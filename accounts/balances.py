@@ -0,0 +1,138 @@
+"""
+Ethereum account balance cache
+
+ETH と UTCoin の残高を Django のキャッシュに ETH_BALANCE_CACHE_TTL 秒保持する。
+UTpay が送金を送信したとき、取り込んだとき、トランザクションの状態が変わったときに
+関係するアドレスのキャッシュを破棄する。
+キャッシュにない残高は eth_getBalance と balanceOf の eth_call を1回のバッチ
+リクエストでまとめて取得する。
+"""
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from eth_utils import function_signature_to_4byte_selector
+
+from utpay import chain
+
+BALANCE_OF_SELECTOR = '0x' + function_signature_to_4byte_selector('balanceOf(address)').hex()
+
+
+class BalanceStats:
+    """
+    キャッシュのヒット数と、ノードへの問い合わせ回数
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, hits=0, misses=0, rpc_calls=0, round_trips=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.rpc_calls += rpc_calls
+            self.round_trips += round_trips
+
+    def snapshot(self):
+        """
+        :return dict: {'hits', 'misses', 'hit_rate', 'rpc_calls', 'round_trips'}
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'rpc_calls': self.rpc_calls,
+                'round_trips': self.round_trips,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.rpc_calls = 0
+            self.round_trips = 0
+
+
+stats = BalanceStats()
+
+
+def cache_key(address):
+    return 'eth_balance:' + address.lower()
+
+
+def result_to_int(response):
+    """
+    :param dict response: JSON-RPC のレスポンス
+    :return int:
+    """
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    value = chain.to_hex(response['result'])
+    if value in (None, '0x', ''):
+        return 0
+    return chain.to_int(value)
+
+
+def fetch_balances(addresses):
+    """
+    ノードから残高を取得 (1回のバッチリクエスト)
+    :param list addresses:
+    :return dict: {address: (ETH 残高 (wei), UTCoin 残高 (int))} (エラーが返ったアドレスは None)
+    """
+    calls = []
+    for address in addresses:
+        calls.append(('eth_getBalance', [address, 'latest']))
+        calls.append(('eth_call', [{
+            'from': address,
+            'to': settings.UTCOIN_ADDRESS,
+            'data': BALANCE_OF_SELECTOR + '0' * 24 + address[2:].lower(),
+        }, 'latest']))
+    responses = chain.batch_request(calls)
+    stats.record(rpc_calls=len(calls), round_trips=1)
+    balances = {}
+    for i, address in enumerate(addresses):
+        try:
+            balances[address] = (result_to_int(responses[2 * i]), result_to_int(responses[2 * i + 1]))
+        except RuntimeError as e:
+            # 1件のエラーでバッチ全体を失敗にしない
+            print('Error:', f'{address} の残高を取得できませんでした。', e)
+            balances[address] = None
+    return balances
+
+
+def get_balances(addresses):
+    """
+    :param list addresses: Ethereum アドレス
+    :return dict: {address: (ETH 残高 (wei), UTCoin 残高 (int))} (取得できなかったアドレスは None)
+    """
+    keys = {address: cache_key(address) for address in addresses}
+    cached = cache.get_many(list(keys.values()))
+    balances = {address: tuple(cached[key]) for address, key in keys.items() if key in cached}
+    missing = [address for address in keys if address not in balances]
+    stats.record(hits=len(balances), misses=len(missing))
+
+    if missing:
+        fetched = fetch_balances(missing)
+        cache.set_many({keys[address]: balance for address, balance in fetched.items() if balance is not None},
+                       timeout=settings.ETH_BALANCE_CACHE_TTL)
+        balances.update(fetched)
+    return balances
+
+
+def get_balance(address):
+    """
+    :param str address:
+    :return tuple: (ETH 残高 (wei), UTCoin 残高 (int)) (取得できなかった場合は None)
+    """
+    return get_balances([address])[address]
+
+
+def invalidate(*addresses):
+    """
+    残高が変わるアドレスのキャッシュを破棄
+    :param str addresses:
+    """
+    cache.delete_many([cache_key(address) for address in addresses if address])
@@ -0,0 +1,194 @@
+import contextlib
+import json
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test.utils import (
+    setup_databases, teardown_databases, setup_test_environment, teardown_test_environment,
+)
+from web3 import Web3
+from web3.providers.eth_tester import EthereumTesterProvider
+
+from .models import Account
+
+
+@contextlib.contextmanager
+def test_database(verbosity=0):
+    """
+    ベンチマーク用のテストデータベースを作成し、終了時に破棄する
+    :param int verbosity:
+    """
+    setup_test_environment()
+    old_config = setup_databases(verbosity=verbosity, interactive=False, keepdb=False)
+    try:
+        yield
+    finally:
+        connections.close_all()
+        teardown_databases(old_config, verbosity=verbosity)
+        teardown_test_environment()
+
+
+def make_accounts(n, balance=0, prefix='bench'):
+    """
+    ベンチマーク用の User と Account を一括作成
+    :param int n:
+    :param int balance: 初期残高 (milli-UTC)
+    :param str prefix: ユーザ名の接頭辞
+    :return list: Account objects
+    """
+    base58_alphabet = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+    users = User.objects.bulk_create(
+        User(username=f'{prefix}{i}', email=f'{prefix}{i}@example.com') for i in range(n)
+    )
+    if not users or users[0].pk is None:
+        # bulk_create が主キーを返さないバックエンド (MySQL) 向け
+        users = list(User.objects.filter(username__startswith=prefix).order_by('pk'))
+    Account.objects.bulk_create(
+        Account(user=user, address='UT' + ''.join(secrets.choice(base58_alphabet) for _ in range(40)), balance=balance)
+        for user in users
+    )
+    return list(Account.objects.filter(user__in=users).order_by('pk'))
+
+
+def percentile(samples, p):
+    """
+    :param list samples: ソート済みの値
+    :param float p: 0 - 100
+    :return float:
+    """
+    if not samples:
+        return 0.0
+    k = min(len(samples) - 1, max(0, int(round(p / 100 * (len(samples) - 1)))))
+    return samples[k]
+
+
+def summarize(latencies, elapsed):
+    """
+    レイテンシ (秒) の一覧から集計値を算出
+    :param list latencies:
+    :param float elapsed: 全体の経過時間 (秒)
+    :return dict:
+    """
+    samples = sorted(latencies)
+    return {
+        'count': len(samples),
+        'elapsed': elapsed,
+        'throughput': len(samples) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p95_ms': percentile(samples, 95) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+    }
+
+
+class Timer:
+    """
+    経過時間を計測するコンテキストマネージャ
+    """
+
+    def __init__(self):
+        self.start = None
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def deploy_utcoin(w3, address):
+    """
+    UTCoin をデプロイ
+    :param Web3 w3:
+    :param str address: デプロイするアカウント
+    :return str: コントラクトアドレス (デプロイできないバックエンドの場合は None)
+    """
+    with open(settings.ARTIFACT_PATH, 'r') as artifact:
+        json_dict = json.load(artifact)
+    try:
+        UTCoin = w3.eth.contract(abi=json_dict['abi'], bytecode=json_dict['bytecode'])
+        tx_hash = UTCoin.deploy(transaction={'from': address})
+        contract_address = w3.eth.getTransactionReceipt(tx_hash)['contractAddress']
+        if contract_address and w3.eth.getCode(contract_address) not in (b'', '0x'):
+            return contract_address
+    except Exception:
+        pass
+    return None
+
+
+def encode_rpc(value):
+    """
+    eth-tester の結果を JSON-RPC の表現 (数値は16進数文字列) に変換
+    """
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, int):
+        return hex(value)
+    if isinstance(value, bytes):
+        return '0x' + value.hex()
+    if isinstance(value, dict):
+        return {key: encode_rpc(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_rpc(item) for item in value]
+    return value
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@contextlib.contextmanager
+def tester_rpc_server(tester, latency=0.0):
+    """
+    eth-tester のチェーンを HTTP の JSON-RPC (バッチリクエスト対応) で公開する
+    :param EthereumTester tester:
+    :param float latency: 1回の HTTP リクエストごとに加えるネットワーク遅延 (秒)
+    :return str: エンドポイントの URL
+    """
+    provider = EthereumTesterProvider(tester)
+    request_func = provider.request_func(Web3(provider), ())
+    lock = threading.Lock()
+
+    def call(request):
+        with lock:
+            response = request_func(request['method'], request.get('params') or [])
+        return dict(encode_rpc(response), jsonrpc='2.0', id=request.get('id'))
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # ヘッダと本文を別々に書き込むため、Nagle + delayed ACK の待ちを避ける
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if latency:
+                time.sleep(latency)
+            if isinstance(payload, list):
+                result = [call(request) for request in payload]
+            else:
+                result = call(payload)
+            body = json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,104 @@
+"""
+On-chain confirmation tracker
+
+未確定の EthTransaction のレシートを JSON-RPC のバッチリクエストでまとめて取得し、
+ブロック番号・ガス使用量・状態を記録する。
+settings.ETH_CONFIRMATIONS ブロックに達するまでは毎回レシートを確認し、
+レシートが消えた・ブロックハッシュが変わった場合 (reorg) は状態を戻す。
+"""
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+
+from utpay import chain
+from . import balances
+from .models import EthTransaction
+
+
+def head_block_number():
+    """
+    :return int: 最新のブロック番号
+    """
+    response, = chain.batch_request([('eth_blockNumber', [])])
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return chain.to_int(response['result'])
+
+
+def receipt_fields(receipt, head, depth):
+    """
+    レシートから EthTransaction の更新内容を作成
+    :param dict receipt: JSON-RPC のレシート (None の場合は未取り込み)
+    :param int head: 最新のブロック番号
+    :param int depth: 確定とみなすブロック数
+    :return dict:
+    """
+    if receipt is None or receipt.get('blockNumber') is None:
+        return {
+            'status': EthTransaction.STATUS_PENDING,
+            'block_number': None,
+            'block_hash': None,
+            'gas_used': None,
+        }
+    block_number = chain.to_int(receipt['blockNumber'])
+    # Byzantium 以前のレシートには status がない
+    succeeded = chain.to_int(receipt.get('status', 1)) != 0
+    if head - block_number + 1 < depth:
+        status = EthTransaction.STATUS_MINED
+    elif succeeded:
+        status = EthTransaction.STATUS_CONFIRMED
+    else:
+        status = EthTransaction.STATUS_FAILED
+    return {
+        'status': status,
+        'block_number': block_number,
+        'block_hash': chain.to_hex(receipt['blockHash']),
+        'gas_used': chain.to_int(receipt.get('gasUsed')),
+    }
+
+
+def track(chunk_size=500, depth=None):
+    """
+    未確定の EthTransaction のレシートを確認
+    :param int chunk_size: 1回のバッチリクエストで確認する件数
+    :param int depth: 確定とみなすブロック数 (None の場合は settings.ETH_CONFIRMATIONS)
+    :return Counter: 状態ごとの件数 ('reorged', 'errors' を含む)
+    """
+    if depth is None:
+        depth = settings.ETH_CONFIRMATIONS
+    head = head_block_number()
+    stats = Counter()
+    last_id = 0
+    while True:
+        rows = list(
+            EthTransaction.objects
+            .filter(id__gt=last_id, status__in=[EthTransaction.STATUS_PENDING, EthTransaction.STATUS_MINED])
+            .order_by('id')
+            .values_list('id', 'tx_hash', 'status', 'block_hash', 'from_address', 'to_address')[:chunk_size]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        responses = chain.batch_request([('eth_getTransactionReceipt', [row[1]]) for row in rows])
+
+        changed = set()
+        with transaction.atomic():
+            for (pk, tx_hash, status, block_hash, from_address, to_address), response in zip(rows, responses):
+                if 'error' in response:
+                    print('Error:', tx_hash, response['error'])
+                    stats['errors'] += 1
+                    continue
+                fields = receipt_fields(response.get('result'), head, depth)
+                if status == EthTransaction.STATUS_MINED and fields['block_hash'] != block_hash:
+                    # 取り込まれたブロックがチェーンから外れた
+                    stats['reorged'] += 1
+                stats[fields['status']] += 1
+                if fields['status'] == status and fields['block_hash'] == block_hash:
+                    continue
+                if fields['status'] == EthTransaction.STATUS_FAILED:
+                    fields['is_active'] = False
+                EthTransaction.objects.filter(pk=pk).update(**fields)
+                changed.update((from_address, to_address))
+        balances.invalidate(*changed)
+    return stats
@@ -0,0 +1,136 @@
+"""
+User Contract execution
+
+認証済みのコントラクトのコードは1度だけコンパイルし、modified_at が変わるまでプロセス内に
+キャッシュする。コードは utpay.sandbox の起動済みワーカープロセスで、送金の情報
+(tx_hash, from_address, to_address, amount, amount_fixed) を変数として実行する。
+送金先のコントラクトへの配信は events が行う。
+"""
+import threading
+
+from django.conf import settings
+from web3 import Web3
+
+from utpay import sandbox
+from . import addresses, money, verification
+from .models import Contract
+
+
+class CompileCache:
+    """
+    コンパイル済みのコントラクトのコード (modified_at が変わると破棄)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, contract):
+        """
+        :param Contract contract:
+        :return bytes: marshal したコードオブジェクト (検査を通過しない場合は sandbox.CodeError)
+        """
+        with self._lock:
+            entry = self._entries.get(contract.pk)
+            if entry is not None and entry[0] == contract.modified_at:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        analysis = verification.analyze_cached(contract.code)
+        if not analysis.success:
+            raise sandbox.CodeError(analysis.errors[0])
+        code = analysis.code
+        with self._lock:
+            self._entries[contract.pk] = (contract.modified_at, code)
+        return code
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+compiled = CompileCache()
+
+_lock = threading.Lock()
+_engine = None
+
+
+def configure(engine=None):
+    """
+    使用する Sandbox を差し替え、起動済みのものを終了する (テスト・ベンチマーク用)
+    :param sandbox.Sandbox engine: None の場合は次の実行時に settings から作成する
+    """
+    global _engine
+    with _lock:
+        if _engine is not None:
+            _engine.close()
+        _engine = engine
+
+
+def get_engine():
+    """
+    :return sandbox.Sandbox: プロセス内で共有するワーカープロセスのプール
+    """
+    global _engine
+    if _engine is None:
+        with _lock:
+            if _engine is None:
+                _engine = sandbox.Sandbox(settings.CONTRACT_WORKERS, sandbox.Limits(
+                    cpu_time=settings.CONTRACT_CPU_TIME,
+                    memory=settings.CONTRACT_MEMORY,
+                    wall_time=settings.CONTRACT_WALL_TIME
+                ))
+    return _engine
+
+
+def runnable():
+    """
+    :return QuerySet: 実行できる (有効・認証済み・禁止されていない) コントラクト
+    """
+    return Contract.objects.filter(is_active=True, is_verified=True, is_banned=False, address__isnull=False)
+
+
+def match(address_list):
+    """
+    送金先のアドレスに一致する実行できるコントラクト
+    :param iterable address_list:
+    :return dict: {address.lower(): [Contract, ...]}
+    """
+    candidates = set()
+    for address in address_list:
+        candidates.add(address)
+        if addresses.address_type(address) == addresses.ETH:
+            candidates.update((address.lower(), Web3.toChecksumAddress(address)))
+    matched = {}
+    for contract in runnable().filter(address__in=candidates).order_by('pk'):
+        matched.setdefault(contract.address.lower(), []).append(contract)
+    return matched
+
+
+def execute(contract, tx_hash, from_address, to_address, amount):
+    """
+    コントラクトを実行
+    :param Contract contract:
+    :param str tx_hash:
+    :param str from_address:
+    :param str to_address:
+    :param int amount: milli-UTC
+    :return sandbox.Result:
+    """
+    try:
+        code = compiled.get(contract)
+    except sandbox.CodeError as e:
+        return sandbox.Result(False, str(e))
+    variables = {
+        'tx_hash': tx_hash,
+        'from_address': from_address,
+        'to_address': to_address,
+        'amount': amount,
+        'amount_fixed': money.Amount(amount).fixed,
+    }
+    return get_engine().run((contract.pk, contract.modified_at), code, variables)
@@ -0,0 +1,202 @@
+"""
+Transfer event stream
+
+送金は TransferEvent に追記するだけにし (送金と同じトランザクション)、コントラクトの実行は
+dispatch_events コマンドのディスパッチャが行う。ディスパッチャは TransferEvent を Cursor の
+続きから読み、送金先に一致するコントラクトごとに ContractDelivery を作成 (fan-out) する。
+同じコントラクトへの配信は作成順に1件ずつ行い、失敗した配信は間隔を空けて再実行する
+(at-least-once)。配信中のコントラクトは Contract.locked_until のリースで他のディスパッチャから守り、
+配信の結果は1件ずつコミットする。max_attempts 回失敗した配信は ContractDeadLetter に移して次に進む。
+"""
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import contracts, tasks
+from .models import Contract, ContractDelivery, ContractDeadLetter, Cursor, TransferEvent
+
+CURSOR_NAME = 'transfer_events'
+
+
+def append(from_address, to_address, amount, tx=None, tx_hash=None):
+    """
+    送金を追記 (送金と同じトランザクション内で呼び出す)
+    :param str from_address:
+    :param str to_address:
+    :param int amount: milli-UTC
+    :param Transaction tx: オフチェーン送金の場合
+    :param str tx_hash: オンチェーン送金の場合
+    :return TransferEvent:
+    """
+    return TransferEvent.objects.create(transaction=tx, tx_hash=tx_hash, from_address=from_address,
+                                        to_address=to_address, amount=amount)
+
+
+def append_transactions(txs):
+    """
+    オフチェーン送金をまとめて追記
+    :param list txs: Transaction objects
+    """
+    TransferEvent.objects.bulk_create(
+        TransferEvent(transaction=tx, from_address=tx.from_address, to_address=tx.to_address,
+                      amount=tx.amount)
+        for tx in txs
+    )
+
+
+def fan_out(batch_size=500):
+    """
+    Cursor の続きの TransferEvent を送金先のコントラクトに振り分け、Cursor を進める
+    (ID の採番順とコミット順が前後しても取りこぼさないよう、EVENT_SETTLE_SECONDS 経過したものだけ)
+    :param int batch_size:
+    :return tuple: (読んだイベントの件数, 作成した配信の件数)
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.EVENT_SETTLE_SECONDS)
+    with transaction.atomic():
+        Cursor.objects.get_or_create(name=CURSOR_NAME)
+        cursor = Cursor.objects.select_for_update().get(name=CURSOR_NAME)
+        events = list(
+            TransferEvent.objects.filter(pk__gt=cursor.position, created_at__lte=cutoff).order_by('pk')[:batch_size]
+        )
+        if not events:
+            return 0, 0
+
+        matched = contracts.match({event.to_address for event in events})
+        deliveries = [
+            ContractDelivery(contract=contract, event=event, run_at=event.created_at)
+            for event in events
+            for contract in matched.get(event.to_address.lower(), [])
+        ]
+        ContractDelivery.objects.bulk_create(deliveries)
+        cursor.position = events[-1].pk
+        cursor.save(update_fields=['position', 'modified_at'])
+    return len(events), len(deliveries)
+
+
+def deliver(batch_size=100, max_attempts=5):
+    """
+    配信待ちのあるコントラクトごとに、作成順に配信する
+    (先頭の配信が再実行待ちの間は、そのコントラクトの後続の配信も待たせる)
+    :param int batch_size: 1回に処理するコントラクトの数 (とコントラクトあたりの配信の数)
+    :param int max_attempts:
+    :return Counter: {'delivered', 'retried', 'dead'}
+    """
+    now = timezone.now()
+    counts = Counter()
+    contract_ids = list(
+        ContractDelivery.objects.filter(status=ContractDelivery.STATUS_PENDING, run_at__lte=now)
+        .order_by('contract_id').values_list('contract_id', flat=True).distinct()[:batch_size]
+    )
+    for contract_id in contract_ids:
+        # 他のディスパッチャが配信中のコントラクトは飛ばす
+        lease = acquire(contract_id)
+        if lease is None:
+            continue
+        try:
+            deliveries = list(
+                ContractDelivery.objects.filter(contract_id=contract_id, status=ContractDelivery.STATUS_PENDING)
+                .select_related('event').order_by('id')[:batch_size]
+            )
+            for delivery in deliveries:
+                if delivery.run_at > now:
+                    break
+                # 配信ごとにリースを延長し、コントラクトの状態を読み直す
+                lease = renew(contract_id, lease)
+                if lease is None:
+                    break
+                contract = Contract.objects.get(pk=contract_id)
+                if not (contract.is_active and contract.is_verified and not contract.is_banned):
+                    delivery.attempts = max_attempts
+                    delivery.last_error = 'コントラクトが無効です。'
+                    kill(delivery)
+                    counts['dead'] += 1
+                    continue
+
+                event = delivery.event
+                result = contracts.execute(contract, event.tx_hash, event.from_address, event.to_address,
+                                           event.amount)
+                delivery.attempts += 1
+                if result.success:
+                    delivery.status = ContractDelivery.STATUS_DONE
+                    delivery.last_error = None
+                    delivery.save(update_fields=['status', 'attempts', 'last_error', 'modified_at'])
+                    counts['delivered'] += 1
+                    continue
+
+                delivery.last_error = result.detail
+                if delivery.attempts >= max_attempts:
+                    print('Error:', f'コントラクト {contract.pk} への配信 (event={event.pk}) を中止しました。',
+                          result.detail)
+                    kill(delivery)
+                    counts['dead'] += 1
+                    continue
+                delivery.run_at = now + tasks.retry_delay(delivery.attempts)
+                delivery.save(update_fields=['attempts', 'run_at', 'last_error', 'modified_at'])
+                counts['retried'] += 1
+                break
+        finally:
+            release(contract_id, lease)
+    return counts
+
+
+def acquire(contract_id):
+    """
+    コントラクトへの配信のリースを取得 (期限切れのリースは取得し直せる)
+    :param int contract_id:
+    :return datetime: リースの期限 (他のディスパッチャが配信中の場合は None)
+    """
+    now = timezone.now()
+    locked_until = now + timedelta(seconds=settings.EVENT_LEASE_SECONDS)
+    acquired = Contract.objects.filter(Q(locked_until__isnull=True) | Q(locked_until__lte=now), pk=contract_id) \
+        .update(locked_until=locked_until)
+    return locked_until if acquired else None
+
+
+def renew(contract_id, lease):
+    """
+    リースを延長
+    :param int contract_id:
+    :param datetime lease: acquire, renew が返した期限
+    :return datetime: 新しい期限 (リースを失っていた場合は None)
+    """
+    locked_until = timezone.now() + timedelta(seconds=settings.EVENT_LEASE_SECONDS)
+    renewed = Contract.objects.filter(pk=contract_id, locked_until=lease).update(locked_until=locked_until)
+    return locked_until if renewed else None
+
+
+def release(contract_id, lease):
+    """
+    リースを返す (リースを失っていた場合は何もしない)
+    :param int contract_id:
+    :param datetime lease:
+    """
+    if lease is not None:
+        Contract.objects.filter(pk=contract_id, locked_until=lease).update(locked_until=None)
+
+
+def kill(delivery):
+    """
+    配信を ContractDeadLetter に移す
+    :param ContractDelivery delivery:
+    """
+    with transaction.atomic():
+        ContractDeadLetter.objects.create(contract_id=delivery.contract_id, event_id=delivery.event_id,
+                                          attempts=delivery.attempts, last_error=delivery.last_error)
+        delivery.delete()
+
+
+def replay(dead_letter):
+    """
+    ContractDeadLetter の配信をやり直す (そのコントラクトの配信待ちの最後に追加される)
+    :param ContractDeadLetter dead_letter:
+    :return ContractDelivery:
+    """
+    with transaction.atomic():
+        delivery = ContractDelivery.objects.create(contract_id=dead_letter.contract_id,
+                                                   event_id=dead_letter.event_id)
+        dead_letter.delete()
+    return delivery
@@ -3,6 +3,7 @@ from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from django.forms import ModelForm
 
+from . import verification
 from .models import Contract
 
 
@@ -70,6 +71,13 @@ class ContractForm(ModelForm):
         widget=forms.Textarea(attrs={'class': 'mdl-textfield__input'}),
     )
 
+    def clean_code(self):
+        code = self.cleaned_data.get('code', '')
+        analysis = verification.analyze_cached(code)
+        if not analysis.success:
+            raise forms.ValidationError(list(analysis.errors))
+        return code
+
     class Meta:
         model = Contract
         fields = ['name', 'description', 'code']
@@ -0,0 +1,80 @@
+"""
+Per-address transaction history
+
+アドレスが送金元または送金先の行を OR で検索するとインデックスを使えないため、
+(from_address, created_at, id) と (to_address, created_at, id) の2つのインデックスを
+それぞれ範囲検索して UNION ALL する。ページは (created_at, id) のキーセットで区切り、
+各インデックスから最大 limit 件だけ読む。
+"""
+import heapq
+from itertools import islice
+from operator import attrgetter
+
+from django.db import connections
+from django.db.models import Q
+
+
+def involving(queryset, address):
+    """
+    :param QuerySet queryset: Transaction または EthTransaction
+    :param str address:
+    :return QuerySet: アドレスが送金元または送金先の行 (フィルタ・件数・オフセット形式のページ用)
+    """
+    return queryset.filter(Q(from_address=address) | Q(to_address=address))
+
+
+def branches(queryset, address):
+    """
+    UNION ALL する2つの検索 (自分宛ての送金は送金元側にだけ含める)
+    :return tuple: (送金元が address の行, 送金先が address の行)
+    """
+    return (
+        queryset.filter(from_address=address),
+        queryset.filter(to_address=address).exclude(from_address=address),
+    )
+
+
+def after(queryset, created_at, pk, reverse=False):
+    """
+    キーセットより後 (reverse の場合は前) の行
+    (created_at の範囲条件を重ねて、インデックスをカーソルの位置から読ませる)
+    """
+    if reverse:
+        return queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk),
+                               created_at__gte=created_at)
+    return queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk),
+                           created_at__lte=created_at)
+
+
+def ordering(reverse=False):
+    return ('created_at', 'id') if reverse else ('-created_at', '-id')
+
+
+def count(queryset, address):
+    """
+    :return int: アドレスが送金元または送金先の行の件数
+    """
+    return sum(branch.count() for branch in branches(queryset, address))
+
+
+def page(queryset, address, cursor=None, reverse=False, limit=20):
+    """
+    (created_at, id) の降順 (reverse の場合は昇順) で cursor の続きを最大 limit 件取得
+    :param QuerySet queryset: フィルタ済みの Transaction または EthTransaction
+    :param str address: None の場合は queryset をそのまま使う
+    :param tuple cursor: (created_at, id)
+    :param bool reverse:
+    :param int limit:
+    :return list:
+    """
+    parts = branches(queryset, address) if address is not None else (queryset,)
+    if cursor is not None:
+        parts = [after(part, *cursor, reverse=reverse) for part in parts]
+    parts = [part.order_by(*ordering(reverse))[:limit] for part in parts]
+    if len(parts) == 1:
+        return list(parts[0])
+    if connections[queryset.db].features.supports_slicing_ordering_in_compound:
+        return list(parts[0].union(*parts[1:], all=True).order_by(*ordering(reverse))[:limit])
+    # 複合クエリ内で ORDER BY / LIMIT を使えないバックエンド (SQLite) では、それぞれの結果をマージする
+    merged = heapq.merge(*parts, key=attrgetter('created_at', 'id'), reverse=not reverse)
+    return list(islice(merged, limit))
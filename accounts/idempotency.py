@@ -0,0 +1,176 @@
+"""
+Idempotency keys
+
+Idempotency-Key ヘッダ付きのリクエストのレスポンスを IdempotencyKey に保存し、同じキーで
+再送されたリクエストには処理を再実行せずに保存したレスポンスを返す。
+キーの作成と処理は1つのトランザクションで行うため、処理中のキーで再送されたリクエストは
+一意制約のロック待ちで最初のリクエストの完了を待つ (最初のリクエストが失敗した場合はキーも
+残らず、再送で処理し直す)。同じプロセス内の重複はロックで待ち合わせ、完了したレスポンスは
+プロセス内の LRU キャッシュから返す。期限切れのキーは sweep_idempotency_keys コマンドで削除する。
+"""
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+import pylru
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+MAX_KEY_LENGTH = 128
+
+# 同じプロセス内で同じキーのリクエストを待ち合わせるロックの数
+LOCK_STRIPES = 64
+
+
+class StoredResponse(NamedTuple):
+    """
+    保存したレスポンス
+    """
+    fingerprint: str
+    status_code: int
+    body: str
+    expires_at: datetime
+
+
+class ReplayCache:
+    """
+    保存したレスポンスのプロセス内 LRU キャッシュ
+    """
+
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._entries = pylru.lrucache(size)
+
+    def get(self, user_id, key):
+        """
+        :return StoredResponse: キャッシュされていない (または期限切れの) 場合は None
+        """
+        with self._lock:
+            stored = self._entries.get((user_id, key))
+            if stored is not None and stored.expires_at <= timezone.now():
+                del self._entries[(user_id, key)]
+                return None
+            return stored
+
+    def set(self, user_id, key, stored):
+        with self._lock:
+            self._entries[(user_id, key)] = stored
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+replay_cache = ReplayCache(settings.IDEMPOTENCY_CACHE_SIZE)
+_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+
+class NotStored(Exception):
+    """
+    サーバーエラーのレスポンス (キーを残さずにロールバックする)
+    """
+
+    def __init__(self, stored):
+        super(NotStored, self).__init__(stored.status_code)
+        self.stored = stored
+
+
+def fingerprint(method, path, body):
+    """
+    同じキーが別のリクエストに使われていないか確認するためのハッシュ
+    :param str method:
+    :param str path:
+    :param bytes body:
+    :return str:
+    """
+    digest = hashlib.sha256()
+    for part in (method.encode(), path.encode(), body):
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def execute(user_id, key, request_fingerprint, handler):
+    """
+    キーに保存したレスポンスを返すか、handler を実行してレスポンスを保存する
+    :param int user_id:
+    :param str key:
+    :param str request_fingerprint:
+    :param handler: 引数なしで呼び出し、(ステータスコード, JSON) を返す関数
+    :return tuple: (StoredResponse, 保存済みのレスポンスかどうか)
+    """
+    stored = replay_cache.get(user_id, key)
+    if stored is not None:
+        return stored, True
+
+    with _locks[hash((user_id, key)) % LOCK_STRIPES]:
+        stored = replay_cache.get(user_id, key)
+        if stored is not None:
+            return stored, True
+        stored, replayed = run_once(user_id, key, request_fingerprint, handler)
+        if stored.status_code < 500:
+            replay_cache.set(user_id, key, stored)
+        return stored, replayed
+
+
+def run_once(user_id, key, request_fingerprint, handler):
+    """
+    キーを作成できた場合だけ handler を実行 (同じトランザクションで結果を保存)
+    :return tuple: (StoredResponse, 保存済みのレスポンスかどうか)
+    """
+    while True:
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                try:
+                    with transaction.atomic():
+                        row = IdempotencyKey.objects.create(
+                            user_id=user_id, key=key, fingerprint=request_fingerprint, created_at=now,
+                            expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+                        )
+                except IntegrityError:
+                    row = None
+
+                if row is not None:
+                    status_code, body = handler()
+                    stored = StoredResponse(request_fingerprint, status_code, body, row.expires_at)
+                    if status_code >= 500:
+                        raise NotStored(stored)
+                    row.status_code = status_code
+                    row.response = body
+                    row.save(update_fields=['status_code', 'response'])
+                    return stored, False
+        except NotStored as e:
+            return e.stored, False
+
+        # 同じキーのリクエストが完了済み (処理中だった場合はロック待ちで完了を待った)
+        row = IdempotencyKey.objects.filter(user_id=user_id, key=key).first()
+        if row is None:
+            # 最初のリクエストが失敗してキーが残らなかった
+            continue
+        if row.expires_at <= now:
+            IdempotencyKey.objects.filter(pk=row.pk, expires_at__lte=now).delete()
+            continue
+        return StoredResponse(row.fingerprint, row.status_code, row.response, row.expires_at), True
+
+
+def sweep(batch_size=1000):
+    """
+    期限切れのキーを削除
+    :param int batch_size: 1回の DELETE で削除する件数
+    :return int: 削除した件数
+    """
+    now = timezone.now()
+    deleted = 0
+    while True:
+        pks = list(
+            IdempotencyKey.objects.filter(expires_at__lte=now).order_by('expires_at')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        if not pks:
+            return deleted
+        deleted += IdempotencyKey.objects.filter(pk__in=pks).delete()[0]
@@ -0,0 +1,175 @@
+"""
+UTCoin Transfer event indexer
+
+UTCoin の Transfer イベントをブロック範囲ごとに eth_getLogs で取得し、既知の
+EthAccount が関係するものを EthTransaction に取り込む (UTpay 外からの入金を含む)。
+取り込み済みのブロックは Cursor に保存するため、再起動後は続きから再開する。
+reorg を避けるため最新ブロックから lag ブロック手前までを取り込み、取り込んだ
+トランザクションの確定は confirmations.track に任せる。
+"""
+from django.conf import settings
+from django.db import transaction
+from eth_utils import event_signature_to_log_topic, to_checksum_address
+
+from utpay import chain
+from . import balances, confirmations
+from .models import EthAccount, EthTransaction, Cursor
+
+TRANSFER_TOPIC = '0x' + event_signature_to_log_topic('Transfer(address,address,uint256)').hex()
+CURSOR_NAME = 'utcoin_transfer'
+
+
+def topic_to_address(topic):
+    """
+    :param str topic: indexed な address 引数の topic (32 bytes)
+    :return str: チェックサム付きアドレス
+    """
+    return to_checksum_address('0x' + chain.to_hex(topic)[-40:])
+
+
+class KnownAddresses:
+    """
+    EthAccount のアドレスのプロセス内の集合 (追加された分だけ読み込む)
+    """
+
+    def __init__(self):
+        self.addresses = set()
+        self.last_id = 0
+
+    def refresh(self):
+        rows = list(EthAccount.objects.filter(id__gt=self.last_id).order_by('id').values_list('id', 'address'))
+        for pk, address in rows:
+            self.addresses.add(address.lower())
+        if rows:
+            self.last_id = rows[-1][0]
+
+    def __contains__(self, address):
+        return address.lower() in self.addresses
+
+
+class TransferIndexer:
+    """
+    :param int chunk_size: 1回の eth_getLogs で取得するブロック数
+    :param int lag: 最新ブロックから取り込みを遅らせるブロック数 (None の場合は settings.ETH_CONFIRMATIONS)
+    :param int start_block: Cursor がない場合に取り込みを開始するブロック
+    """
+
+    def __init__(self, chunk_size=1000, lag=None, start_block=None):
+        self.chunk_size = chunk_size
+        self.lag = settings.ETH_CONFIRMATIONS if lag is None else lag
+        self.start_block = settings.UTCOIN_START_BLOCK if start_block is None else start_block
+        self.known = KnownAddresses()
+        self.network_id = None
+
+    def position(self):
+        """
+        :return int: 取り込み済みの最後のブロック番号
+        """
+        cursor, _ = Cursor.objects.get_or_create(name=CURSOR_NAME, defaults={'position': self.start_block - 1})
+        return cursor.position
+
+    def fetch_logs(self, from_block, to_block):
+        """
+        :return list: 既知のアドレスが関係する Transfer イベント (tx_hash ごとに最初の1件)
+        """
+        response, = chain.batch_request([('eth_getLogs', [{
+            'fromBlock': hex(from_block),
+            'toBlock': hex(to_block),
+            'address': settings.UTCOIN_ADDRESS,
+            'topics': [TRANSFER_TOPIC],
+        }])])
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+
+        logs = {}
+        for log in response['result'] or []:
+            if log.get('removed'):
+                continue
+            from_address = topic_to_address(log['topics'][1])
+            to_address = topic_to_address(log['topics'][2])
+            if from_address not in self.known and to_address not in self.known:
+                continue
+            tx_hash = chain.to_hex(log['transactionHash'])
+            logs.setdefault(tx_hash, {
+                'tx_hash': tx_hash,
+                'from_address': from_address,
+                'to_address': to_address,
+                'amount': chain.to_int(log['data']),
+                'block_number': chain.to_int(log['blockNumber']),
+                'block_hash': chain.to_hex(log['blockHash']),
+            })
+        return list(logs.values())
+
+    def index_range(self, from_block, to_block):
+        """
+        ブロック範囲の Transfer イベントを取り込み、Cursor を進める
+        :return int: 新たに取り込んだ件数
+        """
+        logs = self.fetch_logs(from_block, to_block)
+        existing = set(
+            EthTransaction.objects.filter(tx_hash__in=[log['tx_hash'] for log in logs])
+            .values_list('tx_hash', flat=True)
+        )
+        new_logs = [log for log in logs if log['tx_hash'] not in existing]
+
+        calls = [('eth_getTransactionByHash', [log['tx_hash']]) for log in new_logs]
+        if new_logs and self.network_id is None:
+            calls.append(('net_version', []))
+        responses = chain.batch_request(calls)
+        if any('error' in response for response in responses):
+            raise RuntimeError('トランザクションの取得に失敗しました。')
+        if new_logs and self.network_id is None:
+            self.network_id = int(responses.pop()['result'])
+
+        rows = []
+        for log, response in zip(new_logs, responses):
+            tx_info = response['result'] or {}
+            rows.append(EthTransaction(
+                tx_hash=log['tx_hash'],
+                from_address=log['from_address'],
+                to_address=log['to_address'],
+                amount=log['amount'],
+                gas=chain.to_int(tx_info.get('gas', 0)),
+                gas_price=chain.to_int(tx_info.get('gasPrice', 0)),
+                value=chain.to_int(tx_info.get('value', 0)),
+                network_id=self.network_id or 0,
+                status=EthTransaction.STATUS_MINED,
+                block_number=log['block_number'],
+                block_hash=log['block_hash'],
+            ))
+
+        with transaction.atomic():
+            EthTransaction.objects.bulk_create(rows)
+            for log in logs:
+                if log['tx_hash'] in existing:
+                    # UTpay から送信したトランザクション
+                    EthTransaction.objects.filter(
+                        tx_hash=log['tx_hash'], status=EthTransaction.STATUS_PENDING
+                    ).update(
+                        status=EthTransaction.STATUS_MINED,
+                        block_number=log['block_number'],
+                        block_hash=log['block_hash'],
+                    )
+            Cursor.objects.filter(name=CURSOR_NAME).update(position=to_block)
+        balances.invalidate(*{address for log in logs for address in (log['from_address'], log['to_address'])})
+        return len(rows)
+
+    def run(self, max_blocks=None):
+        """
+        Cursor の続きから (最新ブロック - lag) まで取り込む
+        :param int max_blocks: 1回の実行で取り込む最大ブロック数
+        :return tuple: (取り込んだブロック数, 取り込んだ件数)
+        """
+        self.known.refresh()
+        position = self.position()
+        target = confirmations.head_block_number() - self.lag
+        if max_blocks is not None:
+            target = min(target, position + max_blocks)
+        blocks = 0
+        stored = 0
+        while position < target:
+            to_block = min(position + self.chunk_size, target)
+            stored += self.index_range(position + 1, to_block)
+            blocks += to_block - position
+            position = to_block
+        return blocks, stored
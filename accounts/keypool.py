@@ -0,0 +1,156 @@
+"""
+Pre-generated Ethereum keypair pool
+
+鍵はバックグラウンドで生成し (os.urandom)、ノードに importRawKey したうえでアドレスとパスワードを
+EthKey に保存する (秘密鍵はノードの keystore にだけ置き、パスワードと同じ行には保存しない)。
+EthAccount や Contract への割り当ては未割り当ての行を1件確保するだけなので、ノードでの鍵導出を待たずに済む。
+残りが KEYPOOL_LOW_WATERMARK を下回るとタスクで KEYPOOL_SIZE まで補充する。
+"""
+import os
+import secrets
+import string
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from utpay import chain
+from utpay.db import skip_locked
+from . import tasks
+from .models import EthKey, Task
+
+
+class PoolStats:
+    """
+    プロセス内での鍵の割り当て・生成件数
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, claims=0, misses=0, generated=0):
+        with self._lock:
+            self.claims += claims
+            self.misses += misses
+            self.generated += generated
+
+    def snapshot(self):
+        """
+        :return dict: {'claims', 'misses', 'generated'}
+        """
+        with self._lock:
+            return {'claims': self.claims, 'misses': self.misses, 'generated': self.generated}
+
+    def reset(self):
+        with self._lock:
+            self.claims = 0
+            self.misses = 0
+            self.generated = 0
+
+
+stats = PoolStats()
+
+
+def make_random_password(length):
+    """
+    ランダムなパスワードを生成
+    :param int length: パスワードの文字数
+    :return str: password
+    """
+    alphabet = string.ascii_letters + string.digits
+    password = ''.join(secrets.choice(alphabet) for _ in range(length))
+    return password
+
+
+def generate_key():
+    """
+    鍵を生成
+    :return str: 秘密鍵 (16進数)
+    """
+    return os.urandom(32).hex()
+
+
+def add_keys(n):
+    """
+    鍵を生成してノードに登録し、プールに追加
+    (ノードでの鍵導出に時間がかかるため、登録はトランザクションの外で行い、最後にまとめて保存する)
+    :param int n:
+    :return int: 追加した件数
+    """
+    web3 = chain.get_web3()
+    keys = []
+    try:
+        for _ in range(n):
+            password = make_random_password(length=30)
+            address = web3.personal.importRawKey(generate_key(), password)
+            keys.append(EthKey(address=address, password=password))
+    finally:
+        # 途中で失敗しても、ノードに登録した鍵は保存する
+        with transaction.atomic():
+            EthKey.objects.bulk_create(keys)
+        stats.record(generated=len(keys))
+    return len(keys)
+
+
+def available():
+    """
+    :return int: 未割り当ての鍵の件数
+    """
+    return EthKey.objects.filter(assigned_at__isnull=True).count()
+
+
+def claim():
+    """
+    未割り当ての鍵を1件割り当てる (呼び出し元のトランザクションがロールバックされた場合は戻る)
+    :return EthKey: プールが空の場合は None
+    """
+    with transaction.atomic():
+        key = skip_locked(EthKey.objects.filter(assigned_at__isnull=True).order_by('id')).first()
+        if key is None:
+            stats.record(misses=1)
+        else:
+            key.assigned_at = timezone.now()
+            key.save(update_fields=['assigned_at'])
+            stats.record(claims=1)
+    schedule_refill()
+    return key
+
+
+def schedule_refill():
+    """
+    残りが KEYPOOL_LOW_WATERMARK を下回っていれば補充タスクを登録 (登録済みの場合は何もしない)
+    """
+    if available() >= settings.KEYPOOL_LOW_WATERMARK:
+        return
+    if Task.objects.filter(
+        name=tasks.task_name(refill), status__in=[Task.STATUS_QUEUED, Task.STATUS_RUNNING]
+    ).exists():
+        return
+    tasks.enqueue(refill)
+
+
+@tasks.non_atomic
+def refill():
+    """
+    KEYPOOL_REFILL_BATCH 件ずつ KEYPOOL_SIZE まで補充する (足りない場合は次のタスクを登録)
+    """
+    shortage = settings.KEYPOOL_SIZE - available()
+    if shortage <= 0:
+        return
+    add_keys(min(shortage, settings.KEYPOOL_REFILL_BATCH))
+    if shortage > settings.KEYPOOL_REFILL_BATCH:
+        tasks.enqueue(refill)
+
+
+def new_account():
+    """
+    Ethereum アカウントを用意 (プールが空の場合はノードで作成)
+    :return tuple: (address, password)
+    """
+    key = claim()
+    if key is not None:
+        return key.address, key.password
+    password = make_random_password(length=30)
+    return chain.get_web3().personal.newAccount(password), password
@@ -0,0 +1,249 @@
+from typing import NamedTuple, Optional
+
+from django.db import transaction
+from django.db.models import F, Case, When, BigIntegerField, Sum
+from django.utils import timezone
+
+from . import activity, addresses, events, money
+from .models import Account, Transaction, Posting, BalanceCheckpoint
+
+
+class TransferResult(NamedTuple):
+    """
+    送金結果
+    """
+    success: bool
+    detail: str = ''
+    transaction: Optional[Transaction] = None
+
+
+def to_amount(value):
+    """
+    送金額を最小単位に変換 (不正な値、0以下の値は None)
+    :param value: str, int, float or Decimal (UTC)、または money.Amount
+    :return int: milli-UTC
+    """
+    amount = money.parse(value)
+    if amount is None or amount <= 0:
+        return None
+    return int(amount)
+
+
+def transfer(from_account, to_address, amount):
+    """
+    UTアドレス間で UTCoin を送金 (オフチェーン)
+
+    両アカウントを主キー順に select_for_update でロックし (デッドロック回避)、
+    残高は F() 式による条件付き UPDATE で増減する。
+    :param Account from_account:
+    :param str to_address:
+    :param amount: str, int, float or Decimal (UTC)、または money.Amount
+    :return TransferResult:
+    """
+    if not to_address or not amount:
+        return TransferResult(False, 'アドレスまたは金額が入力されていません。')
+
+    amount = to_amount(amount)
+    if amount is None:
+        return TransferResult(False, '金額が不正です。')
+
+    if to_address == from_account.address or not addresses.is_ut_address_format(to_address):
+        return TransferResult(False, '無効なアドレスです。')
+
+    with transaction.atomic():
+        locked = list(
+            Account.objects.select_for_update()
+                .filter(address__in=[from_account.address, to_address])
+                .order_by('pk')
+                .values_list('pk', 'address', 'user_id')
+        )
+        to_pk, to_user_id = next(((pk, user_id) for pk, address, user_id in locked if address == to_address),
+                                 (None, None))
+        if to_pk is None:
+            return TransferResult(False, '無効なアドレスです。')
+
+        if not debit(from_account, amount):
+            return TransferResult(False, '送金可能額を超えています。')
+        credit(to_pk, amount)
+
+        # Create Transaction
+        tx = Transaction.objects.create(
+            from_address=from_account.address,
+            to_address=to_address,
+            amount=amount
+        )
+        Posting.objects.bulk_create(make_postings(tx))
+        events.append_transactions([tx])
+        activity.invalidate(from_account.user_id, to_user_id)
+
+    return TransferResult(True, transaction=tx)
+
+
+def transfer_batch(from_account, transfers):
+    """
+    複数のUTアドレスへまとめて送金 (オフチェーン)
+
+    宛先の存在確認は1回の address__in クエリで行い、残高の増減と Transaction の作成は
+    1つのトランザクション内で一括して行う。残高が合計額に満たない場合は全件失敗とする。
+    :param Account from_account:
+    :param list transfers: [{'address': str, 'amount': str}, ...]
+    :return list: 各送金の TransferResult (transfers と同じ順序)
+    """
+    results = [None] * len(transfers)
+    pending = []
+    for i, item in enumerate(transfers):
+        to_address = item.get('address') if isinstance(item, dict) else None
+        amount = item.get('amount') if isinstance(item, dict) else None
+        if not to_address or not amount:
+            results[i] = TransferResult(False, 'アドレスまたは金額が入力されていません。')
+            continue
+        amount = to_amount(amount)
+        if amount is None:
+            results[i] = TransferResult(False, '金額が不正です。')
+            continue
+        if to_address == from_account.address or not addresses.is_ut_address_format(to_address):
+            results[i] = TransferResult(False, '無効なアドレスです。')
+            continue
+        pending.append((i, to_address, amount))
+
+    if not pending:
+        return results
+
+    with transaction.atomic():
+        to_addresses = {to_address for _, to_address, _ in pending}
+        locked = dict(
+            (address, (pk, user_id)) for pk, address, user_id in Account.objects.select_for_update()
+                .filter(address__in=to_addresses | {from_account.address})
+                .order_by('pk')
+                .values_list('pk', 'address', 'user_id')
+        )
+
+        valid = []
+        for i, to_address, amount in pending:
+            if to_address in locked:
+                valid.append((i, to_address, amount))
+            else:
+                results[i] = TransferResult(False, '無効なアドレスです。')
+
+        if not valid:
+            return results
+
+        total = sum(amount for _, _, amount in valid)
+        if not debit(from_account, total):
+            for i, _, _ in valid:
+                results[i] = TransferResult(False, '送金可能額を超えています。')
+            return results
+
+        credits = {}
+        for _, to_address, amount in valid:
+            pk = locked[to_address][0]
+            credits[pk] = credits.get(pk, 0) + amount
+        Account.objects.filter(pk__in=credits).update(
+            balance=F('balance') + Case(
+                *[When(pk=pk, then=amount) for pk, amount in credits.items()],
+                output_field=BigIntegerField()
+            ),
+            modified_at=timezone.now()
+        )
+
+        # Create Transactions
+        now = timezone.now()
+        txs = Transaction.objects.bulk_create(
+            Transaction(from_address=from_account.address, to_address=to_address, amount=amount, created_at=now)
+            for _, to_address, amount in valid
+        )
+        if txs and txs[0].pk is None:
+            # bulk_create が主キーを返さないバックエンド (MySQL) 向け
+            # 送金元の行ロック中なので、この作成日時の送金元の Transaction は今回作成したものだけ
+            pks = Transaction.objects.filter(from_address=from_account.address, created_at=now) \
+                .order_by('pk').values_list('pk', flat=True)
+            for tx, pk in zip(txs, pks):
+                tx.pk = pk
+        Posting.objects.bulk_create(posting for tx in txs for posting in make_postings(tx))
+        events.append_transactions(txs)
+        activity.invalidate(from_account.user_id, *(locked[to_address][1] for _, to_address, _ in valid))
+        for (i, _, _), tx in zip(valid, txs):
+            results[i] = TransferResult(True, transaction=tx)
+
+    return results
+
+
+def debit(account, amount):
+    """
+    残高が足りる場合のみ減算
+    :param Account account:
+    :param int amount: milli-UTC
+    :return bool: 減算できたかどうか
+    """
+    # F() 式のパラメータは int にする (MySQLdb は int の派生クラスを文字列として渡す)
+    amount = int(amount)
+    updated = Account.objects.filter(pk=account.pk, balance__gte=amount).update(
+        balance=F('balance') - amount,
+        modified_at=timezone.now()
+    )
+    return updated == 1
+
+
+def credit(account_pk, amount):
+    """
+    残高を加算
+    :param int account_pk:
+    :param int amount: milli-UTC
+    """
+    Account.objects.filter(pk=account_pk).update(
+        balance=F('balance') + int(amount),
+        modified_at=timezone.now()
+    )
+
+
+def make_postings(tx):
+    """
+    Transaction に対応する複式の Posting (出金・入金) を作成 (未保存)
+    :param Transaction tx:
+    :return tuple: (出金, 入金)
+    """
+    return (
+        Posting(transaction=tx, address=tx.from_address, amount=-tx.amount, created_at=tx.created_at),
+        Posting(transaction=tx, address=tx.to_address, amount=tx.amount, created_at=tx.created_at),
+    )
+
+
+def record_withdrawal(from_account, eth_transaction, amount):
+    """
+    UTアドレスから ETH アドレスへの出金を Posting に記録
+    :param Account from_account:
+    :param EthTransaction eth_transaction:
+    :param int amount: milli-UTC
+    """
+    Posting.objects.bulk_create([
+        Posting(eth_transaction=eth_transaction, address=from_account.address, amount=-amount,
+                created_at=eth_transaction.created_at),
+        Posting(eth_transaction=eth_transaction, address=eth_transaction.to_address, amount=amount,
+                created_at=eth_transaction.created_at),
+    ])
+
+
+def balance_as_of(address, at=None):
+    """
+    指定時点の残高を Posting から計算
+
+    直近の BalanceCheckpoint と、それ以降の Posting (高々チェックポイント間隔分) の合計から求める。
+    :param str address:
+    :param datetime at: 省略時は現在
+    :return int: milli-UTC
+    """
+    checkpoints = BalanceCheckpoint.objects.filter(address=address)
+    postings = Posting.objects.filter(address=address)
+    if at is not None:
+        checkpoints = checkpoints.filter(as_of__lte=at)
+        postings = postings.filter(created_at__lte=at)
+
+    checkpoint = checkpoints.order_by('-posting_id').first()
+    if checkpoint is None:
+        balance = 0
+    else:
+        balance = checkpoint.balance
+        postings = postings.filter(id__gt=checkpoint.posting_id)
+
+    tail = postings.aggregate(total=Sum('amount'))['total']
+    return balance + (tail or 0)
@@ -0,0 +1,71 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from eth_tester import EthereumTester
+from web3 import Web3
+from web3.providers.eth_tester import EthereumTesterProvider
+
+from accounts.benchmark import deploy_utcoin, summarize
+from utpay import chain
+
+
+class Command(BaseCommand):
+    help = 'Measure per-request Web3 client overhead against an eth-tester chain, before and after sharing the client.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help='number of simulated requests')
+
+    def handle(self, *args, **options):
+        n = options['requests']
+        tester = EthereumTester()
+        provider = EthereumTesterProvider(tester)
+        address = tester.get_accounts()[0]
+        utcoin_address = deploy_utcoin(Web3(provider), address)
+        if utcoin_address is None:
+            self.stdout.write('UTCoin をデプロイできないバックエンドのため、balanceOf は計測しません。')
+
+        with override_settings(UTCOIN_ADDRESS=utcoin_address or settings.UTCOIN_ADDRESS):
+            def before():
+                # 変更前: リクエストごとに Web3・ABI・コントラクトを作成
+                w3 = Web3(EthereumTesterProvider(tester))
+                with open(settings.ARTIFACT_PATH, 'r') as artifact:
+                    abi = json.load(artifact)['abi']
+                UTCoin = w3.eth.contract(abi=abi, address=settings.UTCOIN_ADDRESS)
+                w3.eth.getBalance(address)
+                if utcoin_address:
+                    UTCoin.call().balanceOf(address)
+
+            def after():
+                # 変更後: プロセス内で共有するクライアントを使用
+                w3 = chain.get_web3()
+                UTCoin = chain.get_utcoin()
+                w3.eth.getBalance(address)
+                if utcoin_address:
+                    UTCoin.call().balanceOf(address)
+
+            chain.configure(provider)
+            chain.metrics.reset()
+            try:
+                for label, fn in (('before', before), ('after', after)):
+                    fn()  # warm up
+                    latencies = []
+                    start = time.perf_counter()
+                    for _ in range(n):
+                        t = time.perf_counter()
+                        fn()
+                        latencies.append(time.perf_counter() - t)
+                    summary = summarize(latencies, time.perf_counter() - start)
+                    self.stdout.write(
+                        f'{label:<7} {summary["throughput"]:9.1f} req/sec  '
+                        f'p50={summary["p50_ms"]:.3f}ms p99={summary["p99_ms"]:.3f}ms'
+                    )
+
+                self.stdout.write('\nJSON-RPC latency (shared client):')
+                for method, entry in sorted(chain.metrics.snapshot().items()):
+                    self.stdout.write(f'  {method:<24} count={entry["count"]:<6} '
+                                      f'mean={entry["mean"] * 1000:.3f}ms max={entry["max"] * 1000:.3f}ms')
+            finally:
+                chain.configure(None)
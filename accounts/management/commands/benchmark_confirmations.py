@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from eth_tester import EthereumTester
+
+from accounts import confirmations
+from accounts.benchmark import test_database, tester_rpc_server, Timer
+from accounts.models import EthTransaction
+from utpay import chain
+
+
+class Command(BaseCommand):
+    help = 'Compare one JSON-RPC round trip per receipt with batched receipt requests on pending transactions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hashes', type=int, default=2000, help='number of pending transactions')
+        parser.add_argument('--chunk-size', type=int, default=500, help='receipts per batch request')
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='simulated network latency per HTTP request (seconds)')
+        parser.add_argument('--depth', type=int, default=12, help='confirmation depth')
+
+    def handle(self, *args, **options):
+        n = options['hashes']
+        tester = EthereumTester()
+        sender, receiver = tester.get_accounts()[:2]
+        tx_hashes = [
+            # 同じ内容だとハッシュが重複するバックエンドがあるため value を変える
+            tester.send_transaction({'from': sender, 'to': receiver, 'value': i + 1, 'gas': 21000})
+            for i in range(n)
+        ]
+
+        with test_database(), tester_rpc_server(tester, latency=options['latency']) as url:
+            EthTransaction.objects.bulk_create(
+                EthTransaction(tx_hash=tx_hash, from_address=sender, to_address=receiver, amount=0,
+                               gas=21000, gas_price=1, value=1, network_id=1)
+                for tx_hash in tx_hashes
+            )
+            chain.configure(chain.PooledHTTPProvider(url))
+            try:
+                head = confirmations.head_block_number()
+
+                def before():
+                    # 変更前: トランザクションごとに1回の JSON-RPC 呼び出し
+                    w3 = chain.get_web3()
+                    with transaction.atomic():
+                        for pk, tx_hash in EthTransaction.objects.values_list('id', 'tx_hash'):
+                            receipt = w3.eth.getTransactionReceipt(tx_hash)
+                            fields = confirmations.receipt_fields(receipt, head, options['depth'])
+                            EthTransaction.objects.filter(pk=pk).update(**fields)
+
+                def after():
+                    # 変更後: chunk_size 件ずつバッチリクエスト
+                    confirmations.track(options['chunk_size'], options['depth'])
+
+                for label, fn in (('sequential', before), ('batched', after)):
+                    EthTransaction.objects.update(
+                        status=EthTransaction.STATUS_PENDING, block_number=None, block_hash=None, gas_used=None
+                    )
+                    chain.metrics.reset()
+                    with Timer() as timer:
+                        fn()
+                    round_trips = sum(entry['count'] for entry in chain.metrics.snapshot().values())
+                    tracked = EthTransaction.objects.exclude(status=EthTransaction.STATUS_PENDING).count()
+                    self.stdout.write(
+                        f'{label:<10} {n / timer.elapsed:9.1f} receipts/sec  elapsed={timer.elapsed:.3f}s  '
+                        f'round_trips={round_trips}  tracked={tracked}/{n}'
+                    )
+            finally:
+                chain.configure(None)
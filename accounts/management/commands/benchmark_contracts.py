@@ -0,0 +1,88 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from accounts import contracts
+from accounts.benchmark import test_database, summarize
+from accounts.models import Contract
+from utpay import sandbox
+
+SAMPLE_CODE = {
+    'noop': 'pass',
+    'fee': 'fee = amount * 3 // 100\nprint(tx_hash, from_address, to_address, fee, amount_fixed)',
+    'loop': 'total = 0\nfor i in range(10000):\n    total += i * amount\nprint(total)',
+    'strings': "memo = ','.join(str(i) for i in range(500))\nprint(len(memo), memo.upper()[:10])",
+}
+
+
+class Command(BaseCommand):
+    help = 'Measure contract callbacks/sec and latency per contract on the sandbox worker pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=2000, help='callbacks per contract')
+        parser.add_argument('--workers', type=int, default=settings.CONTRACT_WORKERS, help='worker processes')
+        parser.add_argument('--baseline-calls', type=int, default=20,
+                            help='callbacks per contract starting a new process and compiling on every call '
+                                 '(0 to skip)')
+
+    def handle(self, *args, **options):
+        with test_database():
+            user = User.objects.create_user(username='bench', email='bench@example.com', password='hogehoge')
+            objs = [
+                Contract.objects.create(user=user, address='0x' + f'{i + 1:040x}', name=name, code=code,
+                                        is_verified=True)
+                for i, (name, code) in enumerate(SAMPLE_CODE.items())
+            ]
+
+            if options['baseline_calls']:
+                # 比較用: 呼び出しごとにコンパイルし、新しいワーカープロセスで実行
+                for contract in objs:
+                    latencies = []
+                    start = time.perf_counter()
+                    for i in range(options['baseline_calls']):
+                        t = time.perf_counter()
+                        engine = sandbox.Sandbox(1)
+                        try:
+                            code = sandbox.compile_code(contract.code)
+                            engine.run(i, code, self.variables(contract, i))
+                        finally:
+                            engine.close()
+                        latencies.append(time.perf_counter() - t)
+                    self.report('per call', contract, summarize(latencies, time.perf_counter() - start))
+
+            contracts.configure(sandbox.Sandbox(options['workers']))
+            contracts.compiled.clear()
+            try:
+                with ThreadPoolExecutor(options['workers']) as executor:
+                    for contract in objs:
+                        def call(i):
+                            t = time.perf_counter()
+                            result = contracts.execute(contract, **self.variables(contract, i))
+                            assert result.success, result.detail
+                            return time.perf_counter() - t
+
+                        start = time.perf_counter()
+                        latencies = list(executor.map(call, range(options['calls'])))
+                        self.report('pool', contract, summarize(latencies, time.perf_counter() - start))
+                self.stdout.write(f'compile cache: hits={contracts.compiled.hits} misses={contracts.compiled.misses}  '
+                                  f'restarts={contracts.get_engine().restarts}')
+            finally:
+                contracts.configure(None)
+
+    def report(self, label, contract, summary):
+        self.stdout.write(
+            f'{label:<9} {contract.name:<8} {summary["throughput"]:9.1f} callbacks/sec  '
+            f'p50={summary["p50_ms"]:.2f}ms p99={summary["p99_ms"]:.2f}ms'
+        )
+
+    @staticmethod
+    def variables(contract, i):
+        return {
+            'tx_hash': '0x' + f'{i:064x}',
+            'from_address': '0x' + 'ab' * 20,
+            'to_address': contract.address,
+            'amount': 1000 + i,
+        }
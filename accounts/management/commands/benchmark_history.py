@@ -0,0 +1,82 @@
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from accounts import history
+from accounts.benchmark import test_database, make_accounts
+from accounts.models import Transaction
+
+
+class Command(BaseCommand):
+    help = ('Compare per-page latency of the transaction history query (offset, keyset over an OR of the '
+            'address predicates, keyset over a UNION ALL of the address indexes) on large ledgers.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000000, 10000000],
+                            help='ledger sizes to measure (the ledger grows to each size in turn)')
+        parser.add_argument('--share', type=float, default=0.1,
+                            help='fraction of the transactions involving the benchmark user')
+        parser.add_argument('--limit', type=int, default=20, help='page size')
+        parser.add_argument('--pages', type=int, nargs='+', default=[1, 10, 100, 1000, 4000],
+                            help='page numbers to fetch')
+        parser.add_argument('--repeat', type=int, default=5, help='queries per page (median is reported)')
+
+    def handle(self, *args, **options):
+        limit = options['limit']
+        every = max(2, round(1 / options['share']))
+        with test_database():
+            account, other = make_accounts(2)
+            address = account.address
+            start = timezone.now() - timedelta(seconds=max(options['rows']))
+            created = 0
+            for rows in sorted(options['rows']):
+                self.stdout.write(f'creating {rows - created} transactions...')
+                batch = []
+                for i in range(created, rows):
+                    # 送金と受取を半分ずつ
+                    if i % every == 0:
+                        from_address, to_address = address, other.address
+                    elif i % every == every // 2:
+                        from_address, to_address = other.address, address
+                    else:
+                        from_address, to_address = other.address, 'UT' + '1' * 40
+                    batch.append(Transaction(from_address=from_address, to_address=to_address, amount=1,
+                                             created_at=start + timedelta(seconds=i)))
+                    if len(batch) == 10000:
+                        Transaction.objects.bulk_create(batch)
+                        batch = []
+                Transaction.objects.bulk_create(batch)
+                created = rows
+
+                self.stdout.write(f'{rows} rows')
+                self.stdout.write(f'{"page":>6} {"offset":>12} {"or":>12} {"union":>12}')
+                involving = history.involving(Transaction.objects.all(), address)
+                ordered = involving.order_by(*history.ordering())
+                for page in options['pages']:
+                    offset = (page - 1) * limit
+                    # 直前のページの最後の行のカーソル (計測対象外)
+                    previous = ordered[offset - 1:offset].first() if offset else None
+                    if offset and previous is None:
+                        break
+                    cursor = (previous.created_at, previous.pk) if previous else None
+                    or_page = involving if cursor is None else history.after(involving, *cursor)
+                    timings = [
+                        self.measure(lambda: list(ordered[offset:offset + limit + 1]), options['repeat']),
+                        self.measure(lambda: list(or_page.order_by(*history.ordering())[:limit + 1]),
+                                     options['repeat']),
+                        self.measure(lambda: history.page(involving, address, cursor, limit=limit + 1),
+                                     options['repeat']),
+                    ]
+                    self.stdout.write(f'{page:>6} ' + ' '.join(f'{timing:>10.2f}ms' for timing in timings))
+
+    @staticmethod
+    def measure(query, repeat):
+        latencies = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            query()
+            latencies.append(time.perf_counter() - t)
+        return statistics.median(latencies) * 1000
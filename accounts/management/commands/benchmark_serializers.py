@@ -0,0 +1,80 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from accounts.benchmark import test_database, Timer
+from accounts.models import Transaction, EthTransaction
+from api.serializer import (
+    TransactionSerializer, TransactionRowSerializer, EthTransactionSerializer, EthTransactionRowSerializer,
+)
+
+
+class Command(BaseCommand):
+    help = ('Compare rows/sec of the DRF transaction serializers with the values_list fast path '
+            '(the JSON output must be byte-identical).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help='number of rows to serialize')
+        parser.add_argument('--repeat', type=int, default=3, help='runs per measurement (best is reported)')
+
+    def handle(self, *args, **options):
+        cases = (
+            (Transaction, TransactionSerializer, TransactionRowSerializer, self.make_transaction),
+            (EthTransaction, EthTransactionSerializer, EthTransactionRowSerializer, self.make_eth_transaction),
+        )
+        with test_database():
+            start = timezone.now() - timedelta(seconds=max(options['rows']))
+            created = 0
+            for rows in sorted(options['rows']):
+                for model, _, _, make in cases:
+                    batch = [make(i, start + timedelta(seconds=i)) for i in range(created, rows)]
+                    model.objects.bulk_create(batch)
+                created = rows
+
+                self.stdout.write(f'{rows} rows')
+                self.stdout.write(f'{"":>16} {"drf":>12} {"values_list":>12} {"instances":>12} {"speedup":>8}')
+                for model, serializer_class, row_serializer_class, _ in cases:
+                    queryset = model.objects.order_by('id')
+                    renderer = JSONRenderer()
+                    expected = renderer.render(serializer_class(queryset, many=True).data)
+                    assert renderer.render(row_serializer_class().from_queryset(queryset)) == expected
+                    instances = list(queryset)
+
+                    # 行の取得 (values_list / インスタンス化) と JSON の出力を含む
+                    timings = [
+                        self.measure(lambda: renderer.render(serializer_class(queryset.all(), many=True).data),
+                                     options['repeat']),
+                        self.measure(lambda: renderer.render(row_serializer_class().from_queryset(queryset.all())),
+                                     options['repeat']),
+                        # 取得済みのインスタンス (ページネーション後の一覧)
+                        self.measure(lambda: renderer.render(row_serializer_class().from_instances(instances)),
+                                     options['repeat']),
+                    ]
+                    self.stdout.write(
+                        f'{model.__name__:>16} ' + ' '.join(f'{rows / timing:>8.0f}r/s' for timing in timings) +
+                        f' {timings[0] / timings[1]:>7.1f}x'
+                    )
+
+    @staticmethod
+    def make_transaction(i, created_at):
+        return Transaction(from_address='UT' + 'a' * 40, to_address='UT' + 'b' * 40, amount=i * 7 + 1,
+                           created_at=created_at)
+
+    @staticmethod
+    def make_eth_transaction(i, created_at):
+        return EthTransaction(tx_hash='0x%064x' % i, from_address='0x' + '1' * 40, to_address='0x' + '2' * 40,
+                              amount=i * 7 + 1, gas=21000, gas_price=10 ** 9, value=0, network_id=3,
+                              status=EthTransaction.STATUS_CONFIRMED, block_number=i, gas_used=21000,
+                              created_at=created_at)
+
+    @staticmethod
+    def measure(run, repeat):
+        best = None
+        for _ in range(repeat):
+            with Timer() as timer:
+                run()
+            best = timer.elapsed if best is None else min(best, timer.elapsed)
+        return best
@@ -0,0 +1,70 @@
+import os
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+from eth_keyfile import create_keyfile_json
+from eth_tester import EthereumTester
+from web3.providers.eth_tester import EthereumTesterProvider
+
+from accounts import keypool, provisioning
+from accounts.benchmark import test_database, summarize
+from accounts.models import EthAccount
+from utpay import chain
+
+
+class Command(BaseCommand):
+    help = 'Measure signups/sec with and without the pre-generated Ethereum key pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--signups', type=int, default=20, help='number of signups per run')
+        parser.add_argument('--no-kdf', action='store_true',
+                            help='do not emulate the key derivation geth performs in personal.newAccount')
+
+    def handle(self, *args, **options):
+        n = options['signups']
+        emulate_kdf = not options['no_kdf']
+        chain.configure(EthereumTesterProvider(EthereumTester()))
+        try:
+            with test_database(), override_settings(KEYPOOL_LOW_WATERMARK=0):
+                def without_pool(i):
+                    # 変更前: リクエスト内でノードにアカウントを作成
+                    self.signup(f'nopool{i}')
+                    if emulate_kdf:
+                        # eth-tester は鍵導出を行わないため、geth と同じ scrypt の keystore 暗号化を行う
+                        create_keyfile_json(os.urandom(32), b'password', kdf='scrypt')
+                    provisioning.create_eth_account(User.objects.get(username=f'nopool{i}').pk)
+
+                def with_pool(i):
+                    # 変更後: 生成済みの鍵を割り当てる
+                    self.signup(f'pool{i}')
+
+                for label, fn in (('no pool', without_pool), ('pool', with_pool)):
+                    if label == 'pool':
+                        # 計測対象外 (バックグラウンドで補充される)
+                        keypool.add_keys(n)
+                    keypool.stats.reset()
+                    latencies = []
+                    start = time.perf_counter()
+                    for i in range(n):
+                        t = time.perf_counter()
+                        with transaction.atomic():
+                            fn(i)
+                        latencies.append(time.perf_counter() - t)
+                    summary = summarize(latencies, time.perf_counter() - start)
+                    self.stdout.write(
+                        f'{label:<8} {summary["throughput"]:8.2f} signups/sec  '
+                        f'p50={summary["p50_ms"]:.1f}ms p99={summary["p99_ms"]:.1f}ms  '
+                        f'pool={keypool.stats.snapshot()}'
+                    )
+                self.stdout.write(f'EthAccount: {EthAccount.objects.count()} / {2 * n}')
+        finally:
+            chain.configure(None)
+
+    @staticmethod
+    def signup(username):
+        user = User.objects.create_user(username=username, email=f'{username}@example.com', password='hogehoge',
+                                        is_active=False)
+        provisioning.provision(user, 'http://testserver')
@@ -0,0 +1,265 @@
+import json
+import platform
+import secrets
+import subprocess
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from eth_tester import EthereumTester
+from rest_framework.test import APIClient
+from web3 import Web3
+from web3.providers.eth_tester import EthereumTesterProvider
+
+from accounts import balances, keypool, money
+from accounts.benchmark import test_database, make_accounts, summarize, deploy_utcoin, Timer
+from accounts.models import EthAccount, EthOutbox, Transaction
+from utpay import chain
+
+SCENARIOS = ('signup', 'transfer', 'eth_transfer', 'history', 'get_balance', 'get_qrcode')
+
+PASSWORD = 'benchmark-password'
+
+
+class Command(BaseCommand):
+    help = ('Run the end-to-end benchmark suite: drive the real views (signup, off-chain transfer, UT->ETH transfer, '
+            'history paging, get_balance, get_qrcode) against an in-process eth-tester chain and the configured '
+            'database, and write throughput and p50/p95/p99 latencies to a JSON file.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='measured requests per scenario')
+        parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests per scenario')
+        parser.add_argument('--users', type=int, default=20, help='number of benchmark users')
+        parser.add_argument('--history-rows', type=int, default=10000,
+                            help='transactions involving the user whose history is paged')
+        parser.add_argument('--page-size', type=int, default=20, help='history page size')
+        parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+        parser.add_argument('--output', default='benchmark.json', help='JSON file to write the results to')
+        parser.add_argument('--baseline', help='JSON file of an earlier run to compare against')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError('--users must be 2 or more')
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline'], 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+
+        tester = EthereumTester()
+        provider = EthereumTesterProvider(tester)
+        admin_address = tester.get_accounts()[0]
+        utcoin_address = deploy_utcoin(Web3(provider), admin_address)
+        chain.configure(provider)
+        try:
+            with test_database(), override_settings(UTCOIN_ADDRESS=utcoin_address or settings.UTCOIN_ADDRESS,
+                                                    KEYPOOL_LOW_WATERMARK=0, ALLOWED_HOSTS=['testserver']):
+                cache.clear()
+                self.setup(admin_address, options['users'])
+                results = {}
+                for name in options['scenarios']:
+                    if name == 'get_balance' and utcoin_address is None:
+                        results[name] = {'skipped': 'UTCoin をデプロイできないバックエンドのため計測しません。'}
+                    else:
+                        results[name] = getattr(self, f'run_{name}')(options)
+                    self.report(name, results[name], baseline)
+                database = connection.vendor
+        finally:
+            chain.configure(None)
+
+        report = {
+            'commit': self.git('rev-parse', 'HEAD'),
+            'dirty': bool(self.git('status', '--porcelain', '--untracked-files=no')),
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': database,
+            'options': {key: options[key] for key in ('requests', 'warmup', 'users', 'history_rows', 'page_size')},
+            'scenarios': results,
+        }
+        with open(options['output'], 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        self.stdout.write(f'wrote {options["output"]}')
+
+    def setup(self, admin_address, n_users):
+        """
+        送金元の管理者 (pk=1) とベンチマーク用のユーザー (Account, EthAccount) を作成
+        """
+        admin = User.objects.create_superuser(username='admin', email='admin@example.com', password=PASSWORD)
+        EthAccount.objects.create(user=admin, address=admin_address, password='')
+
+        self.accounts = make_accounts(n_users, balance=int(money.parse(1000000)))
+        # パスワードのハッシュは1回だけ計算する
+        User.objects.filter(pk__in=[account.user_id for account in self.accounts]).update(
+            password=make_password(PASSWORD))
+        EthAccount.objects.bulk_create(
+            EthAccount(user_id=account.user_id, address='0x' + secrets.token_hex(20), password='')
+            for account in self.accounts
+        )
+        self.eth_addresses = list(EthAccount.objects.filter(user__in=[account.user_id for account in self.accounts])
+                                  .order_by('user_id').values_list('address', flat=True))
+        self.users = list(User.objects.filter(pk__in=[account.user_id for account in self.accounts]).order_by('pk'))
+
+    def measure(self, request, options, ok):
+        """
+        :param callable request: request(i) -> Response (i < 0 はウォームアップ)
+        :param dict options:
+        :param callable ok: ok(response) -> bool
+        :return dict: summarize の結果と失敗したリクエスト数
+        """
+        for i in range(-options['warmup'], 0):
+            request(i)
+        latencies = []
+        errors = 0
+        with Timer() as total:
+            for i in range(options['requests']):
+                with Timer() as timer:
+                    response = request(i)
+                latencies.append(timer.elapsed)
+                if not ok(response):
+                    errors += 1
+        return dict(summarize(latencies, total.elapsed), errors=errors)
+
+    def api_client(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def run_signup(self, options):
+        """
+        サインアップ (仮登録、鍵は事前生成したプールから割り当てる)
+        """
+        # 計測対象外 (本番ではバックグラウンドで補充される)
+        keypool.add_keys(options['warmup'] + options['requests'])
+        client = Client()
+        url = reverse('accounts:signup')
+
+        def request(i):
+            username = f'signup{i + options["warmup"]}'
+            return client.post(url, {
+                'username': username, 'first_name': 'Taro', 'last_name': 'Benchmark',
+                'email': f'{username}@g.ecc.u-tokyo.ac.jp', 'password1': PASSWORD, 'password2': PASSWORD,
+            })
+
+        return dict(self.measure(request, options, lambda response: response.status_code == 302),
+                    keypool=keypool.stats.snapshot())
+
+    def run_transfer(self, options):
+        """
+        UTアドレス間の送金 (POST /api/v1/transactions/transfer/)
+        """
+        clients = [self.api_client(user) for user in self.users]
+        url = '/api/v1/transactions/transfer/'
+
+        def request(i):
+            sender = i % len(clients)
+            to_address = self.accounts[(sender + 1) % len(self.accounts)].address
+            return clients[sender].post(url, {'address': to_address, 'amount': '0.001'}, format='json')
+
+        return self.measure(request, options, lambda response: response.status_code == 201)
+
+    def run_eth_transfer(self, options):
+        """
+        UTアドレスから ETH アドレスへの送金 (送金フォーム、送信は process_eth_outbox が行うため含まない)
+        """
+        clients = []
+        for user in self.users:
+            client = Client()
+            client.force_login(user)
+            clients.append(client)
+        url = reverse('website:transfer')
+        queued = EthOutbox.objects.count()
+
+        def request(i):
+            return clients[i % len(clients)].post(url, {
+                'address': '0x' + '1' * 40, 'amount': '0.001', 'fee': '0.000', 'balance': '0.000',
+                'password': PASSWORD,
+            })
+
+        result = self.measure(request, options, lambda response: response.status_code == 200)
+        # 入力エラーでもフォームを 200 で返すため、登録された送金の件数で確認する
+        queued = EthOutbox.objects.count() - queued
+        result['errors'] += options['warmup'] + options['requests'] - queued
+        return result
+
+    def run_history(self, options):
+        """
+        送金履歴のページング (GET /api/v1/transactions/、next を最後のページまでたどる)
+        """
+        account, other = self.accounts[0], self.accounts[1]
+        start = timezone.now() - timedelta(seconds=options['history_rows'])
+        Transaction.objects.bulk_create(
+            Transaction(from_address=account.address if i % 2 else other.address,
+                        to_address=other.address if i % 2 else account.address,
+                        amount=1, created_at=start + timedelta(seconds=i))
+            for i in range(options['history_rows'])
+        )
+        client = self.api_client(self.users[0])
+        first = f'/api/v1/transactions/?limit={options["page_size"]}'
+        state = {'next': first}
+
+        def request(i):
+            response = client.get(state['next'])
+            state['next'] = response.data.get('next') or first
+            return response
+
+        return self.measure(request, options, lambda response: response.status_code == 200)
+
+    def run_get_balance(self, options):
+        """
+        ETH・UTCoin の残高 (GET /api/v1/eth_accounts/<address>/get_balance/、残高のキャッシュを含む)
+        """
+        clients = [self.api_client(user) for user in self.users]
+        balances.stats.reset()
+
+        def request(i):
+            n = i % len(clients)
+            return clients[n].get(f'/api/v1/eth_accounts/{self.eth_addresses[n]}/get_balance/')
+
+        return dict(self.measure(request, options, lambda response: response.status_code == 200),
+                    balance_cache=balances.stats.snapshot())
+
+    def run_get_qrcode(self, options):
+        """
+        QR コードの URL (GET /api/v1/eth_accounts/<address>/get_qrcode/)
+        """
+        clients = [self.api_client(user) for user in self.users]
+
+        def request(i):
+            n = i % len(clients)
+            return clients[n].get(f'/api/v1/eth_accounts/{self.eth_addresses[n]}/get_qrcode/')
+
+        return self.measure(request, options, lambda response: response.status_code == 200)
+
+    def report(self, name, result, baseline):
+        if 'skipped' in result:
+            self.stdout.write(f'{name:<13} skipped: {result["skipped"]}')
+            return
+        line = (f'{name:<13} {result["throughput"]:8.1f} req/sec  p50={result["p50_ms"]:.2f}ms '
+                f'p95={result["p95_ms"]:.2f}ms p99={result["p99_ms"]:.2f}ms  errors={result["errors"]}')
+        previous = (baseline or {}).get('scenarios', {}).get(name)
+        if previous and previous.get('throughput'):
+            # 1.0 より大きいほど速い
+            line += (f'  vs baseline: throughput x{result["throughput"] / previous["throughput"]:.2f} '
+                     f'p50 x{previous["p50_ms"] / result["p50_ms"]:.2f} '
+                     f'p99 x{previous["p99_ms"] / result["p99_ms"]:.2f}')
+        self.stdout.write(line)
+
+    @staticmethod
+    def git(*args):
+        """
+        :return str: git の出力 (git がない場合は None)
+        """
+        try:
+            return subprocess.run(('git',) + args, cwd=settings.BASE_DIR, stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,96 @@
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, DatabaseError
+from django.db.models import Sum
+
+from accounts import ledger, money
+from accounts.benchmark import test_database, make_accounts, summarize, Timer
+from accounts.models import Account, Transaction
+
+
+class Command(BaseCommand):
+    help = 'Stress test the off-chain transfer engine and check for lost updates.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='number of worker threads')
+        parser.add_argument('--transfers', type=int, default=200, help='transfers per thread')
+        parser.add_argument('--accounts', type=int, nargs='+', default=[2, 8, 64],
+                            help='number of accounts (contention level: fewer accounts = more contention)')
+        parser.add_argument('--initial-balance', type=int, default=1000, help='initial balance per account (UTC)')
+
+    def handle(self, *args, **options):
+        with test_database():
+            for n in options['accounts']:
+                self.run(n, options['threads'], options['transfers'], int(money.parse(options['initial_balance'])))
+
+    def run(self, n_accounts, n_threads, n_transfers, initial_balance):
+        Transaction.objects.all().delete()
+        Account.objects.all().delete()
+        accounts = make_accounts(n_accounts, balance=initial_balance, prefix=f'bench{n_accounts}_')
+        latencies = []
+        failures = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker(seed):
+            rnd = random.Random(seed)
+            local_latencies = []
+            local_failures = 0
+            local_errors = 0
+            try:
+                for _ in range(n_transfers):
+                    from_account, to_account = rnd.sample(accounts, 2)
+                    amount = money.Amount(rnd.randint(1, 5000))
+                    start = time.perf_counter()
+                    try:
+                        result = ledger.transfer(from_account, to_account.address, amount)
+                    except DatabaseError:
+                        # SQLite などテーブルロックのバックエンドではロック待ちに失敗することがある
+                        local_errors += 1
+                        continue
+                    local_latencies.append(time.perf_counter() - start)
+                    if not result.success:
+                        local_failures += 1
+            finally:
+                connection.close()
+            with lock:
+                latencies.extend(local_latencies)
+                failures.append(local_failures)
+                errors.append(local_errors)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+        with Timer() as timer:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        summary = summarize(latencies, timer.elapsed)
+        lost = self.count_lost_updates(accounts, initial_balance)
+        total = Account.objects.aggregate(total=Sum('balance'))['total']
+
+        self.stdout.write(
+            f'accounts={n_accounts:<4} threads={n_threads:<3} '
+            f'transfers={summary["count"]:<6} rejected={sum(failures):<5} errors={sum(errors):<5} '
+            f'{summary["throughput"]:8.1f} transfers/sec  '
+            f'p50={summary["p50_ms"]:.2f}ms p99={summary["p99_ms"]:.2f}ms  '
+            f'lost_updates={lost}'
+        )
+        if lost or total != initial_balance * n_accounts:
+            self.stderr.write(f'残高が一致しません: total={total}')
+
+    @staticmethod
+    def count_lost_updates(accounts, initial_balance):
+        """
+        Transaction の履歴から期待される残高と実際の残高を比較
+        :return int: 残高が一致しないアカウント数
+        """
+        expected = {account.address: initial_balance for account in accounts}
+        for from_address, to_address, amount in Transaction.objects.values_list('from_address', 'to_address', 'amount'):
+            expected[from_address] -= amount
+            expected[to_address] += amount
+        actual = dict(Account.objects.values_list('address', 'balance'))
+        return sum(1 for address, balance in expected.items() if actual[address] != balance)
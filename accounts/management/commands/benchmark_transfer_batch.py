@@ -0,0 +1,52 @@
+import json
+
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIClient
+
+from accounts import money
+from accounts.benchmark import test_database, make_accounts, Timer
+from accounts.models import Account, Transaction
+
+
+class Command(BaseCommand):
+    help = 'Compare the batch transfer endpoint with N single transfer calls.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, nargs='+', default=[10, 100, 1000],
+                            help='number of recipients per payout')
+
+    def handle(self, *args, **options):
+        with test_database():
+            self.run(1, report=False)  # warm up
+            for n in options['recipients']:
+                self.run(n)
+
+    def run(self, n, report=True):
+        Transaction.objects.all().delete()
+        Account.objects.all().delete()
+        payer, *recipients = make_accounts(n + 1, balance=n * 10 * money.UNIT, prefix=f'payout{n}_')
+        client = APIClient()
+        client.force_authenticate(user=payer.user)
+        transfers = [{'address': account.address, 'amount': '1.000'} for account in recipients]
+
+        # N single calls
+        with Timer() as single:
+            for item in transfers:
+                response = client.post('/api/v1/transactions/transfer/', json.dumps(item),
+                                       content_type='application/json')
+                assert response.data['success'], response.data
+
+        # One batch call
+        with Timer() as batch:
+            response = client.post('/api/v1/transactions/transfer_batch/', json.dumps({'transfers': transfers}),
+                                   content_type='application/json')
+        assert all(result['success'] for result in response.data['results']), response.data
+
+        payer.refresh_from_db()
+        assert payer.balance == n * 10 - n * 2
+        if not report:
+            return
+        self.stdout.write(
+            f'recipients={n:<5} single={single.elapsed * 1000:9.1f}ms '
+            f'batch={batch.elapsed * 1000:9.1f}ms  speedup={single.elapsed / batch.elapsed:6.1f}x'
+        )
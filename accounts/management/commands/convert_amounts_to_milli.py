@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, models
+
+from accounts.models import Account, Transaction, Posting, BalanceCheckpoint
+
+# UTC の DecimalField から milli-UTC の BigIntegerField に変更した列
+FIELDS = (
+    (Account, 'balance'),
+    (Transaction, 'amount'),
+    (Posting, 'amount'),
+    (BalanceCheckpoint, 'balance'),
+)
+
+
+class Command(BaseCommand):
+    help = ('Convert the UTC DecimalField amount columns of an existing database to milli-UTC integers. '
+            'Run this BEFORE makemigrations/migrate: the generated AlterField would truncate the decimals on MySQL. '
+            'Columns that are no longer decimal are skipped, so it is safe to run again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only list the columns that would be converted')
+
+    def handle(self, *args, **options):
+        for model, name in FIELDS:
+            table = model._meta.db_table
+            column = model._meta.get_field(name).column
+            field_type = self.column_type(table, column)
+            if field_type != 'DecimalField':
+                self.stdout.write(f'{table}.{column}: {field_type or "no such column"}, skipped')
+                continue
+            if options['dry_run']:
+                self.stdout.write(f'{table}.{column}: would convert')
+                continue
+            self.convert(model, name)
+            self.stdout.write(f'{table}.{column}: converted to milli-UTC')
+
+    @staticmethod
+    def column_type(table, column):
+        """
+        :return str: 列の型 (introspection のフィールド名、テーブルまたは列がない場合は None)
+        """
+        with connection.cursor() as cursor:
+            if table not in connection.introspection.table_names(cursor):
+                return None
+            for info in connection.introspection.get_table_description(cursor, table):
+                if info.name == column:
+                    return connection.introspection.get_field_type(info.type_code, info)
+        return None
+
+    @staticmethod
+    def convert(model, name):
+        """
+        DECIMAL(12, 3) の UTC を BIGINT の milli-UTC に変換
+        (1000倍すると DECIMAL(12, 3) に収まらないため、桁数を広げてから変換し、整数の列に変更する)
+        :param Model model:
+        :param str name: フィールド名
+        """
+        new_field = model._meta.get_field(name)
+        old_field = models.DecimalField(max_digits=12, decimal_places=3)
+        wide_field = models.DecimalField(max_digits=18, decimal_places=3)
+        for field in (old_field, wide_field):
+            field.set_attributes_from_name(name)
+            field.model = model
+
+        table = connection.ops.quote_name(model._meta.db_table)
+        column = connection.ops.quote_name(new_field.column)
+        with connection.schema_editor() as editor:
+            editor.alter_field(model, old_field, wide_field)
+            editor.execute(f'UPDATE {table} SET {column} = ROUND({column} * 1000)')
+            editor.alter_field(model, wide_field, new_field)
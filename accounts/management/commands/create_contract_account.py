@@ -1,13 +1,10 @@
 from django.core.management.base import BaseCommand
-from django.conf import settings
 from django.db import transaction
+from django.urls import reverse
 from django.utils import timezone
 import sys
-from web3 import Web3, HTTPProvider
-import secrets
-import string
-import qrcode
 
+from accounts import keypool
 from accounts.models import Contract
 
 
@@ -30,7 +27,6 @@ class Command(BaseCommand):
         print('User:', contract.user)
         print('address:', contract.address)
         print('password:', contract.password)
-        print('qrcode:', contract.qrcode)
         print('name:', contract.name)
         print('is_active:', contract.is_active)
         print('is_verified:', contract.is_verified)
@@ -53,22 +49,12 @@ class Command(BaseCommand):
         # Ethereum アカウント作成
         try:
             with transaction.atomic():
-                # Generate random password and address
-                web3 = Web3(HTTPProvider(settings.WEB3_PROVIDER))
-                alphabet = string.ascii_letters + string.digits
-                password = ''.join(secrets.choice(alphabet) for _ in range(30))
-                address = web3.personal.newAccount(password)
-
-                # Generate QR code
-                img = qrcode.make(address)
-                file_name = address + '.png'
-                file_path = '/images/qrcode/contract/' + file_name
-                img.save(settings.MEDIA_ROOT + file_path)
+                # Assign a pre-generated key (or create a new account on the node)
+                address, password = keypool.new_account()
 
                 # Save contract object
                 contract.address = address
                 contract.password = password
-                contract.qrcode = file_path
                 contract.modified_at = timezone.now()
                 contract.save()
         except Exception as e:
@@ -80,7 +66,7 @@ class Command(BaseCommand):
         print('\nEthereum アカウントを作成しました！')
         print('Address:', contract.address)
         print('Password:', contract.password)
-        print('QR code:', contract.qrcode)
+        print('QR code:', reverse('accounts:qrcode', args=[contract.address]))
 
         print('\n認証を行うには次のコマンドを実行してください:')
         print(f'  > python manage.py verify_contract {contract_id}')
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts import events
+
+
+class Command(BaseCommand):
+    help = 'Fan transfer events out to matching contracts and run the deliveries with retries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='events read per iteration')
+        parser.add_argument('--contracts', type=int, default=100, help='contracts delivered to per iteration')
+        parser.add_argument('--max-attempts', type=int, default=5,
+                            help='attempts before a delivery is moved to the dead-letter table')
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds to sleep when idle')
+        parser.add_argument('--once', action='store_true', help='process one batch and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            read, fanned_out = events.fan_out(options['batch_size'])
+            counts = events.deliver(options['contracts'], options['max_attempts'])
+            if read or counts:
+                self.stdout.write(
+                    f'events={read} deliveries={fanned_out} delivered={counts["delivered"]} '
+                    f'retried={counts["retried"]} dead={counts["dead"]}'
+                )
+
+            if options['once']:
+                break
+            if not read and not counts:
+                time.sleep(options['interval'])
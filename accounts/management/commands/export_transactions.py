@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.models import Transaction, EthTransaction
+from api import exports
+from api.serializer import TransactionRowSerializer, EthTransactionRowSerializer
+
+MODELS = {
+    'transaction': (Transaction, TransactionRowSerializer),
+    'eth_transaction': (EthTransaction, EthTransactionRowSerializer),
+}
+
+
+class Command(BaseCommand):
+    help = 'Export the transaction history as CSV or JSON Lines (streamed in keyset chunks).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=sorted(MODELS), default='transaction')
+        parser.add_argument('--type', choices=sorted(exports.FORMATS), default='csv', help='output format')
+        parser.add_argument('--since', help='ISO 8601 date or datetime (inclusive)')
+        parser.add_argument('--until', help='ISO 8601 date or datetime (exclusive)')
+        parser.add_argument('--address', help='only transactions from or to this address')
+        parser.add_argument('--chunk-size', type=int, default=exports.CHUNK_SIZE, help='rows per query')
+        parser.add_argument('--output', help='output file (default: stdout)')
+
+    def handle(self, *args, **options):
+        model, row_serializer_class = MODELS[options['model']]
+        try:
+            since = exports.parse_time(options['since']) if options['since'] else None
+            until = exports.parse_time(options['until']) if options['until'] else None
+        except ValueError as e:
+            raise CommandError(f'invalid date: {e}')
+
+        queryset = exports.filter_queryset(model.objects.all(), since, until)
+        lines = exports.export(queryset, row_serializer_class(), options['type'], options['address'],
+                               options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,42 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts.indexer import TransferIndexer
+
+
+class Command(BaseCommand):
+    help = 'Ingest UTCoin Transfer events touching known Ethereum accounts, resuming from the stored cursor.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='blocks per eth_getLogs request')
+        parser.add_argument('--lag', type=int, default=settings.ETH_CONFIRMATIONS,
+                            help='blocks to stay behind the chain head')
+        parser.add_argument('--from-block', type=int, default=settings.UTCOIN_START_BLOCK,
+                            help='first block when no cursor is stored')
+        parser.add_argument('--interval', type=float, default=5.0, help='seconds to sleep when caught up')
+        parser.add_argument('--once', action='store_true', help='catch up once and exit')
+
+    def handle(self, *args, **options):
+        indexer = TransferIndexer(options['chunk_size'], options['lag'], options['from_block'])
+        while True:
+            start = time.perf_counter()
+            try:
+                blocks, stored = indexer.run()
+            except Exception as e:
+                if options['once']:
+                    raise
+                print(e)
+                print('Error:', 'Transfer イベントの取り込みに失敗しました。')
+                blocks = stored = 0
+            elapsed = time.perf_counter() - start
+            if blocks:
+                self.stdout.write(
+                    f'blocks={blocks} transfers={stored} position={indexer.position()} '
+                    f'{blocks / elapsed:.1f} blocks/sec'
+                )
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
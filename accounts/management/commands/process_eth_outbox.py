@@ -0,0 +1,46 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from accounts import outbox
+from accounts.models import EthOutbox
+
+
+class Command(BaseCommand):
+    help = 'Send queued on-chain UTCoin transfers and apply confirmations recorded by track_confirmations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help='transfers claimed per iteration')
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds to sleep when idle')
+        parser.add_argument('--once', action='store_true', help='process one batch and exit')
+        parser.add_argument('--reconcile-after', type=float, default=300,
+                            help='seconds before a transfer left in sending is checked against the node')
+
+    def handle(self, *args, **options):
+        sender = outbox.Sender()
+        while True:
+            # 送信中のまま残った送金 (ノードが受け付けたか分からない) をノードの状態と照合する
+            stale = list(EthOutbox.objects.filter(
+                status=EthOutbox.STATUS_SENDING,
+                modified_at__lt=timezone.now() - timedelta(seconds=options['reconcile_after'])
+            ).order_by('from_address', 'nonce')[:options['batch_size']])
+            if stale:
+                counts = sender.reconcile(stale)
+                self.stdout.write(f'reconciled: sent={counts[EthOutbox.STATUS_SENT]} '
+                                  f'requeued={counts[EthOutbox.STATUS_QUEUED]} '
+                                  f'unknown={counts[EthOutbox.STATUS_SENDING]}')
+
+            items = outbox.claim(options['batch_size'])
+            counts = sender.send_all(items)
+            mined = outbox.check_receipts(options['batch_size'])
+            if items or mined:
+                self.stdout.write(f'sent={counts[EthOutbox.STATUS_SENT]} failed={counts[EthOutbox.STATUS_FAILED]} '
+                                  f'unknown={counts[EthOutbox.STATUS_SENDING]} '
+                                  f'requeued={counts[EthOutbox.STATUS_QUEUED]} mined={mined}')
+
+            if options['once']:
+                break
+            if not items:
+                time.sleep(options['interval'])
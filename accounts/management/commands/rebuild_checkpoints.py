@@ -0,0 +1,159 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum, Count, Max
+from django.utils import timezone
+
+from accounts import ledger
+from accounts.models import Account, Transaction, Posting, BalanceCheckpoint, Cursor
+
+
+class Command(BaseCommand):
+    help = 'Rebuild and verify balance checkpoints incrementally.'
+    cursor_name = 'balance_checkpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help='postings per chunk')
+        parser.add_argument('--interval', type=int, default=settings.LEDGER_CHECKPOINT_INTERVAL,
+                            help='postings per address between checkpoints')
+        parser.add_argument('--backfill', action='store_true', help='create postings for old transactions')
+        parser.add_argument('--full', action='store_true', help='drop all checkpoints and rebuild from scratch')
+        parser.add_argument('--verify', action='store_true', help='verify checkpoints and account balances')
+
+    def handle(self, *args, **options):
+        if options['full']:
+            with transaction.atomic():
+                BalanceCheckpoint.objects.all().delete()
+                Cursor.objects.filter(name=self.cursor_name).delete()
+
+        if options['backfill']:
+            self.backfill(options['chunk_size'])
+
+        self.rebuild(options['chunk_size'], options['interval'])
+
+        if options['verify'] and not self.verify(options['chunk_size']):
+            raise SystemExit(1)
+
+    def backfill(self, chunk_size):
+        """
+        Posting が作成されていない Transaction の Posting を作成
+        """
+        last_id = 0
+        created = 0
+        while True:
+            txs = list(
+                Transaction.objects.filter(id__gt=last_id, posting__isnull=True).order_by('id')[:chunk_size]
+            )
+            if not txs:
+                break
+            Posting.objects.bulk_create(posting for tx in txs for posting in ledger.make_postings(tx))
+            last_id = txs[-1].id
+            created += len(txs) * 2
+        self.stdout.write(f'backfill: {created} postings created')
+
+    def rebuild(self, chunk_size, interval):
+        """
+        カーソル以降の Posting を ID 順に集計し、interval 件ごとにチェックポイントを作成
+        """
+        cursor, _ = Cursor.objects.get_or_create(name=self.cursor_name)
+        cutoff = timezone.now() - timedelta(seconds=settings.LEDGER_SETTLE_SECONDS)
+        state = {}
+        processed = 0
+        created = 0
+
+        while True:
+            rows = list(
+                Posting.objects.filter(id__gt=cursor.position).order_by('id')
+                    .values_list('id', 'address', 'amount', 'created_at')[:chunk_size]
+            )
+            # 最近の Posting より先は、ID の小さい未コミットの Posting がありうるので次回に回す
+            settled = next((i for i, row in enumerate(rows) if row[3] >= cutoff), len(rows))
+            rows = rows[:settled]
+            if not rows:
+                break
+
+            self.load_state(state, {address for _, address, _, _ in rows} - state.keys(), cursor.position)
+            checkpoints = []
+            for posting_id, address, amount, created_at in rows:
+                entry = state[address]
+                entry['balance'] += amount
+                entry['count'] += 1
+                if entry['as_of'] is None or entry['as_of'] < created_at:
+                    entry['as_of'] = created_at
+                if entry['count'] >= interval:
+                    checkpoints.append(BalanceCheckpoint(
+                        address=address, posting_id=posting_id, balance=entry['balance'], as_of=entry['as_of']
+                    ))
+                    entry['count'] = 0
+
+            with transaction.atomic():
+                BalanceCheckpoint.objects.bulk_create(checkpoints)
+                cursor.position = rows[-1][0]
+                cursor.save()
+
+            processed += len(rows)
+            created += len(checkpoints)
+            if settled < chunk_size:
+                break
+
+        self.stdout.write(f'rebuild: {processed} postings processed, {created} checkpoints created '
+                          f'(cursor: {cursor.position})')
+
+    @staticmethod
+    def load_state(state, addresses, position):
+        """
+        各アドレスの position 時点の残高と、直近のチェックポイント以降の件数を読み込む
+        """
+        for address in addresses:
+            checkpoint = BalanceCheckpoint.objects.filter(address=address, posting_id__lte=position) \
+                .order_by('-posting_id').first()
+            tail = Posting.objects.filter(address=address, id__lte=position)
+            if checkpoint is not None:
+                tail = tail.filter(id__gt=checkpoint.posting_id)
+            tail = tail.aggregate(total=Sum('amount'), count=Count('id'), as_of=Max('created_at'))
+            state[address] = {
+                'balance': (checkpoint.balance if checkpoint else 0) + (tail['total'] or 0),
+                'count': tail['count'],
+                'as_of': tail['as_of'] or (checkpoint.as_of if checkpoint else None),
+            }
+
+    def verify(self, chunk_size):
+        """
+        各アドレスの直近のチェックポイントと、Posting から計算した残高と Account.balance を照合
+        :return bool: 不一致がなければ True
+        """
+        errors = 0
+
+        # チェックポイント: 直前のチェックポイント + 間の Posting の合計と一致するか
+        addresses = BalanceCheckpoint.objects.values_list('address', flat=True).distinct()
+        for address in addresses.iterator():
+            latest, previous = (list(
+                BalanceCheckpoint.objects.filter(address=address).order_by('-posting_id')[:2]
+            ) + [None])[:2]
+            postings = Posting.objects.filter(address=address, id__lte=latest.posting_id)
+            if previous is not None:
+                postings = postings.filter(id__gt=previous.posting_id)
+            expected = (previous.balance if previous else 0) + (postings.aggregate(total=Sum('amount'))['total'] or 0)
+            if expected != latest.balance:
+                errors += 1
+                self.stderr.write(f'checkpoint mismatch: {latest} balance={latest.balance} expected={expected}')
+
+        # Account.balance: Posting から計算した現在の残高と一致するか
+        last_id = 0
+        while True:
+            accounts = list(
+                Account.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'address', 'balance')[:chunk_size]
+            )
+            if not accounts:
+                break
+            for _, address, balance in accounts:
+                expected = ledger.balance_as_of(address)
+                if expected != balance:
+                    errors += 1
+                    self.stderr.write(f'balance mismatch: {address} balance={balance} ledger={expected}')
+            last_id = accounts[-1][0]
+
+        self.stdout.write(f'verify: {errors} mismatches')
+        return errors == 0
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts import keypool
+from accounts.benchmark import Timer
+
+
+class Command(BaseCommand):
+    help = 'Fill the pre-generated Ethereum key pool up to the given size.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=settings.KEYPOOL_SIZE, help='number of unassigned keys')
+        parser.add_argument('--batch-size', type=int, default=settings.KEYPOOL_REFILL_BATCH,
+                            help='keys committed per batch')
+
+    def handle(self, *args, **options):
+        available = keypool.available()
+        self.stdout.write(f'available={available} size={options["size"]}')
+        while available < options['size']:
+            n = min(options['size'] - available, options['batch_size'])
+            with Timer() as timer:
+                keypool.add_keys(n)
+            available += n
+            self.stdout.write(f'available={available} ({n / timer.elapsed:.2f} keys/sec)')
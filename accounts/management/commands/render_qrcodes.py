@@ -0,0 +1,48 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from accounts import qrcodes
+from accounts.benchmark import Timer
+from accounts.models import Account, Contract, EthAccount
+
+
+class Command(BaseCommand):
+    help = 'Render QR codes of all addresses into the disk cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--formats', nargs='+', default=[qrcodes.DEFAULT_FORMAT],
+                            choices=sorted(qrcodes.FORMATS), help='image formats')
+        parser.add_argument('--sizes', nargs='+', type=int, default=[qrcodes.DEFAULT_SIZE],
+                            help='pixels per module')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes')
+        parser.add_argument('--chunk-size', type=int, default=100, help='images per task sent to a worker')
+
+    def handle(self, *args, **options):
+        address_list = []
+        for model in (Account, EthAccount, Contract):
+            address_list += model.objects.filter(address__isnull=False).values_list('address', flat=True)
+
+        jobs = [
+            (address, fmt, size)
+            for address in address_list
+            for fmt in options['formats']
+            for size in options['sizes']
+            if not os.path.exists(qrcodes.cache_path(qrcodes.cache_key(address, fmt, size), fmt))
+        ]
+        self.stdout.write(f'addresses={len(address_list)} to render={len(jobs)}')
+        if not jobs:
+            return
+
+        with Timer() as timer:
+            if options['workers'] <= 1:
+                for job in jobs:
+                    qrcodes.write(*job)
+            else:
+                # 子プロセスに DB 接続を引き継がない
+                connections.close_all()
+                with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+                    list(executor.map(qrcodes.write, *zip(*jobs), chunksize=options['chunk_size']))
+        self.stdout.write(f'rendered={len(jobs)} ({len(jobs) / timer.elapsed:.2f} renders/sec)')
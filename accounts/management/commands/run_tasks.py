@@ -0,0 +1,33 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from accounts import tasks
+
+
+class Command(BaseCommand):
+    help = 'Run queued background tasks (signup provisioning etc.) with retries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10, help='tasks claimed per iteration')
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds to sleep when idle')
+        parser.add_argument('--stale-minutes', type=int, default=10,
+                            help='requeue tasks left running longer than this')
+        parser.add_argument('--once', action='store_true', help='process one batch and exit')
+
+    def handle(self, *args, **options):
+        requeued = tasks.requeue_stale(timedelta(minutes=options['stale_minutes']))
+        if requeued:
+            self.stderr.write(f'実行中のまま停止していたタスク {requeued} 件を再実行します。')
+
+        while True:
+            claimed = tasks.claim(options['batch_size'])
+            done = sum(1 for task in claimed if tasks.run(task))
+            if claimed:
+                self.stdout.write(f'done={done} failed={len(claimed) - done}')
+
+            if options['once']:
+                break
+            if not claimed:
+                time.sleep(options['interval'])
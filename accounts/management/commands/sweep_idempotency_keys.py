@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from accounts import idempotency
+
+
+class Command(BaseCommand):
+    help = 'Delete idempotency keys (stored transfer responses) past IDEMPOTENCY_KEY_TTL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='keys deleted per statement')
+
+    def handle(self, *args, **options):
+        deleted = idempotency.sweep(options['batch_size'])
+        self.stdout.write(f'deleted={deleted}')
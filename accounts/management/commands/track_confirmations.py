@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts import confirmations
+
+
+class Command(BaseCommand):
+    help = 'Fetch receipts of unconfirmed on-chain transactions with batched JSON-RPC requests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='receipts per batch request')
+        parser.add_argument('--depth', type=int, default=settings.ETH_CONFIRMATIONS,
+                            help='blocks required before a transaction is confirmed')
+        parser.add_argument('--interval', type=float, default=5.0, help='seconds between polls')
+        parser.add_argument('--once', action='store_true', help='poll once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                stats = confirmations.track(options['chunk_size'], options['depth'])
+            except Exception as e:
+                if options['once']:
+                    raise
+                print(e)
+                print('Error:', 'レシートの取得に失敗しました。')
+                stats = None
+            if stats:
+                self.stdout.write(' '.join(f'{key}={value}' for key, value in sorted(stats.items())))
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
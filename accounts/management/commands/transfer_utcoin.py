@@ -1,11 +1,10 @@
 from django.core.management.base import BaseCommand
-from django.conf import settings
 from django.contrib.auth.models import User
 import sys
-from web3 import Web3, HTTPProvider
-import json
 
-from accounts.models import EthAccount, Transaction
+from accounts import money, outbox
+from accounts.models import EthAccount
+from utpay import chain
 
 
 class Command(BaseCommand):
@@ -14,23 +13,23 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('from', type=str, help='From user name')
         parser.add_argument('to', type=str, help='To user name')
-        parser.add_argument('amount', type=float, help='Amount (min: 0.001 UTC)')
+        parser.add_argument('amount', type=str, help='Amount (min: 0.001 UTC)')
 
     def handle(self, *args, **options):
         # Load contract
-        web3 = Web3(HTTPProvider(settings.WEB3_PROVIDER))
-        abi = self.load_abi(settings.ARTIFACT_PATH)
-        UTCoin = web3.eth.contract(abi=abi, address=settings.UTCOIN_ADDRESS)
+        web3 = chain.get_web3()
+        UTCoin = chain.get_utcoin()
 
-        # Load decimals
-        decimals = UTCoin.call().decimals()
-        num_suffix = 10 ** decimals
+        # Check decimals (最小単位が money.DECIMALS と一致すること)
+        money.check_token_decimals()
 
         # Receive params
         from_username = options['from']
         to_username = options['to']
-        amount = options['amount']
-        amount_int = int(amount * num_suffix)
+        amount = money.parse(options['amount'])
+        if amount is None or amount <= 0:
+            print('金額が不正です。')
+            sys.exit(1)
 
         from_user = User.objects.filter(username=from_username).first()
         if not from_user:
@@ -51,8 +50,8 @@ class Command(BaseCommand):
         # Get balances
         from_balance = UTCoin.call().balanceOf(from_address)
         to_balance = UTCoin.call().balanceOf(to_address)
-        from_balance_fixed = from_balance / num_suffix
-        to_balance_fixed = to_balance / num_suffix
+        from_balance_fixed = money.render(from_balance)
+        to_balance_fixed = money.render(to_balance)
         from_eth_balance = web3.fromWei(web3.eth.getBalance(from_address), 'ether')
         to_eth_balance = web3.fromWei(web3.eth.getBalance(to_address), 'ether')
 
@@ -71,45 +70,12 @@ class Command(BaseCommand):
         print('-----------------------------------------------------\n')
 
         # Confirm
-        print(f'@{from_username} [{amount} UTC] ---> @{to_username}\n')
+        print(f'@{from_username} [{amount.render()} UTC] ---> @{to_username}\n')
         confirm = input('本当に送金しますか？(y/N): ')
         if confirm != 'y':
             print('キャンセルしました。')
             sys.exit(0)
-        print('Please wait...')
-
-        # Transfer UTCoin
-        if web3.personal.unlockAccount(from_address, from_account.password, duration=hex(300)):
-            try:
-                tx_hash = UTCoin.transact({'from': from_address}).transfer(to_address, amount_int)
-
-                # Create Transaction
-                transaction_info = web3.eth.getTransaction(tx_hash)
-                transaction = Transaction.objects.create(
-                    user=from_user,
-                    eth_account=from_account,
-                    tx_hash=tx_hash,
-                    from_address=from_address,
-                    to_address=to_address,
-                    amount=amount_int,
-                    gas=transaction_info['gas'],
-                    gas_price=transaction_info['gasPrice'],
-                    value=transaction_info['value'],
-                    network_id=1
-                )
-            except Exception as e:
-                print(e)
-                print('トランザクションに失敗しました。')
-                sys.exit(1)
-        else:
-            print('アカウントのアンロックに失敗しました。')
-            sys.exit(1)
-
-        print('送金が完了しました！')
 
-    @staticmethod
-    def load_abi(file_path):
-        artifact = open(file_path, 'r')
-        json_dict = json.load(artifact)
-        abi = json_dict['abi']
-        return abi
+        # Transfer UTCoin (nonce の採番と送信は process_eth_outbox が行う)
+        item = outbox.enqueue(from_address, to_address, int(amount))
+        print(f'送金を登録しました (EthOutbox #{item.pk})。process_eth_outbox が送信します。')
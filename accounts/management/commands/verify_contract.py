@@ -1,7 +1,10 @@
-from django.core.management.base import BaseCommand
+import os
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 import sys
 
+from accounts import verification
+from accounts.benchmark import Timer
 from accounts.models import Contract
 
 
@@ -9,10 +12,21 @@ class Command(BaseCommand):
     help = 'Verify the contract.'
 
     def add_arguments(self, parser):
-        parser.add_argument('contract_id', type=int, help='contract object ID')
+        parser.add_argument('contract_id', type=int, nargs='*', help='contract object ID')
+        parser.add_argument('--all', action='store_true', help='verify all contracts not yet checked')
+        parser.add_argument('--noinput', action='store_true',
+                            help='verify without prompting (contracts failing the checks are rejected)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes')
+        parser.add_argument('--batch-size', type=int, default=1000, help='contracts verified per batch')
+        parser.add_argument('--chunk-size', type=int, default=20, help='contracts per task sent to a worker')
 
     def handle(self, *args, **options):
-        contract_id = options['contract_id']
+        if options['all'] or options['noinput'] or len(options['contract_id']) > 1:
+            self.verify_bulk(options)
+            return
+        if not options['contract_id']:
+            raise CommandError('contract_id か --all を指定してください。')
+        contract_id = options['contract_id'][0]
 
         contract = Contract.objects.filter(pk=contract_id).first()
         if not contract:
@@ -23,8 +37,6 @@ class Command(BaseCommand):
         print('ID:', contract.id)
         print('User:', contract.user)
         print('address:', contract.address)
-        print('password:', contract.password)
-        print('qrcode:', contract.qrcode)
         print('name:', contract.name)
         print('is_active:', contract.is_active)
         print('is_verified:', contract.is_verified)
@@ -38,6 +50,14 @@ class Command(BaseCommand):
             print('既に認証されています。')
             sys.exit(1)
 
+        analysis = verification.analyze_cached(contract.code)
+        if not analysis.success:
+            for error in analysis.errors:
+                print('Error:', error)
+            print('検査を通過しないコードは認証できません。')
+            sys.exit(1)
+        print('計算量の見積もり:', analysis.cost)
+
         # 確認
         print('注意: 認証を行うとユーザが利用可能な状態になります。')
         confirm = input('認証を行いますか？(y/N): ')
@@ -58,3 +78,20 @@ class Command(BaseCommand):
             sys.exit(1)
 
         print('\n認証しました！')
+
+    def verify_bulk(self, options):
+        queryset = verification.pending().order_by('pk')
+        if options['contract_id']:
+            queryset = queryset.filter(pk__in=options['contract_id'])
+        last_pk = 0
+        while True:
+            contract_list = list(queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not contract_list:
+                break
+            last_pk = contract_list[-1].pk
+            with Timer() as timer:
+                counts = verification.verify(contract_list, options['workers'], options['chunk_size'])
+            self.stdout.write(
+                f'verified={counts["verified"]} rejected={counts["rejected"]} '
+                f'({len(contract_list) / timer.elapsed:.1f} contracts/sec)'
+            )
@@ -8,6 +8,7 @@ class Activate(models.Model):
     user = models.OneToOneField(User, on_delete=models.PROTECT)
     key = models.CharField('Key', max_length=191, unique=True)
     is_used = models.BooleanField('使用済', default=False)
+    email_sent_at = models.DateTimeField('確認メール送信日時', null=True, blank=True)
     created_at = models.DateTimeField('作成日時', default=timezone.now)
 
     def __str__(self):
@@ -18,7 +19,7 @@ class Activate(models.Model):
 class Account(models.Model):
     user = models.OneToOneField(User, on_delete=models.PROTECT)
     address = models.CharField('アドレス', max_length=42, unique=True, help_text='UT... (42文字)')
-    balance = models.DecimalField('残高', max_digits=12, decimal_places=3, help_text='UTC', default=0)
+    balance = models.BigIntegerField('残高', help_text='milli-UTC', default=0)
     qrcode = models.ImageField('QR code', upload_to='images/qrcode/account/', null=True, blank=True)
     created_at = models.DateTimeField('作成日時', default=timezone.now)
     modified_at = models.DateTimeField('変更日時', auto_now=True)
@@ -47,24 +48,91 @@ class EthAccount(models.Model):
 class Transaction(models.Model):
     from_address = models.CharField('From', max_length=42)
     to_address = models.CharField('To', max_length=42)
-    amount = models.DecimalField('金額', max_digits=12, decimal_places=3, help_text='UTC')
+    amount = models.BigIntegerField('金額', help_text='milli-UTC')
     is_active = models.BooleanField('有効', default=True)
     created_at = models.DateTimeField('作成日時', default=timezone.now)
 
     def __str__(self):
         return str(self.id)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['from_address', 'created_at', 'id'], name='transaction_from_idx'),
+            models.Index(fields=['to_address', 'created_at', 'id'], name='transaction_to_idx'),
+        ]
+
+
+# Double-entry posting (off-chain)
+class Posting(models.Model):
+    transaction = models.ForeignKey(Transaction, on_delete=models.PROTECT, null=True, blank=True)
+    eth_transaction = models.ForeignKey('EthTransaction', on_delete=models.PROTECT, null=True, blank=True)
+    address = models.CharField('アドレス', max_length=42)
+    amount = models.BigIntegerField('金額', help_text='milli-UTC (入金: +, 出金: -)')
+    created_at = models.DateTimeField('作成日時', default=timezone.now)
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['address', 'id']),
+        ]
+
+
+# Materialized balance of an address up to a posting
+class BalanceCheckpoint(models.Model):
+    address = models.CharField('アドレス', max_length=42)
+    posting_id = models.BigIntegerField('Posting ID', help_text='この ID までの Posting を集計済み')
+    balance = models.BigIntegerField('残高', help_text='milli-UTC')
+    as_of = models.DateTimeField('時点', help_text='集計済み Posting の最新の作成日時')
+    created_at = models.DateTimeField('作成日時', default=timezone.now)
+
+    def __str__(self):
+        return f'{self.address} #{self.posting_id}'
+
+    class Meta:
+        unique_together = ('address', 'posting_id')
+        indexes = [
+            models.Index(fields=['address', 'as_of']),
+        ]
+
+
+# Persisted position of an incremental job
+class Cursor(models.Model):
+    name = models.CharField('名前', max_length=191, unique=True)
+    position = models.BigIntegerField('位置', default=0)
+    modified_at = models.DateTimeField('変更日時', auto_now=True)
+
+    def __str__(self):
+        return self.name
+
 
 # On-Chain Transaction information (external)
 class EthTransaction(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_MINED = 'mined'
+    STATUS_CONFIRMED = 'confirmed'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, '未取り込み'),
+        (STATUS_MINED, '取り込み済み'),
+        (STATUS_CONFIRMED, '確定'),
+        (STATUS_FAILED, '失敗'),
+    )
+
     tx_hash = models.CharField('TxHash', max_length=66, unique=True)
     from_address = models.CharField('From', max_length=42)
     to_address = models.CharField('To', max_length=42)
-    amount = models.BigIntegerField('Amount', help_text='UTC (int)')
+    amount = models.BigIntegerField('Amount', help_text='milli-UTC')
     gas = models.BigIntegerField('Gas')
     gas_price = models.BigIntegerField('Gas Price')
     value = models.BigIntegerField('Value')
     network_id = models.IntegerField('Network ID')
+    status = models.CharField('状態', max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    block_number = models.BigIntegerField('Block Number', null=True, blank=True)
+    block_hash = models.CharField('Block Hash', max_length=66, null=True, blank=True)
+    gas_used = models.BigIntegerField('Gas Used', null=True, blank=True)
     is_active = models.BooleanField('有効', default=True)
     created_at = models.DateTimeField('作成日時', default=timezone.now)
 
@@ -73,6 +141,114 @@ class EthTransaction(models.Model):
 
     class Meta:
         verbose_name = 'ETH transaction'
+        indexes = [
+            models.Index(fields=['status', 'id']),
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['from_address', 'created_at', 'id'], name='eth_transaction_from_idx'),
+            models.Index(fields=['to_address', 'created_at', 'id'], name='eth_transaction_to_idx'),
+        ]
+
+
+# Queued on-chain transfer (outbox)
+class EthOutbox(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_MINED = 'mined'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, '送信待ち'),
+        (STATUS_SENDING, '送信中'),
+        (STATUS_SENT, '送信済み'),
+        (STATUS_MINED, '取り込み済み'),
+        (STATUS_FAILED, '失敗'),
+    )
+
+    account = models.ForeignKey(Account, on_delete=models.PROTECT, null=True, blank=True,
+                                help_text='残高を引き落としたUTアカウント (失敗時に返金)')
+    from_address = models.CharField('From', max_length=42)
+    to_address = models.CharField('To', max_length=42)
+    amount = models.BigIntegerField('Amount', help_text='milli-UTC')
+    status = models.CharField('状態', max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    nonce = models.BigIntegerField('Nonce', null=True, blank=True)
+    tx_hash = models.CharField('Tx hash', max_length=66, null=True, blank=True,
+                               help_text='ブロードキャストしたトランザクション (記録前)')
+    eth_transaction = models.OneToOneField('EthTransaction', on_delete=models.PROTECT, null=True, blank=True)
+    attempts = models.IntegerField('試行回数', default=0)
+    last_error = models.TextField('エラー', null=True, blank=True)
+    created_at = models.DateTimeField('作成日時', default=timezone.now)
+    modified_at = models.DateTimeField('変更日時', auto_now=True)
+
+    def __str__(self):
+        return str(self.id)
+
+    class Meta:
+        verbose_name = 'ETH outbox'
+        indexes = [
+            models.Index(fields=['status', 'id']),
+        ]
+
+
+# Next nonce of an Ethereum account managed by UTpay
+class EthNonce(models.Model):
+    address = models.CharField('アドレス', max_length=42, unique=True)
+    nonce = models.BigIntegerField('Nonce')
+    modified_at = models.DateTimeField('変更日時', auto_now=True)
+
+    def __str__(self):
+        return self.address
+
+    class Meta:
+        verbose_name = 'ETH nonce'
+
+
+# Pre-generated Ethereum key (imported to the node, not yet assigned)
+class EthKey(models.Model):
+    address = models.CharField('アドレス', max_length=42, unique=True)
+    password = models.CharField('パスワード', max_length=30)
+    assigned_at = models.DateTimeField('割り当て日時', null=True, blank=True)
+    created_at = models.DateTimeField('作成日時', default=timezone.now)
+
+    def __str__(self):
+        return self.address
+
+    class Meta:
+        verbose_name = 'ETH key'
+        indexes = [
+            models.Index(fields=['assigned_at', 'id']),
+        ]
+
+
+# Background task (signup provisioning etc.)
+class Task(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, '実行待ち'),
+        (STATUS_RUNNING, '実行中'),
+        (STATUS_DONE, '完了'),
+        (STATUS_FAILED, '失敗'),
+    )
+
+    name = models.CharField('タスク', max_length=191, help_text='実行する関数 (module.function)')
+    payload = models.TextField('引数', default='{}', help_text='JSON')
+    status = models.CharField('状態', max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.IntegerField('試行回数', default=0)
+    max_attempts = models.IntegerField('最大試行回数', default=5)
+    run_at = models.DateTimeField('実行予定日時', default=timezone.now)
+    last_error = models.TextField('エラー', null=True, blank=True)
+    created_at = models.DateTimeField('作成日時', default=timezone.now)
+    modified_at = models.DateTimeField('変更日時', auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at']),
+        ]
 
 
 # User defined function
@@ -88,8 +264,85 @@ class Contract(models.Model):
     is_verified = models.BooleanField('認証済み', default=False)
     is_banned = models.BooleanField('禁止', default=False)
     verified_at = models.DateTimeField('認証日時', null=True, blank=True)
+    verification_error = models.TextField('検査エラー', null=True, blank=True)
+    locked_until = models.DateTimeField('配信のリース期限', null=True, blank=True,
+                                        help_text='dispatch_events が配信中の間、この日時まで他のディスパッチャは配信しない')
     created_at = models.DateTimeField('作成日時', default=timezone.now)
     modified_at = models.DateTimeField('変更日時', auto_now=True)
 
     def __str__(self):
         return self.name
+
+
+# Durable stream of transfers (fanned out to contracts by the dispatcher)
+class TransferEvent(models.Model):
+    transaction = models.ForeignKey(Transaction, on_delete=models.PROTECT, null=True, blank=True)
+    tx_hash = models.CharField('TxHash', max_length=66, null=True, blank=True, help_text='オンチェーン送金の場合')
+    from_address = models.CharField('From', max_length=42)
+    to_address = models.CharField('To', max_length=42)
+    amount = models.BigIntegerField('Amount', help_text='milli-UTC')
+    created_at = models.DateTimeField('作成日時', default=timezone.now)
+
+    def __str__(self):
+        return str(self.id)
+
+
+# Delivery of a transfer event to a contract
+class ContractDelivery(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_DONE = 'done'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, '配信待ち'),
+        (STATUS_DONE, '配信済み'),
+    )
+
+    contract = models.ForeignKey(Contract, on_delete=models.PROTECT)
+    event = models.ForeignKey(TransferEvent, on_delete=models.PROTECT)
+    status = models.CharField('状態', max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.IntegerField('試行回数', default=0)
+    run_at = models.DateTimeField('実行予定日時', default=timezone.now)
+    last_error = models.TextField('エラー', null=True, blank=True)
+    created_at = models.DateTimeField('作成日時', default=timezone.now)
+    modified_at = models.DateTimeField('変更日時', auto_now=True)
+
+    def __str__(self):
+        return f'{self.contract_id} #{self.event_id}'
+
+    class Meta:
+        unique_together = ('contract', 'event')
+        indexes = [
+            models.Index(fields=['contract', 'status', 'id']),
+            models.Index(fields=['status', 'run_at']),
+        ]
+
+
+# Delivery given up after max attempts
+class ContractDeadLetter(models.Model):
+    contract = models.ForeignKey(Contract, on_delete=models.PROTECT)
+    event = models.ForeignKey(TransferEvent, on_delete=models.PROTECT)
+    attempts = models.IntegerField('試行回数')
+    last_error = models.TextField('エラー', null=True, blank=True)
+    created_at = models.DateTimeField('作成日時', default=timezone.now)
+
+    def __str__(self):
+        return f'{self.contract_id} #{self.event_id}'
+
+
+# Stored response of a POST request sent with an Idempotency-Key header
+class IdempotencyKey(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField('Key', max_length=128, help_text='Idempotency-Key ヘッダの値')
+    fingerprint = models.CharField('リクエストのハッシュ', max_length=64, help_text='sha256 (メソッド, パス, 本文)')
+    status_code = models.PositiveSmallIntegerField('ステータスコード', null=True, blank=True)
+    response = models.TextField('レスポンス', null=True, blank=True, help_text='JSON')
+    created_at = models.DateTimeField('作成日時', default=timezone.now)
+    expires_at = models.DateTimeField('有効期限')
+
+    def __str__(self):
+        return self.key
+
+    class Meta:
+        unique_together = ('user', 'key')
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
@@ -0,0 +1,115 @@
+"""
+UTCoin amounts
+
+金額はオフチェーン・オンチェーンとも UTCoin の最小単位 (milli-UTC) の整数で扱う。
+残高・送金額は BigIntegerField に最小単位で保存し、Decimal や float を経由しないため
+丸め誤差が生じない。'1.500' のような UTC の文字列との変換は parse / render で行い、
+シリアライザ向けに複数件をまとめて変換する parse_many / render_many を用意する。
+オンチェーンの UTCoin の量とそのまま比較・送金するため、コントラクトの decimals が
+DECIMALS と一致することを check_token_decimals で確認する (ノードへの問い合わせはプロセスごとに1回)。
+"""
+import re
+from decimal import Decimal
+
+from django.core.exceptions import ImproperlyConfigured
+
+from utpay import chain
+
+# 最小単位の桁数 (UTCoin コントラクトの decimals)
+DECIMALS = 3
+UNIT = 10 ** DECIMALS
+
+AMOUNT_PATTERN = re.compile(r'(-?)(\d{1,15})(?:\.(\d{0,%d}))?\Z' % DECIMALS, re.ASCII)
+
+
+class Amount(int):
+    """
+    最小単位 (milli-UTC) の金額
+
+    int のまま DB に保存・演算できる (str() も int と同じ)。UTC の文字列は render() で得る。
+    """
+    __slots__ = ()
+
+    @property
+    def fixed(self):
+        """
+        :return float: UTC (コールバック・コントラクトの amount_fixed 用)
+        """
+        return self / UNIT
+
+    def render(self):
+        """
+        :return str: UTC (例: '1.500')
+        """
+        return render(self)
+
+
+def parse(value):
+    """
+    UTC の金額を最小単位に変換
+    :param value: str, int, float or Decimal (UTC)、Amount はそのまま返す
+    :return Amount: 不正な値、小数点以下が DECIMALS 桁を超える値は None
+    """
+    if isinstance(value, Amount):
+        return value
+    if isinstance(value, str):
+        match = AMOUNT_PATTERN.match(value.strip())
+        if match is None:
+            return None
+        sign, whole, fraction = match.groups()
+        amount = int(whole) * UNIT + int((fraction or '').ljust(DECIMALS, '0'))
+        return Amount(-amount if sign else amount)
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return Amount(value * UNIT)
+    if isinstance(value, float):
+        return parse(repr(value))
+    if isinstance(value, Decimal):
+        if not value.is_finite():
+            return None
+        scaled = value.scaleb(DECIMALS)
+        if scaled != scaled.to_integral_value():
+            return None
+        return Amount(int(scaled))
+    return None
+
+
+def parse_many(values):
+    """
+    :param iterable values:
+    :return list: Amount or None
+    """
+    return [parse(value) for value in values]
+
+
+def render(amount):
+    """
+    :param int amount: 最小単位
+    :return str: UTC (例: '1.500', '-0.001')
+    """
+    whole, fraction = divmod(abs(amount), UNIT)
+    return f'{"-" if amount < 0 else ""}{whole}.{fraction:0{DECIMALS}d}'
+
+
+def render_many(amounts):
+    """
+    :param iterable amounts: 最小単位
+    :return list: UTC の文字列
+    """
+    unit = UNIT
+    width = DECIMALS
+    return [
+        f'{amount // unit}.{amount % unit:0{width}d}' if amount >= 0 else render(amount)
+        for amount in amounts
+    ]
+
+
+def check_token_decimals():
+    """
+    コントラクトの decimals が DECIMALS と一致することを確認 (オンチェーンの送金を扱う前に呼び出す)
+    :raise ImproperlyConfigured:
+    """
+    decimals = chain.get_decimals()
+    if decimals != DECIMALS:
+        raise ImproperlyConfigured(f'UTCoin の decimals ({decimals}) が {DECIMALS} ではありません。')
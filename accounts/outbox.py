@@ -0,0 +1,338 @@
+"""
+On-chain transfer pipeline
+
+Web リクエストでは EthOutbox に送金を登録するだけにし、process_eth_outbox コマンドの
+ワーカーが nonce を割り当てて送信し、track_confirmations コマンドが記録した
+トランザクションの状態を反映する。
+nonce は EthNonce でローカルに採番するため、同じアカウントから複数のトランザクションを
+同時に送信待ちにできる。
+ノードが送金を受け付けたか分からない場合 (タイムアウト・接続エラー、送信後の記録の失敗) は
+送信中のまま残し、reconcile が tx_hash または nonce でノードの状態を確認する。
+返金 (fail) するのはノードが明確に拒否した場合だけとする。
+"""
+import time
+
+from django.db import transaction
+from django.utils import timezone
+
+from callback_functions.transfer_callback import transfer_callback
+from utpay import chain
+from utpay.db import skip_locked
+from . import activity, balances, events, ledger, money
+from .models import EthAccount, EthTransaction, EthOutbox, EthNonce
+
+
+def enqueue(from_address, to_address, amount, account=None):
+    """
+    オンチェーン送金を登録
+    :param str from_address: 送金元の Ethereum アドレス
+    :param str to_address:
+    :param int amount: milli-UTC
+    :param Account account: 残高を引き落とすUTアカウント (引き落とし済みであること)
+    :return EthOutbox:
+    """
+    return EthOutbox.objects.create(account=account, from_address=from_address, to_address=to_address, amount=amount)
+
+
+def enqueue_withdrawal(from_account, admin_address, to_address, amount):
+    """
+    UTアカウントの残高を引き落とし、管理者の Ethereum アカウントからのオンチェーン送金を登録
+    :param Account from_account:
+    :param str admin_address: 送金元 (管理者) の Ethereum アドレス
+    :param str to_address:
+    :param int amount: milli-UTC
+    :return EthOutbox: 残高が足りない場合は None
+    """
+    with transaction.atomic():
+        if not ledger.debit(from_account, amount):
+            return None
+        activity.invalidate(from_account.user_id)
+        return enqueue(admin_address, to_address, amount, account=from_account)
+
+
+def allocate_nonce(address):
+    """
+    nonce を採番 (初回はノードの pending のトランザクション数から開始)
+    :param str address:
+    :return int:
+    """
+    with transaction.atomic():
+        row = EthNonce.objects.select_for_update().filter(address=address).first()
+        if row is None:
+            nonce = chain.get_web3().eth.getTransactionCount(address, 'pending')
+            EthNonce.objects.create(address=address, nonce=nonce + 1)
+            return nonce
+        nonce = row.nonce
+        row.nonce = nonce + 1
+        row.save(update_fields=['nonce', 'modified_at'])
+        return nonce
+
+
+def reset_nonce(*addresses):
+    """
+    送信に失敗して nonce が欠番になった場合に、次回ノードの値から採番し直す
+    :param str addresses:
+    """
+    EthNonce.objects.filter(address__in=addresses).delete()
+
+
+def claim(batch_size):
+    """
+    送信待ちの送金を取得し、nonce を割り当てて送信中にする
+    :param int batch_size:
+    :return list: EthOutbox objects
+    """
+    with transaction.atomic():
+        items = list(
+            skip_locked(EthOutbox.objects.filter(status=EthOutbox.STATUS_QUEUED).order_by('id'))[:batch_size]
+        )
+        for item in items:
+            item.nonce = allocate_nonce(item.from_address)
+            item.status = EthOutbox.STATUS_SENDING
+            item.attempts += 1
+            item.save(update_fields=['nonce', 'status', 'attempts', 'modified_at'])
+    return items
+
+
+def requeue(items):
+    """
+    nonce を割り当てた送信中の送金を送信待ちに戻す (送信していないものに限る)
+    :param list items: EthOutbox objects
+    """
+    EthOutbox.objects.filter(pk__in=[item.pk for item in items], status=EthOutbox.STATUS_SENDING).update(
+        status=EthOutbox.STATUS_QUEUED, nonce=None, tx_hash=None, modified_at=timezone.now()
+    )
+
+
+def mark_unknown(item, error):
+    """
+    ノードが受け付けたか分からない送金を送信中のまま残す (reconcile で確認する)
+    :param EthOutbox item:
+    :param str error:
+    """
+    print('Error:', f'送金 {item.pk} の送信結果を確認できません: {error}')
+    EthOutbox.objects.filter(pk=item.pk).update(last_error=error, modified_at=timezone.now())
+
+
+def is_rpc_error(e):
+    """
+    :param Exception e:
+    :return bool: JSON-RPC のエラー応答か (web3 はエラーオブジェクトを ValueError の引数にする)
+    """
+    return type(e) is ValueError and bool(e.args) and isinstance(e.args[0], dict)
+
+
+class Sender:
+    """
+    送信中の送金をノードに送信する (アカウントのアンロック状態をプロセス内で保持)
+    """
+    unlock_duration = 300
+
+    def __init__(self):
+        self.w3 = chain.get_web3()
+        self.UTCoin = chain.get_utcoin()
+        money.check_token_decimals()
+        self.network_id = None
+        self.unlocked = {}
+
+    def unlock(self, address):
+        """
+        :param str address:
+        :return bool:
+        """
+        if self.unlocked.get(address, 0) > time.monotonic():
+            return True
+        eth_account = EthAccount.objects.filter(address=address).first()
+        if eth_account is None:
+            return False
+        if not self.w3.personal.unlockAccount(address, eth_account.password, duration=hex(self.unlock_duration)):
+            return False
+        # 期限切れ直前に送信しないよう余裕を持たせる
+        self.unlocked[address] = time.monotonic() + self.unlock_duration - 30
+        return True
+
+    def send(self, item):
+        """
+        :param EthOutbox item: 送信中 (nonce 割り当て済み) の送金
+        :return str: 送信後の状態 (STATUS_SENT, ノードが拒否した場合は STATUS_FAILED、
+            受け付けたか分からない場合は STATUS_SENDING のまま)
+        """
+        try:
+            if not self.unlock(item.from_address):
+                fail(item, 'アカウントのアンロックに失敗しました。')
+                return EthOutbox.STATUS_FAILED
+            tx_hash = self.UTCoin.transact({'from': item.from_address, 'nonce': item.nonce}) \
+                .transfer(item.to_address, item.amount)
+        except Exception as e:
+            if is_rpc_error(e):
+                # JSON-RPC のエラー応答 (ノードが拒否した)
+                fail(item, str(e))
+                return EthOutbox.STATUS_FAILED
+            # タイムアウトや壊れた応答 (JSONDecodeError) はノードが受け付けた後に発生することがある
+            mark_unknown(item, str(e))
+            return EthOutbox.STATUS_SENDING
+
+        try:
+            item.tx_hash = tx_hash
+            EthOutbox.objects.filter(pk=item.pk).update(tx_hash=tx_hash)
+            self.record(item, tx_hash)
+        except Exception as e:
+            mark_unknown(item, str(e))
+            return EthOutbox.STATUS_SENDING
+        return EthOutbox.STATUS_SENT
+
+    def send_all(self, items):
+        """
+        claim した送金を nonce の順に送信する
+        ノードが拒否した場合は nonce が欠番になるため、残りの送金を送信待ちに戻してから採番し直す
+        :param list items: EthOutbox objects
+        :return dict: 状態ごとの件数
+        """
+        counts = {EthOutbox.STATUS_SENT: 0, EthOutbox.STATUS_FAILED: 0, EthOutbox.STATUS_SENDING: 0,
+                  EthOutbox.STATUS_QUEUED: 0}
+        for i, item in enumerate(items):
+            status = self.send(item)
+            counts[status] += 1
+            if status == EthOutbox.STATUS_FAILED:
+                rest = items[i + 1:]
+                requeue(rest)
+                counts[EthOutbox.STATUS_QUEUED] += len(rest)
+                reset_nonce(item.from_address, *(other.from_address for other in rest))
+                break
+        return counts
+
+    def record(self, item, tx_hash):
+        """
+        ブロードキャストした送金を EthTransaction に記録して送信済みにする
+        :param EthOutbox item:
+        :param str tx_hash:
+        """
+        tx_info = self.w3.eth.getTransaction(tx_hash)
+        if tx_info is None:
+            raise RuntimeError(f'トランザクション {tx_hash} がノードにありません。')
+        if self.network_id is None:
+            self.network_id = int(self.w3.version.network)
+        with transaction.atomic():
+            eth_tx = EthTransaction.objects.create(
+                tx_hash=tx_hash,
+                from_address=item.from_address,
+                to_address=item.to_address,
+                amount=item.amount,
+                gas=tx_info['gas'],
+                gas_price=tx_info['gasPrice'],
+                value=tx_info['value'],
+                network_id=tx_info.get('networkId', self.network_id)
+            )
+            if item.account_id is not None:
+                ledger.record_withdrawal(item.account, eth_tx, item.amount)
+            else:
+                events.append(item.from_address, item.to_address, item.amount, tx_hash=tx_hash)
+            item.eth_transaction = eth_tx
+            item.status = EthOutbox.STATUS_SENT
+            item.last_error = None
+            item.save(update_fields=['eth_transaction', 'status', 'last_error', 'modified_at'])
+        balances.invalidate(item.from_address, item.to_address)
+
+        if item.account_id is None:
+            # Execute callback function (ユーザの EthAccount からの送金)
+            try:
+                transfer_callback(tx_hash, item.from_address, item.to_address, item.amount,
+                                  money.Amount(item.amount).fixed)
+            except Exception as e:
+                print(e)
+                print('Error:', 'コールバック処理に失敗しました。')
+
+    def find_transaction(self, from_address, nonce, blocks):
+        """
+        直近のブロックから送金元と nonce が一致するトランザクションを探す
+        :param str from_address:
+        :param int nonce:
+        :param int blocks: 遡るブロック数
+        :return str: tx_hash (見つからない場合は None)
+        """
+        head = self.w3.eth.blockNumber
+        for number in range(head, max(head - blocks, -1), -1):
+            block = self.w3.eth.getBlock(number, True)
+            for tx in block['transactions']:
+                if tx['from'].lower() == from_address.lower() and tx['nonce'] == nonce:
+                    return chain.to_hex(tx['hash'])
+        return None
+
+    def reconcile(self, items, blocks=256):
+        """
+        送信中のまま残った送金をノードの状態と照合する
+        - tx_hash が分かっている: 記録をやり直す
+        - ノードの pending の nonce に達していない: 受け付けられていないため送信待ちに戻す
+        - 取り込み済みの nonce: 直近のブロックからトランザクションを探して記録する
+        - それ以外 (トランザクションプールにある) は次回に確認する
+        :param list items: 送信中の EthOutbox objects (nonce の順)
+        :param int blocks: 遡るブロック数
+        :return dict: 状態ごとの件数
+        """
+        counts = {EthOutbox.STATUS_SENT: 0, EthOutbox.STATUS_QUEUED: 0, EthOutbox.STATUS_SENDING: 0}
+        requeued = []
+        for item in items:
+            try:
+                tx_hash = item.tx_hash
+                if tx_hash is None:
+                    if self.w3.eth.getTransactionCount(item.from_address, 'pending') <= item.nonce:
+                        requeued.append(item)
+                        continue
+                    if self.w3.eth.getTransactionCount(item.from_address, 'latest') > item.nonce:
+                        tx_hash = self.find_transaction(item.from_address, item.nonce, blocks)
+                        if tx_hash is not None and EthTransaction.objects.filter(tx_hash=tx_hash).exists():
+                            # 同じ nonce で別の送金が送信された (この送金は受け付けられていない)
+                            requeued.append(item)
+                            continue
+                if tx_hash is None:
+                    counts[EthOutbox.STATUS_SENDING] += 1
+                    continue
+                self.record(item, tx_hash)
+                counts[EthOutbox.STATUS_SENT] += 1
+            except Exception as e:
+                mark_unknown(item, str(e))
+                counts[EthOutbox.STATUS_SENDING] += 1
+        if requeued:
+            requeue(requeued)
+            reset_nonce(*{item.from_address for item in requeued})
+            counts[EthOutbox.STATUS_QUEUED] += len(requeued)
+        return counts
+
+
+def fail(item, error):
+    """
+    送金を失敗にし、引き落とし済みの残高を返金
+    :param EthOutbox item:
+    :param str error:
+    """
+    with transaction.atomic():
+        item.status = EthOutbox.STATUS_FAILED
+        item.last_error = error
+        item.save(update_fields=['status', 'last_error', 'modified_at'])
+        if item.account_id is not None:
+            ledger.credit(item.account_id, item.amount)
+            activity.invalidate(item.account.user_id)
+            if item.eth_transaction_id is not None:
+                # 記録済みの出金を打ち消す
+                ledger.record_withdrawal(item.account, item.eth_transaction, -item.amount)
+
+
+def check_receipts(batch_size):
+    """
+    送信済みの送金に confirmations.track が記録したトランザクションの状態を反映
+    :param int batch_size:
+    :return int: 確定 (または失敗) した送金の件数
+    """
+    items = EthOutbox.objects.filter(
+        status=EthOutbox.STATUS_SENT,
+        eth_transaction__status__in=[EthTransaction.STATUS_CONFIRMED, EthTransaction.STATUS_FAILED]
+    ).select_related('eth_transaction').order_by('id')[:batch_size]
+    done = 0
+    for item in items:
+        done += 1
+        if item.eth_transaction.status == EthTransaction.STATUS_FAILED:
+            # revert された
+            fail(item, 'トランザクションが revert されました。')
+        else:
+            EthOutbox.objects.filter(pk=item.pk).update(status=EthOutbox.STATUS_MINED, modified_at=timezone.now())
+    return done
@@ -0,0 +1,93 @@
+"""
+Signup provisioning
+
+サインアップのリクエストでは User に紐づく Activate と Account、鍵プールから割り当てた
+EthAccount だけを作成し、確認メールの送信 (とプールが空の場合の Ethereum アカウントの作成) は
+タスクとしてワーカーで実行する。QRコードは qrcodes が表示時に生成する。
+各タスクは再実行されても重複して作成・送信しない。
+"""
+import secrets
+import uuid
+
+from django.urls import reverse
+from django.utils import timezone
+
+from . import keypool, tasks
+from .models import Activate, Account, EthAccount
+
+
+def create_activate_key():
+    """
+    ランダムな文字列を生成
+    :return str: UUID
+    """
+    return uuid.uuid4().hex
+
+
+def make_ut_address():
+    """
+    ランダムな42文字のUTアドレスを生成 (bitcoin base58)
+    :return str: address
+    """
+    base58_alphabet = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+    address = 'UT' + ''.join(secrets.choice(base58_alphabet) for _ in range(40))
+    return address
+
+
+def provision(user, base_url):
+    """
+    仮登録した User の Activate と Account を作成し、残りの処理をタスクに登録
+    (呼び出し元のトランザクション内で実行する)
+    :param User user:
+    :param str base_url: 確認メールに記載する URL (scheme://host)
+    :return Account:
+    """
+    # Create Activate
+    activate_key = create_activate_key()
+    Activate.objects.create(user=user, key=activate_key)
+
+    # Create Account
+    ut_address = make_ut_address()
+    while Account.objects.filter(address=ut_address).exists():
+        ut_address = make_ut_address()
+    account = Account.objects.create(user=user, address=ut_address)
+
+    activation_url = base_url + reverse('accounts:activation', args=[activate_key])
+    tasks.enqueue(send_activation_email, activate_key=activate_key, activation_url=activation_url)
+
+    # Create EthAccount
+    key = keypool.claim()
+    if key is None:
+        tasks.enqueue(create_eth_account, user_id=user.id)
+    else:
+        EthAccount.objects.create(user=user, address=key.address, password=key.password)
+    return account
+
+
+def send_activation_email(activate_key, activation_url):
+    """
+    確認メールを送信 (送信済み・有効化済みの場合は送信しない)
+    :param str activate_key:
+    :param str activation_url:
+    """
+    activate = Activate.objects.select_for_update().select_related('user').get(key=activate_key)
+    user = activate.user
+    if activate.email_sent_at is not None or user.is_active:
+        return
+    user.email_user(
+        '[UTpay] Please verify your email',
+        f'@{user.username} さん\n\nこの度は、UTpay にご登録いただきありがとうございます。\n以下のURLにアクセスして、登録を確認してください。\n\n{activation_url}\n\n--\nUTpay <https://utpay.net>\ninfo@utpay.net'
+    )
+    activate.email_sent_at = timezone.now()
+    activate.save(update_fields=['email_sent_at'])
+
+
+def create_eth_account(user_id):
+    """
+    EthAccount を作成 (作成済みの場合は何もしない)
+    :param int user_id:
+    """
+    if EthAccount.objects.filter(user_id=user_id).exists():
+        return
+    eth_address, password = keypool.new_account()
+    EthAccount.objects.create(user_id=user_id, address=eth_address, password=password)
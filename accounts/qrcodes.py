@@ -0,0 +1,120 @@
+"""
+QR code rendering service
+
+QRコードはリクエストされたときに生成し、プロセス内の LRU と、内容 (データ・形式・サイズ) の
+ハッシュをファイル名にしたディスクキャッシュに保持する。同じ内容からは常に同じ画像が
+生成されるため、ハッシュをそのまま ETag に使える。
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from io import BytesIO
+
+import pylru
+import qrcode
+from django.conf import settings
+from qrcode.image.svg import SvgPathImage
+
+FORMATS = {
+    'png': ('image/png', None),
+    'svg': ('image/svg+xml', SvgPathImage),
+}
+DEFAULT_FORMAT = 'png'
+DEFAULT_SIZE = 10
+MIN_SIZE = 1
+MAX_SIZE = 40
+
+
+def cache_key(data, fmt=DEFAULT_FORMAT, size=DEFAULT_SIZE):
+    """
+    :param str data:
+    :param str fmt: 'png' or 'svg'
+    :param int size: 1セルのピクセル数
+    :return str: sha256
+    """
+    return hashlib.sha256(f'{fmt}:{size}:{data}'.encode()).hexdigest()
+
+
+def cache_path(key, fmt):
+    """
+    :return str: ディスクキャッシュのファイルパス
+    """
+    return os.path.join(settings.QRCODE_CACHE_DIR, key[:2], f'{key}.{fmt}')
+
+
+def render(data, fmt=DEFAULT_FORMAT, size=DEFAULT_SIZE):
+    """
+    QRコードを生成
+    :param str data:
+    :param str fmt:
+    :param int size:
+    :return bytes:
+    """
+    image_factory = FORMATS[fmt][1]
+    img = qrcode.make(data, box_size=size, image_factory=image_factory)
+    stream = BytesIO()
+    img.save(stream)
+    return stream.getvalue()
+
+
+def write(data, fmt=DEFAULT_FORMAT, size=DEFAULT_SIZE):
+    """
+    QRコードを生成してディスクキャッシュに保存 (保存済みの場合は読み込む)
+    :return bytes:
+    """
+    path = cache_path(cache_key(data, fmt, size), fmt)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    content = render(data, fmt, size)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 書き込み途中のファイルを読まれないよう、一時ファイルから置き換える
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return content
+
+
+class QRCodeCache:
+    """
+    生成済みのQRコードのプロセス内 LRU キャッシュ
+    """
+
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._entries = pylru.lrucache(size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, data, fmt=DEFAULT_FORMAT, size=DEFAULT_SIZE):
+        """
+        :return bytes:
+        """
+        key = cache_key(data, fmt, size)
+        with self._lock:
+            content = self._entries.get(key)
+            if content is not None:
+                self.hits += 1
+                return content
+            self.misses += 1
+
+        content = write(data, fmt, size)
+        with self._lock:
+            self._entries[key] = content
+        return content
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+qrcode_cache = QRCodeCache(settings.QRCODE_LRU_SIZE)
@@ -0,0 +1,114 @@
+"""
+DB-backed background task queue
+
+enqueue した関数は呼び出し元のトランザクションと一緒にコミットされ、run_tasks コマンドの
+ワーカーが実行する。失敗したタスクは指数バックオフで max_attempts 回まで再実行するため、
+タスクの関数は何度実行されても同じ結果になるようにする。
+タスクはトランザクションの中で実行する (non_atomic を付けた関数を除く)。
+"""
+import json
+import traceback
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from utpay.db import skip_locked
+from .models import Task
+
+
+def task_name(func):
+    """
+    :param func: モジュールの最上位で定義された関数
+    :return str: module.function
+    """
+    return f'{func.__module__}.{func.__qualname__}'
+
+
+def enqueue(func, max_attempts=5, **kwargs):
+    """
+    タスクを登録
+    :param func: 実行する関数
+    :param int max_attempts:
+    :param kwargs: 関数の引数 (JSON に変換できる値)
+    :return Task:
+    """
+    return Task.objects.create(name=task_name(func), payload=json.dumps(kwargs), max_attempts=max_attempts)
+
+
+def non_atomic(func):
+    """
+    トランザクションの外で実行するタスクにするデコレータ (ノードへの問い合わせなど時間のかかる処理を含むもの)
+    :param func:
+    :return: func
+    """
+    func.atomic = False
+    return func
+
+
+def retry_delay(attempts):
+    """
+    :param int attempts: 試行回数
+    :return timedelta: 次の実行までの待ち時間 (最大10分)
+    """
+    return timedelta(seconds=min(2 ** attempts, 600))
+
+
+def claim(batch_size):
+    """
+    実行予定日時を過ぎたタスクを取得し、実行中にする
+    :param int batch_size:
+    :return list: Task objects
+    """
+    with transaction.atomic():
+        tasks = list(
+            skip_locked(Task.objects.filter(status=Task.STATUS_QUEUED, run_at__lte=timezone.now()).order_by('id'))
+            [:batch_size]
+        )
+        for task in tasks:
+            task.status = Task.STATUS_RUNNING
+            task.attempts += 1
+            task.save(update_fields=['status', 'attempts', 'modified_at'])
+    return tasks
+
+
+def run(task):
+    """
+    タスクを実行し、失敗した場合は再実行を予約
+    :param Task task: 実行中のタスク
+    :return bool: 成功したかどうか
+    """
+    try:
+        func = import_string(task.name)
+        if getattr(func, 'atomic', True):
+            with transaction.atomic():
+                func(**json.loads(task.payload))
+        else:
+            func(**json.loads(task.payload))
+    except Exception as e:
+        print(e)
+        print('Error:', f'タスク {task.name} (id={task.id}) の実行に失敗しました。')
+        task.last_error = traceback.format_exc()
+        if task.attempts < task.max_attempts:
+            task.status = Task.STATUS_QUEUED
+            task.run_at = timezone.now() + retry_delay(task.attempts)
+        else:
+            task.status = Task.STATUS_FAILED
+        task.save(update_fields=['status', 'run_at', 'last_error', 'modified_at'])
+        return False
+
+    task.status = Task.STATUS_DONE
+    task.save(update_fields=['status', 'modified_at'])
+    return True
+
+
+def requeue_stale(timeout):
+    """
+    ワーカーの停止などで実行中のまま残ったタスクを実行待ちに戻す
+    :param timedelta timeout:
+    :return int: 戻した件数
+    """
+    return Task.objects.filter(
+        status=Task.STATUS_RUNNING, modified_at__lt=timezone.now() - timeout
+    ).update(status=Task.STATUS_QUEUED, run_at=timezone.now(), modified_at=timezone.now())
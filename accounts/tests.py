@@ -1,13 +1,43 @@
+import json
+import os
 import secrets
+import shutil
 import string
+import tempfile
 import uuid
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
+import requests
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, models
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from eth_utils import function_signature_to_4byte_selector
+from eth_tester import EthereumTester
+from rest_framework.test import APIClient
 from web3 import Web3, HTTPProvider
+from web3.providers.base import BaseProvider
+from web3.providers.eth_tester import EthereumTesterProvider
 
-from .models import Activate, Account, EthAccount
+from utpay import chain, sandbox
+from . import (
+    activity, addresses, balances, confirmations, contracts, events, indexer, keypool, ledger, money, outbox,
+    provisioning, qrcodes, tasks, verification,
+)
+from .models import (
+    Activate, Account, EthAccount, EthTransaction, Transaction, Posting, BalanceCheckpoint, EthOutbox, Cursor, Task,
+    EthKey, EthNonce, Contract, TransferEvent, ContractDelivery, ContractDeadLetter,
+)
 
 
 class UserModelTests(TestCase):
@@ -89,3 +119,1104 @@ class UserModelTests(TestCase):
         self.assertEqual(user.username, 'test')
         self.assertEqual(user.email, 'test@example.com')
         self.assertEqual(user.check_password('hogehoge'), True)
+
+
+class TransferTests(TestCase):
+    def setUp(self):
+        alice = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        bob = User.objects.create_user(username='bob', email='bob@example.com', password='hogehoge')
+        self.from_account = Account.objects.create(user=alice, address='UT' + 'a' * 40, balance=10000)
+        self.to_account = Account.objects.create(user=bob, address='UT' + 'b' * 40, balance=0)
+
+    def test_transfer(self):
+        result = ledger.transfer(self.from_account, self.to_account.address, '1.5')
+        self.assertTrue(result.success)
+        self.assertEqual(result.transaction.amount, 1500)
+        self.from_account.refresh_from_db()
+        self.to_account.refresh_from_db()
+        self.assertEqual(self.from_account.balance, 8500)
+        self.assertEqual(self.to_account.balance, 1500)
+
+    def test_insufficient_balance(self):
+        result = ledger.transfer(self.from_account, self.to_account.address, '10.001')
+        self.assertFalse(result.success)
+        self.from_account.refresh_from_db()
+        self.assertEqual(self.from_account.balance, 10000)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_invalid_amount(self):
+        for amount in ('-1', 'abc', 'NaN', '1.0005'):
+            result = ledger.transfer(self.from_account, self.to_account.address, amount)
+            self.assertFalse(result.success)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_unknown_address(self):
+        result = ledger.transfer(self.from_account, 'UT' + 'c' * 40, '1')
+        self.assertFalse(result.success)
+        self.from_account.refresh_from_db()
+        self.assertEqual(self.from_account.balance, 10000)
+
+    def test_transfer_batch(self):
+        carol = User.objects.create_user(username='carol', email='carol@example.com', password='hogehoge')
+        carol_account = Account.objects.create(user=carol, address='UT' + 'c' * 40, balance=0)
+        results = ledger.transfer_batch(self.from_account, [
+            {'address': self.to_account.address, 'amount': '1'},
+            {'address': carol_account.address, 'amount': '2'},
+            {'address': self.to_account.address, 'amount': '3'},
+            {'address': 'UT' + 'd' * 40, 'amount': '1'},
+            {'address': carol_account.address, 'amount': '-1'},
+        ])
+        self.assertEqual([result.success for result in results], [True, True, True, False, False])
+        self.from_account.refresh_from_db()
+        self.to_account.refresh_from_db()
+        carol_account.refresh_from_db()
+        self.assertEqual(self.from_account.balance, 4000)
+        self.assertEqual(self.to_account.balance, 4000)
+        self.assertEqual(carol_account.balance, 2000)
+        self.assertEqual(Transaction.objects.count(), 3)
+
+    def test_transfer_batch_insufficient_balance(self):
+        results = ledger.transfer_batch(self.from_account, [
+            {'address': self.to_account.address, 'amount': '6'},
+            {'address': self.to_account.address, 'amount': '6'},
+        ])
+        self.assertFalse(any(result.success for result in results))
+        self.from_account.refresh_from_db()
+        self.assertEqual(self.from_account.balance, 10000)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+
+class MoneyTests(TestCase):
+    def test_parse(self):
+        self.assertEqual(money.parse_many(['1.5', ' 10 ', '0.001', '-2.25', 3, 1.25, Decimal('0.010')]),
+                         [1500, 10000, 1, -2250, 3000, 1250, 10])
+        self.assertEqual(money.parse_many(['1.0005', '1e3', '１', '', 'NaN', Decimal('Infinity'), True, None]),
+                         [None] * 8)
+        amount = money.parse('1.5')
+        self.assertIsInstance(amount, money.Amount)
+        self.assertIs(money.parse(amount), amount)
+        self.assertEqual(str(amount), '1500')
+
+    def test_render(self):
+        self.assertEqual(money.render_many([1500, 0, 1, 123456789, -2250]),
+                         ['1.500', '0.000', '0.001', '123456.789', '-2.250'])
+        self.assertEqual(money.Amount(2500).render(), '2.500')
+        self.assertEqual(money.Amount(2500).fixed, 2.5)
+
+    def test_check_token_decimals(self):
+        chain.configure(FakeNodeProvider())
+        try:
+            money.check_token_decimals()
+            chain.configure(FakeNodeProvider(decimals=18))
+            with self.assertRaises(ImproperlyConfigured):
+                money.check_token_decimals()
+        finally:
+            chain.configure(None)
+
+
+class AmountConversionTests(TransactionTestCase):
+    """
+    UTC の DecimalField で作成したデータベースの変換 (convert_amounts_to_milli)
+    """
+    fields = ((Account, 'balance'), (Transaction, 'amount'), (Posting, 'amount'), (BalanceCheckpoint, 'balance'))
+
+    def setUp(self):
+        # 変更前の DECIMAL(12, 3) の列に戻す
+        for model, name in self.fields:
+            old_field = models.DecimalField(max_digits=12, decimal_places=3)
+            old_field.set_attributes_from_name(name)
+            old_field.model = model
+            with connection.schema_editor() as editor:
+                editor.alter_field(model, model._meta.get_field(name), old_field)
+
+    def tearDown(self):
+        call_command('convert_amounts_to_milli', stdout=StringIO())
+
+    def insert(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def test_convert(self):
+        user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        now = timezone.now()
+        self.insert('INSERT INTO accounts_account (user_id, address, balance, created_at, modified_at) '
+                    'VALUES (%s, %s, %s, %s, %s)', [user.pk, 'UT' + 'a' * 40, Decimal('999999999.999'), now, now])
+        self.insert('INSERT INTO accounts_transaction (from_address, to_address, amount, is_active, created_at) '
+                    'VALUES (%s, %s, %s, %s, %s)', ['UT' + 'a' * 40, 'UT' + 'b' * 40, Decimal('12.345'), True, now])
+        self.insert('INSERT INTO accounts_posting (address, amount, created_at) VALUES (%s, %s, %s)',
+                    ['UT' + 'a' * 40, Decimal('-0.001'), now])
+        self.insert('INSERT INTO accounts_balancecheckpoint (address, posting_id, balance, as_of, created_at) '
+                    'VALUES (%s, %s, %s, %s, %s)', ['UT' + 'a' * 40, 1, Decimal('0.1'), now, now])
+
+        out = StringIO()
+        call_command('convert_amounts_to_milli', stdout=out)
+        self.assertEqual(out.getvalue().count('converted to milli-UTC'), 4)
+
+        expected = (999999999999, 12345, -1, 100)
+        for (model, name), value in zip(self.fields, expected):
+            self.assertEqual(list(model.objects.values_list(name, flat=True)), [value])
+
+        # 変換済みの列は変換しない
+        out = StringIO()
+        call_command('convert_amounts_to_milli', stdout=out)
+        self.assertEqual(out.getvalue().count('skipped'), 4)
+        self.assertEqual(Account.objects.get().balance, 999999999999)
+
+@override_settings(LEDGER_SETTLE_SECONDS=0)
+class BalanceCheckpointTests(TestCase):
+    def setUp(self):
+        alice = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        bob = User.objects.create_user(username='bob', email='bob@example.com', password='hogehoge')
+        self.alice = Account.objects.create(user=alice, address='UT' + 'a' * 40, balance=0)
+        self.bob = Account.objects.create(user=bob, address='UT' + 'b' * 40, balance=0)
+
+        # 初期残高
+        tx = Transaction.objects.create(from_address='UT' + '0' * 40, to_address=self.alice.address, amount=100000)
+        Posting.objects.bulk_create(ledger.make_postings(tx))
+        Account.objects.filter(pk=self.alice.pk).update(balance=100000)
+
+    def test_postings_are_balanced(self):
+        for _ in range(5):
+            ledger.transfer(self.alice, self.bob.address, '1')
+        self.assertEqual(Posting.objects.aggregate(total=Sum('amount'))['total'], 0)
+        self.assertEqual(ledger.balance_as_of(self.alice.address), 95000)
+        self.assertEqual(ledger.balance_as_of(self.bob.address), 5000)
+
+    def test_balance_as_of(self):
+        ledger.transfer(self.alice, self.bob.address, '10')
+        middle = timezone.now()
+        ledger.transfer(self.alice, self.bob.address, '20')
+        call_command('rebuild_checkpoints', interval=1, stdout=StringIO())
+        self.assertEqual(ledger.balance_as_of(self.bob.address, middle), 10000)
+        self.assertEqual(ledger.balance_as_of(self.bob.address), 30000)
+
+    def test_rebuild_checkpoints_incrementally(self):
+        for _ in range(4):
+            ledger.transfer(self.alice, self.bob.address, '1')
+        call_command('rebuild_checkpoints', interval=2, stdout=StringIO())
+        self.assertEqual(BalanceCheckpoint.objects.filter(address=self.bob.address).count(), 2)
+
+        for _ in range(3):
+            ledger.transfer(self.alice, self.bob.address, '1')
+        call_command('rebuild_checkpoints', interval=2, verify=True, stdout=StringIO(), stderr=StringIO())
+        checkpoint = BalanceCheckpoint.objects.filter(address=self.bob.address).order_by('-posting_id').first()
+        self.assertEqual(checkpoint.balance, 6000)
+        self.assertEqual(ledger.balance_as_of(self.bob.address), 7000)
+
+
+class AddressTests(TestCase):
+    def setUp(self):
+        addresses.ut_address_cache.clear()
+
+    def test_address_type(self):
+        self.assertEqual(addresses.address_types([
+            'UT' + '1' * 40,
+            'UT' + '0' * 40,  # base58 に 0 は含まれない
+            'UT' + '1' * 39,
+            '0x345ca3e014aaf5dca488057592ee47305d9b3e10',
+            '0x345cA3e014Aaf5dcA488057592ee47305D9B3e10',
+            '0x345cA3e014Aaf5dcA488057592ee47305D9B3e1O',
+            '0x345CA3e014Aaf5dcA488057592ee47305D9B3e10',  # チェックサム不一致
+            '345ca3e014aaf5dca488057592ee47305d9b3e10',
+        ]), ['ut', None, None, 'eth', 'eth', None, None, None])
+
+    def test_malformed_address_skips_database(self):
+        with self.assertNumQueries(0):
+            self.assertFalse(addresses.is_ut_address('UT' + '0' * 40))
+            self.assertFalse(addresses.is_ut_address('0x345ca3e014aaf5dca488057592ee47305d9b3e10'))
+
+    def test_existence_cache(self):
+        address = 'UT' + 'a' * 40
+        with self.assertNumQueries(1):
+            self.assertFalse(addresses.is_ut_address(address))
+            self.assertFalse(addresses.is_ut_address(address))
+
+        # Account の作成でキャッシュを更新
+        user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        Account.objects.create(user=user, address=address)
+        with self.assertNumQueries(0):
+            self.assertTrue(addresses.is_ut_address(address))
+
+
+class EthOutboxTests(TestCase):
+    def setUp(self):
+        self.tester = EthereumTester()
+        chain.configure(EthereumTesterProvider(self.tester))
+        self.admin_address = self.tester.get_accounts()[0]
+        alice = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        self.account = Account.objects.create(user=alice, address='UT' + 'a' * 40, balance=10000)
+
+    def tearDown(self):
+        chain.configure(None)
+
+    def test_enqueue_withdrawal(self):
+        item = outbox.enqueue_withdrawal(self.account, self.admin_address, '0x' + '1' * 40, 2500)
+        self.assertEqual(item.status, EthOutbox.STATUS_QUEUED)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, 7500)
+
+        self.assertIsNone(outbox.enqueue_withdrawal(self.account, self.admin_address, '0x' + '1' * 40, 7501))
+        self.assertEqual(EthOutbox.objects.count(), 1)
+
+    def test_claim_allocates_nonces_locally(self):
+        for _ in range(3):
+            outbox.enqueue(self.admin_address, '0x' + '1' * 40, 1000)
+        items = outbox.claim(batch_size=10)
+        self.assertEqual([item.nonce for item in items], [0, 1, 2])
+        self.assertTrue(all(item.status == EthOutbox.STATUS_SENDING for item in items))
+        self.assertEqual(outbox.claim(batch_size=10), [])
+
+    def test_transfer_utcoin_command(self):
+        # コマンドからの送金も EthOutbox を経由する
+        chain.configure(FakeNodeProvider())
+        for username, address in (('bob', self.admin_address), ('carol', '0x' + '1' * 40)):
+            user = User.objects.create_user(username=username, email=f'{username}@example.com', password='hogehoge')
+            EthAccount.objects.create(user=user, address=address, password='password')
+        with mock.patch('builtins.input', return_value='y'), mock.patch('sys.stdout', new_callable=StringIO):
+            call_command('transfer_utcoin', 'bob', 'carol', '1.5')
+        item = EthOutbox.objects.get()
+        self.assertEqual((item.from_address, item.to_address, item.amount, item.status),
+                         (self.admin_address, '0x' + '1' * 40, 1500, EthOutbox.STATUS_QUEUED))
+
+    def test_fail_refunds_balance(self):
+        item = outbox.enqueue_withdrawal(self.account, self.admin_address, '0x' + '1' * 40, 2500)
+        outbox.fail(item, 'error')
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, 10000)
+        self.assertEqual(EthOutbox.objects.get().status, EthOutbox.STATUS_FAILED)
+
+
+class ConfirmationTests(TestCase):
+    def setUp(self):
+        self.tester = EthereumTester()
+        chain.configure(EthereumTesterProvider(self.tester))
+        self.w3 = chain.get_web3()
+        self.sender, self.receiver = self.tester.get_accounts()[:2]
+
+    def tearDown(self):
+        chain.configure(None)
+
+    def send(self):
+        tx_hash = self.w3.eth.sendTransaction({'from': self.sender, 'to': self.receiver, 'value': 1, 'gas': 21000})
+        return EthTransaction.objects.create(
+            tx_hash=tx_hash, from_address=self.sender, to_address=self.receiver, amount=0,
+            gas=21000, gas_price=1, value=1, network_id=1
+        )
+
+    def test_track_until_confirmed(self):
+        eth_tx = self.send()
+        stats = confirmations.track(depth=3)
+        self.assertEqual(stats[EthTransaction.STATUS_MINED], 1)
+        eth_tx.refresh_from_db()
+        self.assertEqual(eth_tx.status, EthTransaction.STATUS_MINED)
+        self.assertEqual(eth_tx.block_number, self.w3.eth.blockNumber)
+        self.assertEqual(eth_tx.gas_used, 21000)
+
+        self.tester.mine_blocks(2)
+        confirmations.track(depth=3)
+        eth_tx.refresh_from_db()
+        self.assertEqual(eth_tx.status, EthTransaction.STATUS_CONFIRMED)
+        self.assertTrue(eth_tx.is_active)
+
+        # 確定済みのトランザクションは確認しない
+        self.assertEqual(confirmations.track(depth=3), {})
+
+    def test_unknown_hash_stays_pending(self):
+        eth_tx = EthTransaction.objects.create(
+            tx_hash='0x' + 'ab' * 32, from_address=self.sender, to_address=self.receiver, amount=0,
+            gas=21000, gas_price=1, value=1, network_id=1
+        )
+        confirmations.track(depth=3)
+        eth_tx.refresh_from_db()
+        self.assertEqual(eth_tx.status, EthTransaction.STATUS_PENDING)
+        self.assertIsNone(eth_tx.block_number)
+
+    def test_reorg_is_detected(self):
+        eth_tx = self.send()
+        confirmations.track(depth=3)
+        eth_tx.refresh_from_db()
+        block_hash = eth_tx.block_hash
+        # 別のブロックに取り込まれていたことにする
+        EthTransaction.objects.filter(pk=eth_tx.pk).update(block_hash='0x' + 'cd' * 32, block_number=1)
+
+        stats = confirmations.track(depth=3)
+        self.assertEqual(stats['reorged'], 1)
+        eth_tx.refresh_from_db()
+        self.assertEqual(eth_tx.block_hash, block_hash)
+        self.assertEqual(eth_tx.status, EthTransaction.STATUS_MINED)
+
+    def test_outbox_follows_confirmations(self):
+        eth_tx = self.send()
+        item = outbox.enqueue(self.sender, self.receiver, 1000)
+        EthOutbox.objects.filter(pk=item.pk).update(status=EthOutbox.STATUS_SENT, eth_transaction=eth_tx)
+        self.assertEqual(outbox.check_receipts(10), 0)
+
+        self.tester.mine_blocks(2)
+        confirmations.track(depth=3)
+        self.assertEqual(outbox.check_receipts(10), 1)
+        self.assertEqual(EthOutbox.objects.get().status, EthOutbox.STATUS_MINED)
+
+
+DECIMALS_SELECTOR = '0x' + function_signature_to_4byte_selector('decimals()').hex()
+
+
+class FakeNodeProvider(BaseProvider):
+    """
+    eth-tester (MockBackend) が対応していない eth_getLogs, eth_call に応答する provider
+    """
+
+    def __init__(self, head=0, logs=(), balances=None, decimals=3):
+        self.head = head
+        self.logs = logs
+        self.balances = balances or {}
+        self.decimals = decimals
+        self.errors = set()  # eth_getBalance がエラーを返すアドレス
+        self.requests = []
+
+    def make_request(self, method, params):
+        self.requests.append(method)
+        if method == 'eth_blockNumber':
+            return {'result': hex(self.head)}
+        if method == 'net_version':
+            return {'result': '3'}
+        if method == 'eth_getTransactionByHash':
+            return {'result': {'hash': params[0], 'gas': '0x5208', 'gasPrice': '0x1', 'value': '0x0'}}
+        if method == 'eth_getLogs':
+            from_block, to_block = int(params[0]['fromBlock'], 16), int(params[0]['toBlock'], 16)
+            return {'result': [log for log in self.logs if from_block <= int(log['blockNumber'], 16) <= to_block]}
+        if method == 'eth_getBalance' and params[0].lower() in self.errors:
+            return {'error': {'code': -32000, 'message': 'missing trie node'}}
+        if method == 'eth_getBalance':
+            return {'result': hex(self.balances.get(params[0].lower(), (0, 0))[0])}
+        if method == 'eth_call' and params[0]['data'] == DECIMALS_SELECTOR:
+            return {'result': '0x' + format(self.decimals, '064x')}
+        if method == 'eth_call':
+            address = '0x' + params[0]['data'][-40:]
+            return {'result': '0x' + format(self.balances.get(address, (0, 0))[1], '064x')}
+        return {'error': 'not implemented'}
+
+
+class OutboxNodeProvider(FakeNodeProvider):
+    """
+    eth_sendTransaction の結果 (受付・拒否・タイムアウト) を nonce ごとに指定できる provider
+    """
+
+    def __init__(self, address):
+        super().__init__()
+        self.address = address
+        self.sent = []
+        self.mined = 0
+        self.rejects = set()
+        self.timeouts = set()  # 受け付けた後にタイムアウト
+        self.drops = set()  # 受け付ける前にタイムアウト
+        self.lookup_error = False
+
+    def make_request(self, method, params):
+        if method == 'personal_unlockAccount':
+            return {'result': True}
+        if method == 'eth_estimateGas':
+            return {'result': '0x5208'}
+        if method == 'eth_sendTransaction':
+            nonce = chain.to_int(params[0]['nonce'])
+            if nonce in self.rejects:
+                return {'error': {'code': -32000, 'message': 'replacement transaction underpriced'}}
+            if nonce in self.drops:
+                raise requests.exceptions.ConnectionError('connection reset')
+            tx_hash = '0x%064x' % (len(self.sent) + 1)
+            self.sent.append((nonce, tx_hash))
+            if nonce in self.timeouts:
+                raise requests.exceptions.ReadTimeout('read timed out')
+            return {'result': tx_hash}
+        if method == 'eth_getTransactionByHash' and self.lookup_error:
+            return {'error': {'code': -32000, 'message': 'node unavailable'}}
+        if method == 'eth_getTransactionCount':
+            return {'result': hex(len(self.sent) if params[1] == 'pending' else self.mined)}
+        if method == 'eth_getBlockByNumber':
+            return {'result': {'number': '0x0', 'gasLimit': hex(8000000), 'transactions': [
+                {'hash': tx_hash, 'from': self.address, 'nonce': hex(nonce)} for nonce, tx_hash in self.sent
+            ]}}
+        return super().make_request(method, params)
+
+
+class OutboxSenderTests(TestCase):
+    def setUp(self):
+        admin = User.objects.create_user(username='admin', email='admin@example.com', password='hogehoge')
+        self.admin_address = '0x' + 'ad' * 20
+        EthAccount.objects.create(user=admin, address=self.admin_address, password='password')
+        alice = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        self.account = Account.objects.create(user=alice, address='UT' + 'a' * 40, balance=10000)
+        self.provider = OutboxNodeProvider(self.admin_address)
+        chain.configure(self.provider)
+        self.sender = outbox.Sender()
+
+    def tearDown(self):
+        chain.configure(None)
+
+    def withdraw(self, n):
+        for _ in range(n):
+            outbox.enqueue_withdrawal(self.account, self.admin_address, '0x' + '1' * 40, 1000)
+        return outbox.claim(batch_size=10)
+
+    def assertBalance(self, balance):
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, balance)
+
+    def test_timeout_is_not_refunded(self):
+        self.provider.timeouts = {0}
+        counts = self.sender.send_all(self.withdraw(1))
+        self.assertEqual(counts[EthOutbox.STATUS_SENDING], 1)
+        item = EthOutbox.objects.get()
+        self.assertEqual(item.status, EthOutbox.STATUS_SENDING)
+        self.assertIsNotNone(item.last_error)
+        self.assertBalance(9000)
+
+        # トランザクションプールにある間は送信中のまま
+        self.assertEqual(self.sender.reconcile([item])[EthOutbox.STATUS_SENDING], 1)
+
+        # 取り込まれたトランザクションを nonce で探して記録する
+        self.provider.mined = 1
+        self.assertEqual(self.sender.reconcile([item])[EthOutbox.STATUS_SENT], 1)
+        item.refresh_from_db()
+        self.assertEqual(item.status, EthOutbox.STATUS_SENT)
+        self.assertEqual(item.eth_transaction.tx_hash, self.provider.sent[0][1])
+        self.assertBalance(9000)
+
+    def test_reconcile_requeues_unaccepted(self):
+        self.provider.drops = {0}
+        self.sender.send_all(self.withdraw(1))
+        item = EthOutbox.objects.get()
+        self.assertEqual(item.status, EthOutbox.STATUS_SENDING)
+
+        self.assertEqual(self.sender.reconcile([item])[EthOutbox.STATUS_QUEUED], 1)
+        item.refresh_from_db()
+        self.assertEqual(item.status, EthOutbox.STATUS_QUEUED)
+        self.assertIsNone(item.nonce)
+        self.assertFalse(EthNonce.objects.exists())
+
+        self.provider.drops = set()
+        self.assertEqual(self.sender.send_all(outbox.claim(batch_size=10))[EthOutbox.STATUS_SENT], 1)
+        self.assertBalance(9000)
+
+    def test_reject_requeues_rest_of_batch(self):
+        self.provider.rejects = {1}
+        counts = self.sender.send_all(self.withdraw(3))
+        self.assertEqual(counts, {EthOutbox.STATUS_SENT: 1, EthOutbox.STATUS_FAILED: 1, EthOutbox.STATUS_SENDING: 0,
+                                  EthOutbox.STATUS_QUEUED: 1})
+        statuses = list(EthOutbox.objects.order_by('id').values_list('status', 'nonce'))
+        self.assertEqual(statuses, [(EthOutbox.STATUS_SENT, 0), (EthOutbox.STATUS_FAILED, 1),
+                                    (EthOutbox.STATUS_QUEUED, None)])
+        # 拒否された送金だけ返金
+        self.assertBalance(8000)
+
+        # 欠番の nonce から採番し直す
+        self.provider.rejects = set()
+        items = outbox.claim(batch_size=10)
+        self.assertEqual([item.nonce for item in items], [1])
+        self.assertEqual(self.sender.send_all(items)[EthOutbox.STATUS_SENT], 1)
+
+    def test_error_after_broadcast(self):
+        self.provider.lookup_error = True
+        counts = self.sender.send_all(self.withdraw(2))
+        # 1件目の記録に失敗しても残りの送金を送信する
+        self.assertEqual(counts[EthOutbox.STATUS_SENDING], 2)
+        self.assertEqual(len(self.provider.sent), 2)
+        items = list(EthOutbox.objects.order_by('id'))
+        self.assertEqual([item.tx_hash for item in items], [tx_hash for _, tx_hash in self.provider.sent])
+        self.assertBalance(8000)
+
+        self.provider.lookup_error = False
+        self.assertEqual(self.sender.reconcile(items)[EthOutbox.STATUS_SENT], 2)
+        self.assertEqual(EthOutbox.objects.filter(status=EthOutbox.STATUS_SENT).count(), 2)
+        self.assertEqual(EthTransaction.objects.count(), 2)
+
+    def test_garbled_response_is_not_refunded(self):
+        items = self.withdraw(1)
+        postings = Posting.objects.count()
+        contract = mock.Mock()
+        contract.transfer.side_effect = json.JSONDecodeError('Expecting value', '{"jsonrpc": "2.0", "res', 23)
+        with mock.patch.object(self.sender.UTCoin, 'transact', return_value=contract):
+            counts = self.sender.send_all(items)
+        self.assertEqual(counts[EthOutbox.STATUS_SENDING], 1)
+        self.assertEqual(EthOutbox.objects.get().status, EthOutbox.STATUS_SENDING)
+        self.assertEqual(Posting.objects.count(), postings)
+        self.assertBalance(9000)
+
+
+class TransferIndexerTests(TestCase):
+    def setUp(self):
+        alice = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        self.known = '0x' + '1' * 40
+        EthAccount.objects.create(user=alice, address=self.known, password='hogehoge')
+        self.logs = [
+            self.make_log(10, '0x' + '2' * 40, self.known, 1500),
+            self.make_log(20, '0x' + '2' * 40, '0x' + '3' * 40, 500),
+            self.make_log(30, self.known, '0x' + '3' * 40, 700),
+        ]
+        self.provider = FakeNodeProvider(head=50, logs=self.logs)
+        chain.configure(self.provider)
+
+    def tearDown(self):
+        chain.configure(None)
+
+    @staticmethod
+    def make_log(block_number, from_address, to_address, value):
+        return {
+            'address': settings.UTCOIN_ADDRESS,
+            'topics': [indexer.TRANSFER_TOPIC, '0x' + '0' * 24 + from_address[2:], '0x' + '0' * 24 + to_address[2:]],
+            'data': '0x' + format(value, '064x'),
+            'blockNumber': hex(block_number),
+            'blockHash': '0x' + format(block_number, '064x'),
+            'transactionHash': '0x' + uuid.uuid4().hex * 2,
+            'logIndex': '0x0',
+        }
+
+    def test_only_known_addresses_are_stored(self):
+        blocks, stored = indexer.TransferIndexer(chunk_size=8, lag=5).run()
+        self.assertEqual((blocks, stored), (46, 2))
+        deposit = EthTransaction.objects.get(tx_hash=self.logs[0]['transactionHash'])
+        self.assertEqual(deposit.amount, 1500)
+        self.assertEqual(deposit.block_number, 10)
+        self.assertEqual(deposit.status, EthTransaction.STATUS_MINED)
+        self.assertEqual(deposit.network_id, 3)
+        self.assertFalse(EthTransaction.objects.filter(tx_hash=self.logs[1]['transactionHash']).exists())
+
+    def test_resume_from_cursor(self):
+        self.provider.head = 25
+        self.assertEqual(indexer.TransferIndexer(lag=5).run(), (21, 1))
+        self.assertEqual(Cursor.objects.get(name=indexer.CURSOR_NAME).position, 20)
+
+        # 再起動後は続きのブロックだけを取り込む
+        self.provider.head = 50
+        self.assertEqual(indexer.TransferIndexer(lag=5).run(), (25, 1))
+        self.assertEqual(EthTransaction.objects.count(), 2)
+        self.assertEqual(indexer.TransferIndexer(lag=5).run(), (0, 0))
+
+    def test_sent_transaction_is_not_duplicated(self):
+        EthTransaction.objects.create(
+            tx_hash=self.logs[2]['transactionHash'], from_address=self.known, to_address='0x' + '3' * 40,
+            amount=700, gas=21000, gas_price=1, value=0, network_id=3
+        )
+        indexer.TransferIndexer(lag=0).run()
+        self.assertEqual(EthTransaction.objects.count(), 2)
+        sent = EthTransaction.objects.get(tx_hash=self.logs[2]['transactionHash'])
+        self.assertEqual(sent.status, EthTransaction.STATUS_MINED)
+        self.assertEqual(sent.block_number, 30)
+
+
+class BalanceCacheTests(TestCase):
+    def setUp(self):
+        self.accounts = ['0x' + str(i) * 40 for i in range(1, 4)]
+        self.provider = FakeNodeProvider(balances={
+            address: (10 ** 18 * i, 1000 * i) for i, address in enumerate(self.accounts, 1)
+        })
+        chain.configure(self.provider)
+        cache.clear()
+        balances.stats.reset()
+
+    def tearDown(self):
+        chain.configure(None)
+
+    def test_cache_hit_and_invalidate(self):
+        address = self.accounts[0]
+        self.assertEqual(balances.get_balance(address), (10 ** 18, 1000))
+        self.assertEqual(balances.get_balance(address), (10 ** 18, 1000))
+        self.assertEqual(balances.stats.snapshot()['hits'], 1)
+        self.assertEqual(self.provider.requests, ['eth_getBalance', 'eth_call'])
+
+        self.provider.balances[address] = (10 ** 18, 500)
+        balances.invalidate(address.upper().replace('0X', '0x'))
+        self.assertEqual(balances.get_balance(address), (10 ** 18, 500))
+        stats = balances.stats.snapshot()
+        self.assertEqual((stats['hits'], stats['misses'], stats['round_trips']), (1, 2, 2))
+        self.assertAlmostEqual(stats['hit_rate'], 1 / 3)
+
+    def test_get_balances_in_one_round_trip(self):
+        result = balances.get_balances(self.accounts)
+        self.assertEqual(result[self.accounts[2]], (3 * 10 ** 18, 3000))
+        stats = balances.stats.snapshot()
+        self.assertEqual((stats['rpc_calls'], stats['round_trips']), (6, 1))
+
+        balances.get_balances(self.accounts)
+        self.assertEqual(balances.stats.snapshot()['round_trips'], 1)
+
+    def test_indexed_transfer_invalidates_cache(self):
+        alice = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        EthAccount.objects.create(user=alice, address=self.accounts[0], password='hogehoge')
+        self.assertEqual(balances.get_balance(self.accounts[0]), (10 ** 18, 1000))
+
+        # UTpay の外から入金された
+        self.provider.balances[self.accounts[0]] = (10 ** 18, 2500)
+        self.provider.logs = [TransferIndexerTests.make_log(1, self.accounts[1], self.accounts[0], 1500)]
+        self.provider.head = 1
+        indexer.TransferIndexer(lag=0).run()
+        self.assertEqual(balances.get_balance(self.accounts[0]), (10 ** 18, 2500))
+
+    def test_error_for_one_address(self):
+        for i, address in enumerate(self.accounts):
+            user = User.objects.create_user(username=f'user{i}', email=f'user{i}@example.com', password='hogehoge')
+            EthAccount.objects.create(user=user, address=address, password='hogehoge')
+        self.provider.errors = {self.accounts[1]}
+        client = APIClient()
+        client.force_authenticate(user)
+
+        # エラーになったアドレスだけ失敗にし、キャッシュしない
+        response = client.post('/api/v1/eth_accounts/get_balances/', {'addresses': self.accounts}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['success'] for result in response.data['results']], [True, False, True])
+        self.assertEqual(response.data['results'][1]['detail'], '残高を取得できませんでした。')
+
+        response = client.get(f'/api/v1/eth_accounts/{self.accounts[1]}/get_balance/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'success': False, 'detail': '残高を取得できませんでした。'})
+
+        self.provider.errors = set()
+        self.assertEqual(balances.get_balance(self.accounts[1]), (2 * 10 ** 18, 2000))
+
+
+flaky_calls = []
+
+
+def flaky_task(fail_times):
+    flaky_calls.append(fail_times)
+    if len(flaky_calls) <= fail_times:
+        raise RuntimeError('temporary error')
+
+
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        flaky_calls.clear()
+
+    def test_retry_with_backoff(self):
+        task = tasks.enqueue(flaky_task, max_attempts=2, fail_times=1)
+        claimed, = tasks.claim(batch_size=10)
+        self.assertFalse(tasks.run(claimed))
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.STATUS_QUEUED)
+        self.assertGreater(task.run_at, timezone.now())
+        self.assertEqual(tasks.claim(batch_size=10), [])
+
+        Task.objects.filter(pk=task.pk).update(run_at=timezone.now())
+        claimed, = tasks.claim(batch_size=10)
+        self.assertTrue(tasks.run(claimed))
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.STATUS_DONE, 2))
+
+    def test_give_up_after_max_attempts(self):
+        task = tasks.enqueue(flaky_task, max_attempts=1, fail_times=5)
+        tasks.run(tasks.claim(batch_size=10)[0])
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.STATUS_FAILED)
+        self.assertIn('temporary error', task.last_error)
+
+
+@override_settings(KEYPOOL_LOW_WATERMARK=0)
+class ProvisioningTests(TestCase):
+    def setUp(self):
+        chain.configure(EthereumTesterProvider(EthereumTester()))
+
+    def tearDown(self):
+        chain.configure(None)
+
+    def run_tasks(self):
+        while True:
+            claimed = tasks.claim(batch_size=10)
+            if not claimed:
+                break
+            for task in claimed:
+                self.assertTrue(tasks.run(task), task.last_error)
+
+    def test_signup_defers_slow_steps(self):
+        user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge',
+                                        is_active=False)
+        provisioning.provision(user, 'http://testserver')
+        self.assertFalse(EthAccount.objects.filter(user=user).exists())
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.run_tasks()
+        self.assertTrue(EthAccount.objects.filter(user=user).exists())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('http://testserver/', mail.outbox[0].body)
+
+        # 再実行しても重複して作成・送信しない
+        for task in Task.objects.all():
+            self.assertTrue(tasks.run(task))
+        self.assertEqual(EthAccount.objects.filter(user=user).count(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+@override_settings(KEYPOOL_SIZE=3, KEYPOOL_LOW_WATERMARK=2, KEYPOOL_REFILL_BATCH=2)
+class KeyPoolTests(TestCase):
+    def setUp(self):
+        chain.configure(EthereumTesterProvider(EthereumTester()))
+        keypool.stats.reset()
+
+    def tearDown(self):
+        chain.configure(None)
+
+    def test_generated_key_is_usable(self):
+        keypool.add_keys(1)
+        key = EthKey.objects.get()
+        # 秘密鍵はノードにだけ登録する
+        self.assertFalse(hasattr(key, 'keyfile'))
+        self.assertIn(key.address, chain.get_web3().personal.listAccounts)
+        self.assertTrue(chain.get_web3().personal.unlockAccount(key.address, key.password))
+
+    def test_claim_and_refill(self):
+        keypool.add_keys(2)
+        first = keypool.claim()
+        self.assertIsNotNone(first.assigned_at)
+        self.assertEqual(keypool.available(), 1)
+        refills = Task.objects.filter(name=tasks.task_name(keypool.refill))
+        self.assertEqual(refills.count(), 1)
+
+        # 登録済みの補充タスクは重複させない
+        self.assertNotEqual(keypool.claim().pk, first.pk)
+        self.assertIsNone(keypool.claim())
+        self.assertEqual(refills.count(), 1)
+        self.assertEqual(keypool.stats.snapshot(), {'claims': 2, 'misses': 1, 'generated': 2})
+
+        # KEYPOOL_REFILL_BATCH 件ずつ補充し、足りない分は次のタスクで補充する
+        self.assertTrue(tasks.run(tasks.claim(batch_size=10)[0]))
+        self.assertEqual(keypool.available(), 2)
+        self.assertEqual(refills.filter(status=Task.STATUS_QUEUED).count(), 1)
+
+    @override_settings(KEYPOOL_SIZE=2, KEYPOOL_REFILL_BATCH=2)
+    def test_refill_outside_transaction(self):
+        # ノードでの鍵導出の間はトランザクションを開かない
+        personal = chain.get_web3().personal
+        depth = len(connection.savepoint_ids)
+        depths = []
+
+        def import_raw_key(private_key, password):
+            depths.append(len(connection.savepoint_ids))
+            return type(personal).importRawKey(personal, private_key, password)
+
+        keypool.schedule_refill()
+        with mock.patch.object(personal, 'importRawKey', import_raw_key):
+            self.assertTrue(tasks.run(tasks.claim(batch_size=10)[0]))
+        self.assertEqual(depths, [depth, depth])
+        self.assertEqual(keypool.available(), 2)
+
+    def test_signup_uses_pool(self):
+        keypool.add_keys(1)
+        key = EthKey.objects.get()
+        user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        provisioning.provision(user, 'http://testserver')
+        self.assertEqual(EthAccount.objects.get(user=user).address, key.address)
+
+        # プールが空の場合はワーカーでノードに作成する
+        bob = User.objects.create_user(username='bob', email='bob@example.com', password='hogehoge')
+        provisioning.provision(bob, 'http://testserver')
+        self.assertFalse(EthAccount.objects.filter(user=bob).exists())
+        provisioning.create_eth_account(bob.id)
+        self.assertTrue(EthAccount.objects.filter(user=bob).exists())
+
+
+class QRCodeTests(TestCase):
+    address = '0x' + 'ab' * 20
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.override = override_settings(QRCODE_CACHE_DIR=self.cache_dir)
+        self.override.enable()
+        qrcodes.qrcode_cache.clear()
+        addresses.ut_address_cache.clear()
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        EthAccount.objects.create(user=self.user, address=self.address, password='password')
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.cache_dir)
+
+    def test_render_and_cache(self):
+        url = reverse('accounts:qrcode', args=[self.address])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response.content.startswith(b'\x89PNG'))
+        self.assertIn('immutable', response['Cache-Control'])
+        key = qrcodes.cache_key(self.address)
+        self.assertEqual(response['ETag'], f'"{key}"')
+        self.assertTrue(os.path.exists(qrcodes.cache_path(key, 'png')))
+
+        # 2回目以降はプロセス内のキャッシュから返す
+        hits = qrcodes.qrcode_cache.hits
+        self.assertEqual(self.client.get(url).content, response.content)
+        self.assertEqual(qrcodes.qrcode_cache.hits, hits + 1)
+
+        # ETag が一致すれば生成も読み込みもしない
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(qrcodes.qrcode_cache.hits, hits + 1)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=f'"other", W/{etag}').status_code, 304)
+        # ETag を含む別の ETag は一致しない
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=f'"x{etag[1:-1]}x"').status_code, 200)
+
+    def test_format_and_size(self):
+        url = reverse('accounts:qrcode', args=[self.address])
+        response = self.client.get(url, {'format': 'svg', 'size': '4'})
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn(b'<svg', response.content)
+        self.assertEqual(self.client.get(url, {'size': '0'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'size': '²'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'size': '٣'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'format': 'gif'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('accounts:qrcode', args=['0x1234'])).status_code, 404)
+
+    def test_unregistered_address(self):
+        # 登録されていないアドレスは生成もディスクへの保存もしない
+        misses = qrcodes.qrcode_cache.misses
+        for address in ('0x' + 'ef' * 20, 'UT' + 'a' * 40):
+            url = reverse('accounts:qrcode', args=[address])
+            self.assertEqual(self.client.get(url).status_code, 404)
+            self.assertFalse(os.path.exists(qrcodes.cache_path(qrcodes.cache_key(address), 'png')))
+        self.assertEqual(qrcodes.qrcode_cache.misses, misses)
+
+        Account.objects.create(user=self.user, address='UT' + 'a' * 40)
+        self.assertEqual(self.client.get(reverse('accounts:qrcode', args=['UT' + 'a' * 40])).status_code, 200)
+
+    def test_render_command(self):
+        Account.objects.create(user=self.user, address='UT' + 'a' * 40)
+        out = StringIO()
+        call_command('render_qrcodes', '--formats', 'png', 'svg', '--workers', '1', stdout=out)
+        self.assertIn('rendered=4', out.getvalue())
+        self.assertTrue(os.path.exists(qrcodes.cache_path(qrcodes.cache_key(self.address, 'svg'), 'svg')))
+
+        # 生成済みのものはスキップする
+        out = StringIO()
+        call_command('render_qrcodes', '--formats', 'png', 'svg', '--workers', '1', stdout=out)
+        self.assertIn('to render=0', out.getvalue())
+
+
+class ContractTests(TestCase):
+    address = '0x' + 'cd' * 20
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        contracts.configure(sandbox.Sandbox(1))
+
+    @classmethod
+    def tearDownClass(cls):
+        contracts.configure(None)
+        super().tearDownClass()
+
+    def setUp(self):
+        contracts.compiled.clear()
+        user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        self.contract = Contract.objects.create(user=user, address=self.address, name='fee', is_verified=True,
+                                                code='print(to_address, amount_fixed * 3 // 100)')
+
+    def test_execute_and_cache(self):
+        result = contracts.execute(self.contract, '0x01', '0x' + 'ab' * 20, self.address, 5000)
+        self.assertTrue(result.success, result.detail)
+        self.assertEqual(result.output, f'{self.address} 0.0\n')
+        contracts.execute(self.contract, '0x02', '0x' + 'ab' * 20, self.address, 5000)
+        self.assertEqual((contracts.compiled.hits, contracts.compiled.misses), (1, 1))
+
+        # 変更されたコードはコンパイルし直す
+        self.contract.code = 'print(amount * 3 // 100)'
+        self.contract.save()
+        result = contracts.execute(self.contract, '0x03', '0x' + 'ab' * 20, self.address, 5000)
+        self.assertEqual(result.output, '150\n')
+        self.assertEqual(contracts.compiled.misses, 2)
+
+        self.contract.code = 'import os'
+        self.contract.save()
+        result = contracts.execute(self.contract, '0x04', '0x' + 'ab' * 20, self.address, 5000)
+        self.assertFalse(result.success)
+
+
+@override_settings(EVENT_SETTLE_SECONDS=0)
+class EventStreamTests(TestCase):
+    address = '0x' + 'cd' * 20
+    sender = '0x' + 'ab' * 20
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        contracts.configure(sandbox.Sandbox(1))
+
+    @classmethod
+    def tearDownClass(cls):
+        contracts.configure(None)
+        super().tearDownClass()
+
+    def setUp(self):
+        contracts.compiled.clear()
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        self.contract = Contract.objects.create(user=self.user, address=self.address, name='strict', is_verified=True,
+                                                code='if amount == 1:\n    raise ValueError("rejected")')
+
+    def test_transfer_appends_event(self):
+        bob = User.objects.create_user(username='bob', email='bob@example.com', password='hogehoge')
+        alice = Account.objects.create(user=self.user, address='UT' + 'a' * 40, balance=10000)
+        Account.objects.create(user=bob, address='UT' + 'b' * 40)
+        result = ledger.transfer(alice, 'UT' + 'b' * 40, '1.5')
+        event = TransferEvent.objects.get()
+        self.assertEqual((event.transaction, event.to_address, event.amount),
+                         (result.transaction, 'UT' + 'b' * 40, 1500))
+        self.assertEqual(events.fan_out(), (1, 0))
+
+    def test_ordered_delivery_and_dead_letter(self):
+        first = events.append(self.sender, self.address.upper().replace('0X', '0x'), 1, tx_hash='0x01')
+        second = events.append(self.sender, self.address, 2, tx_hash='0x02')
+        events.append(self.sender, '0x' + 'ef' * 20, 3, tx_hash='0x03')
+        self.assertEqual(events.fan_out(), (3, 2))
+        self.assertEqual(events.fan_out(), (0, 0))
+
+        # 先頭の配信が失敗している間は後続の配信も待つ
+        counts = events.deliver(max_attempts=2)
+        self.assertEqual(counts, {'retried': 1})
+        delivery = ContractDelivery.objects.get(event=first)
+        self.assertIn('rejected', delivery.last_error)
+        self.assertEqual(ContractDelivery.objects.get(event=second).attempts, 0)
+
+        ContractDelivery.objects.update(run_at=timezone.now())
+        counts = events.deliver(max_attempts=2)
+        self.assertEqual(counts, {'dead': 1, 'delivered': 1})
+        self.assertEqual(ContractDelivery.objects.get(event=second).status, ContractDelivery.STATUS_DONE)
+        dead_letter = ContractDeadLetter.objects.get()
+        self.assertEqual((dead_letter.event, dead_letter.attempts), (first, 2))
+
+        # 配信をやり直す
+        events.replay(dead_letter)
+        self.assertFalse(ContractDeadLetter.objects.exists())
+        self.assertEqual(ContractDelivery.objects.filter(status=ContractDelivery.STATUS_PENDING).count(), 1)
+
+    def test_lease(self):
+        events.append(self.sender, self.address, 2, tx_hash='0x02')
+        self.assertEqual(events.fan_out(), (1, 1))
+
+        # 他のディスパッチャがリースを持っている間は配信しない
+        Contract.objects.update(locked_until=timezone.now() + timedelta(seconds=60))
+        self.assertEqual(events.deliver(), {})
+        self.assertIsNone(events.acquire(self.contract.pk))
+
+        # 期限切れのリースは取得し直し、配信が終わったら返す
+        Contract.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(events.deliver(), {'delivered': 1})
+        self.contract.refresh_from_db()
+        self.assertIsNone(self.contract.locked_until)
+
+        # リースを失ったら延長できない
+        lease = events.acquire(self.contract.pk)
+        Contract.objects.update(locked_until=None)
+        self.assertIsNone(events.renew(self.contract.pk, lease))
+
+
+class VerificationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+
+    def test_analyze(self):
+        analysis = verification.analyze_cached('fee = amount * 3 // 100\nprint(fee)')
+        self.assertTrue(analysis.success)
+        self.assertIsNotNone(analysis.code)
+
+        analysis = verification.analyze_cached('import os\ndef f(n):\n    return f(n - 1)\n().__class__')
+        self.assertFalse(analysis.success)
+        self.assertEqual(len(analysis.errors), 3)
+        self.assertIsNone(analysis.code)
+
+        # ループの内側は深さに応じて重く見積もる
+        nested = 'for i in range(10):\n    for j in range(10):\n        for k in range(10):\n            print(i, j, k)'
+        self.assertGreater(verification.analyze_cached(nested).cost, settings.CONTRACT_COMPLEXITY_BUDGET)
+
+    def test_unbounded_loops(self):
+        # 回数が分からないループは見積もりに関わらず拒否する
+        for source in ('x = 0\nwhile True:\n    x += 1', 'for i in range(amount):\n    print(i)',
+                       'for c in addresses:\n    print(c)', 'print(sum(range(10 ** 8)))',
+                       'print([c for c in code])'):
+            analysis = verification.analyze_cached(source)
+            self.assertFalse(analysis.success, source)
+            self.assertLess(analysis.cost, settings.CONTRACT_COMPLEXITY_BUDGET)
+
+        # 定数の range(N) は N 回として見積もる
+        self.assertTrue(verification.analyze_cached('for i in range(3):\n    print(i)').success)
+        self.assertTrue(verification.analyze_cached('print([c for c in "abc"])').success)
+        analysis = verification.analyze_cached('print(sum(range(100000000)))')
+        self.assertFalse(analysis.success)
+        self.assertGreater(analysis.cost, 100000000)
+
+    def test_cache(self):
+        source = 'print(amount)'
+        analysis = verification.analyze_cached(source)
+        with self.settings(CONTRACT_MAX_CODE_LENGTH=1):
+            self.assertFalse(verification.analyze_cached(source).success)
+        self.assertEqual(cache.get(verification.cache_key(source)), analysis)
+
+    def test_register_and_verify(self):
+        self.client.force_login(self.user)
+        url = reverse('accounts:contract_register')
+        response = self.client.post(url, {'name': 'bad', 'description': 'test', 'code': 'import os'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Contract.objects.exists())
+
+        response = self.client.post(url, {'name': 'fee', 'description': 'test', 'code': 'print(amount)'})
+        self.assertRedirects(response, reverse('accounts:contract'))
+        task = tasks.claim(batch_size=1)[0]
+        self.assertTrue(tasks.run(task))
+        contract = Contract.objects.get()
+        self.assertTrue(contract.is_verified)
+        self.assertIsNotNone(contract.verified_at)
+
+    def test_bulk_verify(self):
+        for i in range(6):
+            code = f'print(amount + {i})' if i % 2 else f'import os{i}'
+            Contract.objects.create(user=self.user, name=f'c{i}', code=code)
+        out = StringIO()
+        call_command('verify_contract', '--all', '--workers', '2', '--chunk-size', '2', stdout=out)
+        self.assertIn('verified=3 rejected=3', out.getvalue())
+        self.assertEqual(Contract.objects.filter(is_verified=True).count(), 3)
+        self.assertEqual(Contract.objects.exclude(verification_error=None).count(), 3)
+        self.assertFalse(verification.pending().exists())
+
+
+class ActivityTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        activity.stats.reset()
+        self.alice = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        self.bob = User.objects.create_user(username='bob', email='bob@example.com', password='hogehoge')
+        self.account = Account.objects.create(user=self.alice, address='UT' + 'a' * 40, balance=10000)
+        Account.objects.create(user=self.bob, address='UT' + 'b' * 40)
+
+    def test_cache_hit(self):
+        self.assertEqual(activity.get(self.alice).account.balance, 10000)
+        with self.assertNumQueries(0):
+            cached = activity.get(self.alice)
+        self.assertEqual(cached.account.balance, 10000)
+        self.assertIs(cached.account.user, self.alice)
+        stats = activity.stats.snapshot()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_transfer_invalidates_both_users(self):
+        activity.get(self.alice)
+        activity.get(self.bob)
+        tx = ledger.transfer(self.account, 'UT' + 'b' * 40, '1.5').transaction
+
+        alice = activity.get(self.alice)
+        self.assertEqual(alice.account.balance, 8500)
+        self.assertEqual(alice.recent, [tx])
+        self.assertEqual(activity.get(self.bob).account.balance, 1500)
+        self.assertEqual(activity.stats.snapshot()['misses'], 4)
+
+        ledger.transfer_batch(self.account, [{'address': 'UT' + 'b' * 40, 'amount': '1'}])
+        self.assertEqual(activity.get(self.bob).account.balance, 2500)
+        self.assertEqual(len(activity.get(self.bob).recent), 2)
+
+    def test_stale_write_is_ignored(self):
+        # 送金の commit 前に古い残高を読んだリクエストが、後からキャッシュに書き込む
+        activity.get(self.alice)
+        stale = activity.load(self.alice.id, cache.get(activity.generation_key(self.alice.id)))
+        ledger.transfer(self.account, 'UT' + 'b' * 40, '1')
+        cache.set(activity.cache_key(self.alice.id), stale)
+        self.assertEqual(activity.get(self.alice).account.balance, 9000)
+
+    def test_withdrawal_invalidates(self):
+        activity.get(self.alice)
+        outbox.enqueue_withdrawal(self.account, '0x' + '1' * 40, '0x' + '2' * 40, 2000)
+        self.assertEqual(activity.get(self.alice).account.balance, 8000)
@@ -7,6 +7,7 @@ app_name = 'accounts'
 urlpatterns = [
     path('signup/', SignUpView.as_view(), name='signup'),
     path('activation/<key>/', ActivationView.as_view(), name='activation'),
+    path('qrcode/<address>/', QRCodeView.as_view(), name='qrcode'),
     path('login/', auth_views.LoginView.as_view(template_name='login.html'), name='login'),
     path('logout/', auth_views.LogoutView.as_view(template_name='logout.html'), name='logout'),
     path('mypage/', MyPageView.as_view(), name='mypage'),
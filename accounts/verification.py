@@ -0,0 +1,271 @@
+"""
+Contract verification pipeline
+
+登録されたコントラクトのコードを ast で解析し、使用できない構文 (import, 内部属性への
+アクセス, 再帰呼び出し, while と回数が定数でないループ) と計算量の見積もりを検査する。
+ループの内側は定数の range(N) またはリテラルの要素数を回数として見積もる。解析結果とコンパイル済みのコードは
+ソースコード (と計算量の上限) のハッシュをキーにキャッシュし、同じコードを2度解析しない。
+大量の登録は verify_contract コマンドの一括モードでワーカープロセスに分散して検査する。
+"""
+import ast
+import hashlib
+import marshal
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.utils import timezone
+
+from utpay import sandbox
+from .models import Contract
+
+COMPREHENSION_NODES = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+# 回数が分からないループ (検査で拒否する) の内側を見積もる倍数
+LOOP_FACTOR = 10
+
+
+class Analysis(NamedTuple):
+    """
+    解析結果
+    """
+    success: bool
+    errors: Tuple[str, ...] = ()
+    cost: int = 0
+    code: Optional[bytes] = None
+
+
+def constant_int(node):
+    """
+    :param ast.AST node:
+    :return int: 整数の定数 (-N を含む)、それ以外は None
+    """
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = constant_int(node.operand)
+        return None if value is None else -value
+    if isinstance(node, ast.Num) and isinstance(node.n, int) and not isinstance(node.n, bool):
+        return node.n
+    return None
+
+
+def is_range_call(node):
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'range'
+
+
+def range_length(node):
+    """
+    :param ast.Call node: range の呼び出し
+    :return int: 要素数 (引数が定数でない場合は None)
+    """
+    args = [constant_int(arg) for arg in node.args]
+    if node.keywords or not 1 <= len(args) <= 3 or None in args or (len(args) == 3 and args[2] == 0):
+        return None
+    return len(range(*args))
+
+
+def iterations(node):
+    """
+    ループの回数
+    :param ast.AST node: for の iter
+    :return int: 定数の range(N) またはリテラルの要素数 (それ以外は None)
+    """
+    if is_range_call(node):
+        return range_length(node)
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        return len(node.elts)
+    if isinstance(node, ast.Str):
+        return len(node.s)
+    return None
+
+
+def find_unbounded_loops(tree):
+    """
+    回数が分からないループ (実行時間の上限まで止まらないことがあるため拒否する)
+    :param ast.AST tree:
+    :return list: エラーメッセージ
+    """
+    problems = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.While):
+            problems.append(f'{node.lineno}行目: while は使用できません。')
+        elif is_range_call(node) and range_length(node) is None:
+            problems.append(f'{node.lineno}行目: range の引数は定数で指定してください。')
+        elif isinstance(node, ast.For) and iterations(node.iter) is None and not is_range_call(node.iter):
+            problems.append(f'{node.lineno}行目: for は定数の range(N) またはリテラルで回数を指定してください。')
+        elif isinstance(node, ast.comprehension) and iterations(node.iter) is None and not is_range_call(node.iter):
+            problems.append(f'{node.iter.lineno}行目: 内包表記は定数の range(N) またはリテラルで回数を'
+                            f'指定してください。')
+    return problems
+
+
+def estimate_cost(tree):
+    """
+    計算量の見積もり (構文ノードごとに外側のループの回数の積、range(N) は N を加える)
+    :param ast.AST tree:
+    :return int:
+    """
+    cost = 0
+    stack = [(tree, 1)]
+    while stack:
+        node, weight = stack.pop()
+        cost += weight
+        if is_range_call(node):
+            cost += weight * (range_length(node) or LOOP_FACTOR)
+        if isinstance(node, ast.For):
+            stack.extend((child, weight) for child in [node.iter, node.target] + node.orelse)
+            stack.extend((child, weight * (iterations(node.iter) or LOOP_FACTOR)) for child in node.body)
+        elif isinstance(node, ast.While):
+            stack.extend((child, weight) for child in [node.test] + node.orelse)
+            stack.extend((child, weight * LOOP_FACTOR) for child in node.body)
+        elif isinstance(node, COMPREHENSION_NODES):
+            # for 節ごとに内側の回数を掛ける
+            for generator in node.generators:
+                stack.append((generator.iter, weight))
+                weight *= iterations(generator.iter) or LOOP_FACTOR
+                stack.extend((child, weight) for child in [generator.target] + generator.ifs)
+            elts = [node.key, node.value] if isinstance(node, ast.DictComp) else [node.elt]
+            stack.extend((child, weight) for child in elts)
+        else:
+            stack.extend((child, weight) for child in ast.iter_child_nodes(node))
+    return cost
+
+
+def find_recursion(tree):
+    """
+    自身を呼び出す関数 (実行時間の上限まで止まらないため拒否する)
+    :param ast.AST tree:
+    :return list: エラーメッセージ
+    """
+    problems = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        for child in ast.walk(node):
+            if isinstance(child, ast.Call) and isinstance(child.func, ast.Name) and child.func.id == node.name:
+                problems.append(f'{child.lineno}行目: 関数 {node.name} の再帰呼び出しは使用できません。')
+                break
+    return problems
+
+
+def analyze(source, budget, max_length):
+    """
+    コードを解析してコンパイル (ワーカープロセスで実行できるよう Django に依存しない)
+    :param str source:
+    :param int budget: 計算量の見積もりの上限
+    :param int max_length: ソースコードの最大文字数
+    :return Analysis:
+    """
+    if len(source) > max_length:
+        return Analysis(False, (f'ソースコードが長すぎます ({len(source)} / {max_length} 文字)。',))
+    try:
+        tree = ast.parse(source, '<contract>', 'exec')
+    except SyntaxError as e:
+        return Analysis(False, (f'{e.lineno}行目: {e.msg}',))
+
+    errors = sandbox.find_problems(tree) + find_recursion(tree) + find_unbounded_loops(tree)
+    cost = estimate_cost(tree)
+    if cost > budget:
+        errors.append(f'計算量の見積もり ({cost}) が上限 ({budget}) を超えています。')
+    if errors:
+        return Analysis(False, tuple(errors), cost)
+    return Analysis(True, (), cost, marshal.dumps(compile(tree, '<contract>', 'exec')))
+
+
+def cache_key(source):
+    """
+    :param str source:
+    :return str: ソースコードと上限のハッシュ
+    """
+    digest = hashlib.sha256(
+        f'{settings.CONTRACT_COMPLEXITY_BUDGET}:{settings.CONTRACT_MAX_CODE_LENGTH}:{source}'.encode()
+    ).hexdigest()
+    return 'contract-analysis:' + digest
+
+
+def analyze_many(sources, workers=1, chunk_size=20):
+    """
+    キャッシュされていないものだけ解析する
+    :param iterable sources:
+    :param int workers: 2以上の場合はワーカープロセスで解析する
+    :param int chunk_size: 1回にワーカーに渡す件数
+    :return dict: {source: Analysis}
+    """
+    keys = {source: cache_key(source) for source in set(sources)}
+    cached = cache.get_many(list(keys.values()))
+    results = {source: cached[key] for source, key in keys.items() if key in cached}
+    missing = [source for source in keys if source not in results]
+    if not missing:
+        return results
+
+    args = ([settings.CONTRACT_COMPLEXITY_BUDGET] * len(missing), [settings.CONTRACT_MAX_CODE_LENGTH] * len(missing))
+    if workers > 1 and len(missing) > 1:
+        # 子プロセスに DB 接続を引き継がない (トランザクション中は閉じられないため、子プロセスでは使わない)
+        if not transaction.get_connection().in_atomic_block:
+            connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            analyses = list(executor.map(analyze, missing, *args, chunksize=chunk_size))
+    else:
+        analyses = list(map(analyze, missing, *args))
+    new = dict(zip(missing, analyses))
+    cache.set_many({keys[source]: analysis for source, analysis in new.items()},
+                   settings.CONTRACT_ANALYSIS_CACHE_TTL)
+    results.update(new)
+    return results
+
+
+def analyze_cached(source):
+    """
+    :param str source:
+    :return Analysis:
+    """
+    return analyze_many([source])[source]
+
+
+def pending():
+    """
+    :return QuerySet: 検査されていないコントラクト
+    """
+    return Contract.objects.filter(is_verified=False, is_banned=False, verification_error__isnull=True)
+
+
+def verify(contract_list, workers=1, chunk_size=20):
+    """
+    コントラクトを検査し、通過したものを認証済みに、通過しなかったものにエラーを記録する
+    :param list contract_list: Contract objects
+    :param int workers:
+    :param int chunk_size:
+    :return Counter: {'verified', 'rejected'}
+    """
+    analyses = analyze_many([contract.code for contract in contract_list], workers, chunk_size)
+    now = timezone.now()
+    counts = Counter()
+    verified = []
+    with transaction.atomic():
+        for contract in contract_list:
+            analysis = analyses[contract.code]
+            if analysis.success:
+                verified.append(contract.pk)
+                continue
+            Contract.objects.filter(pk=contract.pk).update(
+                verification_error='\n'.join(analysis.errors), modified_at=now
+            )
+            counts['rejected'] += 1
+        if verified:
+            Contract.objects.filter(pk__in=verified).update(
+                is_verified=True, verified_at=now, verification_error=None, modified_at=now
+            )
+            counts['verified'] += len(verified)
+    return counts
+
+
+def verify_contract(contract_id):
+    """
+    登録されたコントラクトを検査 (タスク)
+    :param int contract_id:
+    """
+    contract_list = list(pending().filter(pk=contract_id))
+    if contract_list:
+        verify(contract_list)
@@ -1,17 +1,16 @@
+import re
+
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.conf import settings
 from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags
 from django.shortcuts import render, redirect, get_object_or_404
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified
 from django.views import View
 from django.db import transaction
-from django.urls import reverse
-from web3 import Web3, HTTPProvider
-import secrets
-import string
-import uuid
-import qrcode
 
+from . import activity, addresses, money, provisioning, qrcodes, tasks, verification
 from .models import *
 from .forms import *
 
@@ -37,32 +36,10 @@ class SignUpView(View):
                 user.is_active = False
                 user.save()
 
-                # Create Activate
-                activate_key = self.create_activate_key()
-                activate = Activate(user=user, key=activate_key)
-                activate.save()
-
-                # Create Account
-                ut_address = self.make_ut_address()
-                while Account.objects.filter(address=ut_address).exists():
-                    ut_address = self.make_ut_address()
-                qrcode_path = self.make_qrcode(ut_address, file_dir='/images/qrcode/account/')
-                Account.objects.create(user=user, address=ut_address, qrcode=qrcode_path)
-
-                # Create EthAccount
-                web3 = Web3(HTTPProvider(settings.WEB3_PROVIDER))
-                password = self.make_random_password(length=30)
-                eth_address = web3.personal.newAccount(password)
-                qrcode_path = self.make_qrcode(eth_address, file_dir='/images/qrcode/eth_account/')
-                EthAccount.objects.create(user=user, address=eth_address, password=password, qrcode=qrcode_path)
-
-                # Send activation email
+                # Create Activate, Account
+                # (EthAccount, QRコード, 確認メールはワーカーで処理)
                 base_url = '/'.join(request.build_absolute_uri().split('/')[:3])
-                activation_url = base_url + reverse('accounts:activation', args=[activate_key])
-                user.email_user(
-                    '[UTpay] Please verify your email',
-                    f'@{user.username} さん\n\nこの度は、UTpay にご登録いただきありがとうございます。\n以下のURLにアクセスして、登録を確認してください。\n\n{activation_url}\n\n--\nUTpay <https://utpay.net>\ninfo@utpay.net'
-                )
+                provisioning.provision(user, base_url)
 
             # リダイレクト先にメッセージを表示
             messages.success(request, '登録確認メールを送信しました。')
@@ -75,49 +52,6 @@ class SignUpView(View):
             }
             return render(request, self.template_name, context)
 
-    @staticmethod
-    def create_activate_key():
-        """
-        ランダムな文字列を生成
-        :return str: UUID
-        """
-        return uuid.uuid4().hex
-
-    @staticmethod
-    def make_ut_address():
-        """
-        ランダムな42文字のUTアドレスを生成 (bitcoin base58)
-        :return str: address
-        """
-        base58_alphabet = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
-        address = 'UT' + ''.join(secrets.choice(base58_alphabet) for _ in range(40))
-        return address
-
-    @staticmethod
-    def make_random_password(length):
-        """
-        ランダムなパスワードを生成
-        :param int length: パスワードの文字数
-        :return str: password
-        """
-        alphabet = string.ascii_letters + string.digits
-        password = ''.join(secrets.choice(alphabet) for _ in range(length))
-        return password
-
-    @staticmethod
-    def make_qrcode(address, file_dir):
-        """
-        QRコードを生成
-        :param str address:
-        :param str file_dir:
-        :return str: file path
-        """
-        img = qrcode.make(address)
-        file_name = address + '.png'
-        file_path = file_dir + file_name
-        img.save(settings.MEDIA_ROOT + file_path)
-        return file_path
-
 
 class ActivationView(View):
     template_name = 'activation.html'
@@ -145,13 +79,52 @@ class ActivationView(View):
         return render(request, self.template_name, context)
 
 
+class QRCodeView(View):
+    """
+    アドレスのQRコード画像 (?format=png|svg&size=1-40)
+    登録されていないアドレスの画像は生成しない (任意のアドレスで生成とディスクへの保存をさせない)
+    """
+    max_age = 60 * 60 * 24 * 365
+
+    def get(self, request, address):
+        if not addresses.is_registered_address(address):
+            raise Http404
+
+        fmt = request.GET.get('format', qrcodes.DEFAULT_FORMAT)
+        size = request.GET.get('size', str(qrcodes.DEFAULT_SIZE))
+        # isdigit は '²' などの Unicode の数字も受け付けるため ASCII の数字だけを許可する
+        if fmt not in qrcodes.FORMATS or not re.fullmatch(r'[0-9]{1,4}', size) \
+                or not qrcodes.MIN_SIZE <= int(size) <= qrcodes.MAX_SIZE:
+            return HttpResponseBadRequest('format または size が不正です。')
+        size = int(size)
+
+        # 同じ内容からは同じ画像が生成されるため、生成せずに ETag を比較できる
+        etag = '"' + qrcodes.cache_key(address, fmt, size) + '"'
+        # If-None-Match はカンマ区切りのリスト (弱い比較のため W/ は無視する)
+        etags = [tag[2:] if tag.startswith('W/') else tag
+                 for tag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))]
+        if etag in etags or '*' in etags:
+            response = HttpResponseNotModified()
+        else:
+            content = qrcodes.qrcode_cache.get(address, fmt, size)
+            response = HttpResponse(content, content_type=qrcodes.FORMATS[fmt][0])
+        response['ETag'] = etag
+        response['Cache-Control'] = f'public, max-age={self.max_age}, immutable'
+        return response
+
+
 @method_decorator(login_required, name='dispatch')
 class MyPageView(View):
     template_name = 'mypage.html'
 
     def get(self, request):
+        # 残高と直近の送金はキャッシュから
+        recent = activity.get(request.user)
         context = {
             'title': 'マイページ',
+            'account': recent.account,
+            'balance': money.render(recent.account.balance) if recent.account else None,
+            'transactions': [(tx, money.render(tx.amount)) for tx in recent.recent],
         }
         return render(request, self.template_name, context)
 
@@ -181,6 +154,25 @@ class ContractRegisterView(View):
         }
         return render(request, self.template_name, context)
 
+    def post(self, request):
+        form = ContractForm(request.POST)
+        if form.is_valid():
+            with transaction.atomic():
+                contract = form.save(commit=False)
+                contract.user = request.user
+                contract.save()
+                # 検査を通過すると認証済みになる (ワーカーで処理)
+                tasks.enqueue(verification.verify_contract, contract_id=contract.pk)
+
+            messages.success(request, 'コントラクトの登録申請を受け付けました。')
+            return redirect('accounts:contract')
+        else:
+            context = {
+                'title': 'コントラクトを登録する',
+                'form': form,
+            }
+            return render(request, self.template_name, context)
+
 
 @method_decorator(login_required, name='dispatch')
 class ContractDetailView(View):
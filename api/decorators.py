@@ -0,0 +1,53 @@
+import functools
+import json
+
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from accounts import idempotency
+
+
+def idempotent(view_method):
+    """
+    Idempotency-Key ヘッダ付きのリクエストを1回だけ処理し、同じキーの再送には保存したレスポンスを返す
+    (再送のレスポンスには Idempotent-Replayed: true を付ける)
+    """
+
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+
+        if len(key) > idempotency.MAX_KEY_LENGTH:
+            error_msg = f'Idempotency-Key は{idempotency.MAX_KEY_LENGTH}文字以内で指定してください。'
+            print('Error:', error_msg)
+            context = {
+                'success': False,
+                'detail': error_msg
+            }
+            return Response(context, status=status.HTTP_400_BAD_REQUEST)
+
+        request_fingerprint = idempotency.fingerprint(request.method, request.path, request.body)
+
+        def handler():
+            response = view_method(self, request, *args, **kwargs)
+            return response.status_code, JSONRenderer().render(response.data).decode()
+
+        stored, replayed = idempotency.execute(request.user.pk, key, request_fingerprint, handler)
+        if stored.fingerprint != request_fingerprint:
+            error_msg = 'Idempotency-Key は別のリクエストで使用されています。'
+            print('Error:', error_msg)
+            context = {
+                'success': False,
+                'detail': error_msg
+            }
+            return Response(context, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        response = Response(json.loads(stored.body), status=stored.status_code)
+        if replayed:
+            response['Idempotent-Replayed'] = 'true'
+        return response
+
+    return wrapper
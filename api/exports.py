@@ -0,0 +1,122 @@
+"""
+Transaction history export
+
+Transaction / EthTransaction の履歴を CSV または JSON Lines (NDJSON) で逐次出力する。
+(created_at, id) のキーセットで chunk_size 件ずつ取得し (accounts.history.page)、
+RowSerializer で API と同じ表現に変換して書き出すため、件数に関わらず使用メモリは
+1チャンク分で一定になる。
+"""
+import csv
+import json
+from datetime import datetime, time
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.utils.encoders import JSONEncoder
+
+from accounts import history
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+CHUNK_SIZE = 2000
+
+
+def parse_time(value):
+    """
+    絞り込みの日時 (ISO 8601 の日時または日付、日付は現在のタイムゾーンの0時)
+    :param str value:
+    :return datetime: 不正な値は ValueError
+    """
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        parsed = datetime.combine(day, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def filter_queryset(queryset, since=None, until=None):
+    """
+    :param QuerySet queryset:
+    :param datetime since: この日時以降
+    :param datetime until: この日時より前
+    :return QuerySet:
+    """
+    if since is not None:
+        queryset = queryset.filter(created_at__gte=since)
+    if until is not None:
+        queryset = queryset.filter(created_at__lt=until)
+    return queryset
+
+
+def iter_rows(queryset, row_serializer, address=None, chunk_size=CHUNK_SIZE):
+    """
+    (created_at, id) の昇順に chunk_size 件ずつ取得
+    :param QuerySet queryset:
+    :param RowSerializer row_serializer:
+    :param str address: 送金元または送金先のアドレス (None の場合は全件)
+    :param int chunk_size:
+    :return generator: 1チャンク分の dict のリスト
+    """
+    cursor = None
+    while True:
+        rows = history.page(queryset, address, cursor, reverse=True, limit=chunk_size)
+        if not rows:
+            return
+        yield row_serializer.from_instances(rows)
+        if len(rows) < chunk_size:
+            return
+        cursor = (rows[-1].created_at, rows[-1].pk)
+
+
+class Echo:
+    """
+    csv.writer が書き込んだ行をそのまま返す
+    """
+
+    def write(self, value):
+        return value
+
+
+def to_csv(chunks, fields):
+    """
+    :param iterable chunks: iter_rows の出力
+    :param tuple fields: 列 (ヘッダ)
+    :return generator: str
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for chunk in chunks:
+        yield ''.join(writer.writerow(['' if row[field] is None else row[field] for field in fields])
+                      for row in chunk)
+
+
+def to_ndjson(chunks):
+    """
+    :param iterable chunks: iter_rows の出力
+    :return generator: str (API の JSON と同じ表現を1行に1件)
+    """
+    encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    for chunk in chunks:
+        yield ''.join(encoder.encode(row) + '\n' for row in chunk)
+
+
+def export(queryset, row_serializer, fmt, address=None, chunk_size=CHUNK_SIZE):
+    """
+    :param QuerySet queryset: 絞り込み済みの Transaction または EthTransaction
+    :param RowSerializer row_serializer:
+    :param str fmt: 'csv' or 'ndjson'
+    :param str address:
+    :param int chunk_size:
+    :return generator: str
+    """
+    chunks = iter_rows(queryset, row_serializer, address, chunk_size)
+    if fmt == 'csv':
+        return to_csv(chunks, row_serializer.fields)
+    return to_ndjson(chunks)
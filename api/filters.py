@@ -0,0 +1,27 @@
+from django_filters.constants import EMPTY_VALUES
+from django_filters.rest_framework import CharFilter, FilterSet
+
+from accounts import money
+from accounts.models import Transaction
+
+
+class AmountFilter(CharFilter):
+    """
+    UTC の金額 (例: ?amount=1.5) を最小単位に変換して絞り込む
+    """
+
+    def filter(self, qs, value):
+        if value in EMPTY_VALUES:
+            return qs
+        amount = money.parse(value)
+        if amount is None:
+            return qs.none()
+        return super(AmountFilter, self).filter(qs, int(amount))
+
+
+class TransactionFilter(FilterSet):
+    amount = AmountFilter()
+
+    class Meta:
+        model = Transaction
+        fields = ('from_address', 'to_address', 'amount', 'is_active', 'created_at')
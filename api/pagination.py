@@ -0,0 +1,127 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+
+from django.utils.dateparse import parse_datetime
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from accounts import history
+
+
+class KeysetPagination(pagination.BasePagination):
+    """
+    (created_at, id) の降順のカーソルページネーション
+
+    OFFSET を使わず直前のページの最後の行から続きを取得するため、ページの深さに関わらず
+    取得にかかる時間が変わらず、新しい行が追加されてもカーソルは有効なまま。
+    件数 (COUNT) は ?count=true の場合だけ返す。
+    ?offset= または ?ordering= が指定された場合は従来の LimitOffsetPagination で返す。
+    """
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    count_query_param = 'count'
+    invalid_cursor_message = 'カーソルが不正です。'
+
+    def __init__(self):
+        self.fallback = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if 'offset' in params or api_settings.ORDERING_PARAM in params:
+            self.fallback = pagination.LimitOffsetPagination()
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        # ビューが history_address を持つ場合は送金元と送金先のインデックスを別々に検索する
+        address = getattr(view, 'history_address', None)
+        if params.get(self.count_query_param) in ('1', 'true'):
+            self.count = history.count(queryset, address) if address is not None else queryset.count()
+        else:
+            self.count = None
+        cursor = self.decode_cursor(params.get(self.cursor_query_param))
+        if cursor is None:
+            key, reverse = None, False
+        else:
+            created_at, pk, reverse = cursor
+            key = (created_at, pk)
+
+        # 1件多く取得して続きがあるか判定する
+        rows = history.page(queryset, address, key, reverse, self.page_size + 1)
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+            self.has_next = cursor is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = cursor is not None
+        self.rows = rows
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except (TypeError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def encode_cursor(self, row, reverse):
+        """
+        :return str: URL に含めるカーソル
+        """
+        data = json.dumps([row.created_at.isoformat(), row.pk, int(reverse)], separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, encoded):
+        """
+        :param str encoded:
+        :return tuple: (created_at, id, reverse)、カーソルがない場合は None
+        """
+        if not encoded:
+            return None
+        try:
+            data = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+            created_at, pk, reverse = json.loads(data.decode())
+            created_at = parse_datetime(created_at)
+            if created_at is None or not isinstance(pk, int):
+                raise ValueError
+        except (binascii.Error, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk, bool(reverse)
+
+    def get_link(self, row, reverse):
+        url = self.request.build_absolute_uri()
+        if row is None:
+            # 先頭のページ
+            return remove_query_param(url, self.cursor_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(row, reverse))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.get_link(self.rows[-1] if self.rows else None, False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.get_link(self.rows[0] if self.rows else None, True)
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        body = OrderedDict()
+        if self.count is not None:
+            body['count'] = self.count
+        body['next'] = self.get_next_link()
+        body['previous'] = self.get_previous_link()
+        body['results'] = data
+        return Response(body)
@@ -1,15 +1,15 @@
-import secrets
-import string
-import uuid
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from operator import attrgetter
 
-import qrcode
-from django.conf import settings
 from django.urls import reverse
 from rest_framework import serializers
-from web3 import Web3, HTTPProvider
 
+from accounts import money, provisioning
 from accounts.models import *
 
+DATETIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+
 
 class DateTimeFieldAware(serializers.DateTimeField):
     """
@@ -21,6 +21,100 @@ class DateTimeFieldAware(serializers.DateTimeField):
         return super(DateTimeFieldAware, self).to_representation(value)
 
 
+class LocalTimeFormatter:
+    """
+    aware な datetime を現在のタイムゾーンの DATETIME_FORMAT で表す (DateTimeFieldAware と同じ出力)
+
+    UTC オフセットが変わる時刻 (pytz の遷移時刻) の区間を覚えておき、同じ区間の行は
+    timezone.localtime と strftime を呼ばずにオフセットを足して整形する。
+    """
+
+    def __init__(self, tz=None):
+        self.tz = tz or timezone.get_current_timezone()
+        self.transitions = getattr(self.tz, '_utc_transition_times', None)
+        self.infos = getattr(self.tz, '_transition_info', None)
+        self.start = self.end = None
+        self.offset = None
+        if self.transitions is None:
+            # 固定オフセットのタイムゾーン (UTC など)
+            self.offset = self.tz.utcoffset(None)
+            if self.offset is not None:
+                self.start, self.end = datetime.min, datetime.max
+
+    def locate(self, utc):
+        """
+        :param datetime utc: naive (UTC)
+        :return bool: オフセットが定まったかどうか
+        """
+        if self.transitions is None:
+            return False
+        i = max(0, bisect_right(self.transitions, utc) - 1)
+        self.offset = self.infos[i][0]
+        self.start = self.transitions[i]
+        self.end = self.transitions[i + 1] if i + 1 < len(self.transitions) else datetime.max
+        return True
+
+    def format(self, value):
+        """
+        :param datetime value: aware
+        :return str:
+        """
+        if value is None:
+            return None
+        utc = value.replace(tzinfo=None) - (value.utcoffset() or timedelta(0))
+        if self.start is None or not self.start <= utc < self.end:
+            if not self.locate(utc):
+                return timezone.localtime(value, self.tz).strftime(DATETIME_FORMAT)
+        try:
+            local = utc + self.offset
+        except OverflowError:
+            return timezone.localtime(value, self.tz).strftime(DATETIME_FORMAT)
+        if local.year < 1000:
+            return local.strftime(DATETIME_FORMAT)
+        return '%04d/%02d/%02d %02d:%02d:%02d' % (
+            local.year, local.month, local.day, local.hour, local.minute, local.second
+        )
+
+    def format_many(self, values):
+        """
+        :param list values: aware な datetime
+        :return list:
+        """
+        return [self.format(value) for value in values]
+
+
+class AmountField(serializers.Field):
+    """
+    最小単位 (milli-UTC) の金額を UTC の文字列 (例: '1.500') で表す
+    """
+
+    def to_representation(self, value):
+        return money.render(value)
+
+    def to_internal_value(self, data):
+        amount = money.parse(data)
+        if amount is None:
+            raise serializers.ValidationError('金額が不正です。')
+        return int(amount)
+
+
+class QRCodeURLField(serializers.ReadOnlyField):
+    """
+    アドレスのQRコード画像の URL (画像は表示時に生成される)
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = 'address'
+        super(QRCodeURLField, self).__init__(**kwargs)
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        url = reverse('accounts:qrcode', args=[value])
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+
 class UserSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
     email = serializers.CharField(required=True)
@@ -38,33 +132,11 @@ class UserSerializer(serializers.ModelSerializer):
             is_active=False
         )
 
-        # Create Activate
-        activate_key = self.create_activate_key()
-        activate = Activate(user=user, key=activate_key)
-        activate.save()
-
-        # Create Account
-        ut_address = self.make_ut_address()
-        while Account.objects.filter(address=ut_address).exists():
-            ut_address = self.make_ut_address()
-        qrcode_path = self.make_qrcode(ut_address, file_dir='/images/qrcode/account/')
-        Account.objects.create(user=user, address=ut_address, qrcode=qrcode_path)
-
-        # Create EthAccount
-        web3 = Web3(HTTPProvider(settings.WEB3_PROVIDER))
-        password = self.make_random_password(length=30)
-        eth_address = web3.personal.newAccount(password)
-        qrcode_path = self.make_qrcode(eth_address, file_dir='/images/qrcode/eth_account/')
-        EthAccount.objects.create(user=user, address=eth_address, password=password, qrcode=qrcode_path)
-
-        # Send activation email
+        # Create Activate, Account
+        # (EthAccount, QRコード, 確認メールはワーカーで処理)
         # FIXME: 自動で `base_url` を取得したい
         base_url = 'http://127.0.0.1:8000'
-        activation_url = base_url + reverse('accounts:activation', args=[activate_key])
-        user.email_user(
-            '[UTpay] Please verify your email',
-            f'@{user.username} さん\n\nこの度は、UTpay にご登録いただきありがとうございます。\n以下のURLにアクセスして、登録を確認してください。\n\n{activation_url}\n\n--\nUTpay <https://utpay.net>\ninfo@utpay.net'
-        )
+        provisioning.provision(user, base_url)
 
         return user
 
@@ -81,52 +153,11 @@ class UserSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('既に登録されているメールアドレスです。')
         return email
 
-    @staticmethod
-    def create_activate_key():
-        """
-        ランダムな文字列を生成
-        :return str: UUID
-        """
-        return uuid.uuid4().hex
-
-    @staticmethod
-    def make_ut_address():
-        """
-        ランダムな42文字のUTアドレスを生成 (bitcoin base58)
-        :return str: address
-        """
-        base58_alphabet = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
-        address = 'UT' + ''.join(secrets.choice(base58_alphabet) for _ in range(40))
-        return address
-
-    @staticmethod
-    def make_random_password(length):
-        """
-        ランダムなパスワードを生成
-        :param int length: パスワードの文字数
-        :return str: password
-        """
-        alphabet = string.ascii_letters + string.digits
-        password = ''.join(secrets.choice(alphabet) for _ in range(length))
-        return password
-
-    @staticmethod
-    def make_qrcode(address, file_dir):
-        """
-        QRコードを生成
-        :param str address:
-        :param str file_dir:
-        :return str: file path
-        """
-        img = qrcode.make(address)
-        file_name = address + '.png'
-        file_path = file_dir + file_name
-        img.save(settings.MEDIA_ROOT + file_path)
-        return file_path
-
 
 class AccountSerializer(serializers.ModelSerializer):
     user = UserSerializer()
+    balance = AmountField(read_only=True)
+    qrcode = QRCodeURLField()
 
     class Meta:
         model = Account
@@ -135,6 +166,7 @@ class AccountSerializer(serializers.ModelSerializer):
 
 class EthAccountSerializer(serializers.ModelSerializer):
     user = UserSerializer()
+    qrcode = QRCodeURLField()
 
     class Meta:
         model = EthAccount
@@ -142,7 +174,8 @@ class EthAccountSerializer(serializers.ModelSerializer):
 
 
 class TransactionSerializer(serializers.ModelSerializer):
-    created_at = DateTimeFieldAware(format="%Y/%m/%d %H:%M:%S")
+    amount = AmountField()
+    created_at = DateTimeFieldAware(format=DATETIME_FORMAT)
 
     class Meta:
         model = Transaction
@@ -151,25 +184,104 @@ class TransactionSerializer(serializers.ModelSerializer):
 
 class EthTransactionSerializer(serializers.ModelSerializer):
     amount_fixed = serializers.SerializerMethodField()
-    created_at = DateTimeFieldAware(format="%Y/%m/%d %H:%M:%S")
+    created_at = DateTimeFieldAware(format=DATETIME_FORMAT)
 
     @staticmethod
     def get_amount_fixed(obj):
-        num_suffix = 1000
-        return obj.amount / num_suffix
+        return money.Amount(obj.amount).fixed
 
     class Meta:
         model = EthTransaction
         fields = ('id', 'tx_hash', 'from_address', 'to_address', 'amount', 'amount_fixed', 'gas', 'gas_price', 'value',
-                  'network_id', 'is_active', 'created_at')
+                  'network_id', 'status', 'block_number', 'gas_used', 'is_active', 'created_at')
+
+
+class EthOutboxSerializer(serializers.ModelSerializer):
+    tx_hash = serializers.CharField(source='eth_transaction.tx_hash', default=None, read_only=True)
+    created_at = DateTimeFieldAware(format=DATETIME_FORMAT)
+    modified_at = DateTimeFieldAware(format=DATETIME_FORMAT)
+
+    class Meta:
+        model = EthOutbox
+        fields = ('id', 'from_address', 'to_address', 'amount', 'status', 'nonce', 'tx_hash', 'created_at',
+                  'modified_at')
 
 
 class ContractSerializer(serializers.ModelSerializer):
-    verified_at = DateTimeFieldAware(format="%Y/%m/%d %H:%M:%S")
-    created_at = DateTimeFieldAware(format="%Y/%m/%d %H:%M:%S")
-    modified_at = DateTimeFieldAware(format="%Y/%m/%d %H:%M:%S")
+    qrcode = QRCodeURLField()
+    verified_at = DateTimeFieldAware(format=DATETIME_FORMAT)
+    created_at = DateTimeFieldAware(format=DATETIME_FORMAT)
+    modified_at = DateTimeFieldAware(format=DATETIME_FORMAT)
 
     class Meta:
         model = Contract
         fields = ('id', 'address', 'qrcode', 'name', 'description', 'code', 'is_active', 'is_verified', 'is_banned',
                   'verified_at', 'created_at', 'modified_at')
+
+
+class RowSerializer:
+    """
+    読み取り専用のシリアライザの高速版 (ModelSerializer と同じ JSON を出力)
+
+    .values_list(*columns) の行 (またはモデルのインスタンス) から、フィールドごとの変換を
+    列単位でまとめて行い dict を作る。DRF のフィールドを行ごとに呼び出さないため、
+    一覧・エクスポートで大量の行を返す場合に使う。
+    """
+    # values_list で取得するカラム
+    columns = ()
+    # 出力するフィールド (順序も ModelSerializer と同じにする)
+    fields = ()
+
+    def __init__(self, tz=None):
+        self.localtime = LocalTimeFormatter(tz)
+
+    def convert(self, columns):
+        """
+        列単位の変換 (サブクラスで columns を書き換える)
+        :param dict columns: {カラム: 値のリスト}
+        """
+
+    def to_representation(self, rows):
+        """
+        :param iterable rows: values_list(*self.columns) の行
+        :return list: dict
+        """
+        rows = list(rows)
+        if not rows:
+            return []
+        columns = dict(zip(self.columns, map(list, zip(*rows))))
+        self.convert(columns)
+        fields = self.fields
+        return [dict(zip(fields, row)) for row in zip(*(columns[field] for field in fields))]
+
+    def from_queryset(self, queryset):
+        return self.to_representation(queryset.values_list(*self.columns))
+
+    def from_instances(self, instances):
+        return self.to_representation(map(attrgetter(*self.columns), instances))
+
+
+class TransactionRowSerializer(RowSerializer):
+    """
+    TransactionSerializer の高速版
+    """
+    columns = fields = ('id', 'from_address', 'to_address', 'amount', 'is_active', 'created_at')
+
+    def convert(self, columns):
+        columns['amount'] = money.render_many(columns['amount'])
+        columns['created_at'] = self.localtime.format_many(columns['created_at'])
+
+
+class EthTransactionRowSerializer(RowSerializer):
+    """
+    EthTransactionSerializer の高速版
+    """
+    columns = ('id', 'tx_hash', 'from_address', 'to_address', 'amount', 'gas', 'gas_price', 'value', 'network_id',
+               'status', 'block_number', 'gas_used', 'is_active', 'created_at')
+    fields = ('id', 'tx_hash', 'from_address', 'to_address', 'amount', 'amount_fixed', 'gas', 'gas_price', 'value',
+              'network_id', 'status', 'block_number', 'gas_used', 'is_active', 'created_at')
+
+    def convert(self, columns):
+        unit = money.UNIT
+        columns['amount_fixed'] = [amount / unit for amount in columns['amount']]
+        columns['created_at'] = self.localtime.format_many(columns['created_at'])
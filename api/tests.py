@@ -1,3 +1,431 @@
+import csv
+import json
+from datetime import datetime, timedelta
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.timezone import utc
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from accounts import activity, history, idempotency
+from accounts.models import (
+    Account, Contract, EthAccount, EthOutbox, EthTransaction, IdempotencyKey, Posting, Transaction,
+)
+from . import exports
+from .views import AccountViewSet, ContractViewSet, EthAccountViewSet, EthOutboxViewSet
+from .serializer import (
+    EthTransactionRowSerializer, EthTransactionSerializer, TransactionRowSerializer, TransactionSerializer,
+)
+
+
+class KeysetPaginationTests(TestCase):
+    url = '/api/v1/transactions/'
+
+    def setUp(self):
+        user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        self.account = Account.objects.create(user=user, address='UT' + 'a' * 40)
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+        # 送金と受取、同じ作成日時の行を含む
+        now = timezone.now()
+        Transaction.objects.bulk_create(
+            Transaction(from_address=self.account.address, to_address='UT' + 'b' * 40, amount=i + 1,
+                        created_at=now - timedelta(seconds=i // 3))
+            if i % 2 else
+            Transaction(from_address='UT' + 'b' * 40, to_address=self.account.address, amount=i + 1,
+                        created_at=now - timedelta(seconds=i // 3))
+            for i in range(10)
+        )
+        Transaction.objects.create(from_address='UT' + 'c' * 40, to_address='UT' + 'b' * 40, amount=1)
+        self.expected = list(
+            history.involving(Transaction.objects.all(), self.account.address).order_by('-created_at', '-id')
+            .values_list('id', flat=True)
+        )
+
+    def get_ids(self, response):
+        return [row['id'] for row in response.data['results']]
+
+    def test_walk_pages(self):
+        response = self.client.get(self.url, {'limit': 4})
+        self.assertNotIn('count', response.data)
+        self.assertIsNone(response.data['previous'])
+        pages = [self.get_ids(response)]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            pages.append(self.get_ids(response))
+        self.assertEqual(sum(pages, []), self.expected)
+        self.assertEqual([len(page) for page in pages], [4, 4, 2])
+
+        # 前のページに戻る
+        response = self.client.get(response.data['previous'])
+        self.assertEqual(self.get_ids(response), pages[1])
+
+    def test_cursor_survives_new_rows(self):
+        response = self.client.get(self.url, {'limit': 4})
+        Transaction.objects.create(from_address=self.account.address, to_address='UT' + 'b' * 40, amount=100)
+        response = self.client.get(response.data['next'])
+        self.assertEqual(self.get_ids(response), self.expected[4:8])
+
+    def test_count_and_fallback(self):
+        response = self.client.get(self.url, {'count': 'true'})
+        self.assertEqual(response.data['count'], 10)
+
+        response = self.client.get(self.url, {'offset': 8, 'limit': 4})
+        self.assertEqual(response.data['count'], 10)
+        self.assertEqual(len(response.data['results']), 2)
+
+        self.assertEqual(self.client.get(self.url, {'cursor': 'invalid'}).status_code, 404)
+
+    def test_amount_in_utc(self):
+        # 最小単位 (milli-UTC) で保存し、UTC の文字列で返す・絞り込む
+        response = self.client.get(self.url, {'amount': '0.002'})
+        self.assertEqual([row['amount'] for row in response.data['results']], ['0.002'])
+        self.assertEqual(self.client.get(self.url, {'amount': '0.0001'}).data['results'], [])
+
+
+class HistoryQueryTests(TestCase):
+    url = '/api/v1/transactions/'
+
+    def setUp(self):
+        user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        self.address = Account.objects.create(user=user, address='UT' + 'a' * 40).address
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+        # 他のアドレスの行が大半を占める台帳 (自分宛ての送金を含む)
+        now = timezone.now()
+        others = ['UT' + str(i % 10) * 40 for i in range(500)]
+        Transaction.objects.bulk_create(
+            Transaction(from_address=others[i], to_address=others[i - 1], amount=1,
+                        created_at=now - timedelta(seconds=i))
+            for i in range(500)
+        )
+        Transaction.objects.bulk_create([
+            Transaction(from_address=self.address, to_address=others[0], amount=1, created_at=now),
+            Transaction(from_address=others[1], to_address=self.address, amount=2, created_at=now),
+            Transaction(from_address=self.address, to_address=self.address, amount=3, created_at=now),
+        ])
+
+    def test_union_of_both_sides(self):
+        rows = history.page(Transaction.objects.all(), self.address, limit=10)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(len({row.id for row in rows}), 3)
+        self.assertEqual(history.count(Transaction.objects.all(), self.address), 3)
+
+        expected = list(history.involving(Transaction.objects.all(), self.address).order_by('-created_at', '-id'))
+        self.assertEqual(rows, expected)
+        self.assertEqual(history.page(Transaction.objects.all(), self.address, reverse=True, limit=10),
+                         expected[::-1])
+
+    def test_number_of_queries(self):
+        # ページの取得だけ (UNION ALL、SQLite では送金元と送金先の2回)
+        # アカウントは認証済みのユーザーにキャッシュされている
+        page_queries = 1 if connection.features.supports_slicing_ordering_in_compound else 2
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, {'limit': 2})
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertEqual(len(context), page_queries)
+
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(response.data['next'])
+        self.assertEqual(len(context), page_queries)
+
+    def test_index_range_scans(self):
+        # カーソルの位置からの範囲検索
+        if connection.vendor == 'sqlite':
+            explain, access = 'EXPLAIN QUERY PLAN ', 'created_at<?'
+        elif connection.vendor == 'mysql':
+            explain, access = 'EXPLAIN ', 'range'
+        else:
+            self.skipTest('EXPLAIN の形式に対応していないデータベース')
+
+        queryset = history.involving(Transaction.objects.all(), self.address)
+        cursor_key = (timezone.now(), 10 ** 9)
+        for branch, index in zip(history.branches(queryset, self.address),
+                                 ('transaction_from_idx', 'transaction_to_idx')):
+            part = history.after(branch, *cursor_key).order_by(*history.ordering())[:21]
+            sql, params = part.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(explain + sql, params)
+                plan = ' '.join(str(column) for row in cursor.fetchall() for column in row)
+            self.assertIn(index, plan)
+            self.assertIn(access, plan)
+            # インデックスの順序のまま読み、並べ替えない
+            self.assertNotIn('TEMP B-TREE', plan)
+            self.assertNotIn('filesort', plan)
+
+
+class IdempotencyTests(TestCase):
+    url = '/api/v1/transactions/transfer/'
+
+    def setUp(self):
+        idempotency.replay_cache.clear()
+        alice = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        bob = User.objects.create_user(username='bob', email='bob@example.com', password='hogehoge')
+        Account.objects.create(user=alice, address='UT' + 'a' * 40, balance=10000)
+        self.to_address = Account.objects.create(user=bob, address='UT' + 'b' * 40).address
+        self.client = APIClient()
+        self.client.force_authenticate(alice)
+
+    def transfer(self, key, amount='1.5'):
+        return self.client.post(self.url, {'address': self.to_address, 'amount': amount},
+                                HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_returns_stored_response(self):
+        first = self.transfer('retry-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertNotIn('Idempotent-Replayed', first)
+
+        # プロセス内のキャッシュから、次に DB から返す
+        for clear in (False, True):
+            if clear:
+                idempotency.replay_cache.clear()
+            retry = self.transfer('retry-1')
+            self.assertEqual(retry.status_code, 201)
+            self.assertEqual(retry['Idempotent-Replayed'], 'true')
+            self.assertEqual(retry.data, first.data)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+        # 別のキーは別の送金
+        self.assertEqual(self.transfer('retry-2').status_code, 201)
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_key_reused_for_another_request(self):
+        self.transfer('reused')
+        self.assertEqual(self.transfer('reused', amount='2').status_code, 422)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_expired_keys(self):
+        self.transfer('expired')
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        idempotency.replay_cache.clear()
+        self.assertEqual(idempotency.sweep(), 1)
+
+        self.assertNotIn('Idempotent-Replayed', self.transfer('expired'))
+        self.assertEqual(Transaction.objects.count(), 2)
+
+
+class AccountListTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        Account.objects.create(user=self.user, address='UT' + 'a' * 40, balance=1500)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_served_from_activity_cache(self):
+        first = self.client.get('/api/v1/accounts/')
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/v1/accounts/')
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second.data['count'], 1)
+        self.assertEqual(second.data['results'][0]['balance'], '1.500')
+        self.assertEqual(second.data['results'][0]['user']['username'], 'alice')
+        self.assertGreaterEqual(activity.stats.snapshot()['hits'], 1)
+
+
+class EthOutboxListTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        self.account = Account.objects.create(user=self.user, address='UT' + 'a' * 40)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_without_eth_account(self):
+        # 鍵の割り当て待ちでも出金は見える
+        EthOutbox.objects.create(account=self.account, from_address='0x' + 'ad' * 20, to_address='0x' + '1' * 40,
+                                 amount=1000)
+        response = self.client.get('/api/v1/eth_transfers/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+
+        # EthAccount から直接送金したものも含める
+        EthAccount.objects.create(user=self.user, address='0x' + 'a' * 40, password='x')
+        EthOutbox.objects.create(from_address='0x' + 'a' * 40, to_address='0x' + '1' * 40, amount=1000)
+        EthOutbox.objects.create(from_address='0x' + 'b' * 40, to_address='0x' + '1' * 40, amount=1000)
+        self.assertEqual(len(self.client.get('/api/v1/eth_transfers/').data['results']), 2)
+
+
+class RowSerializerTests(TestCase):
+    def setUp(self):
+        # 夏時間の切り替わり、マイクロ秒、負の金額を含む
+        start = datetime(2018, 3, 11, 6, 30, 59, 999999, tzinfo=utc)
+        Transaction.objects.bulk_create(
+            Transaction(from_address='UT' + 'a' * 40, to_address='UT' + 'b' * 40, amount=(-1) ** i * i * 377,
+                        is_active=bool(i % 3), created_at=start + timedelta(minutes=17 * i))
+            for i in range(50)
+        )
+        Transaction.objects.create(from_address='UT' + 'a' * 40, to_address='UT' + 'b' * 40, amount=1,
+                                   created_at=datetime(1948, 5, 1, 15, 0, tzinfo=utc))
+        EthTransaction.objects.bulk_create(
+            EthTransaction(tx_hash='0x%064x' % i, from_address='0x' + '1' * 40, to_address='0x' + '2' * 40,
+                           amount=i * 1001, gas=21000, gas_price=10 ** 9, value=0, network_id=3,
+                           block_number=i if i % 2 else None, created_at=start + timedelta(hours=i))
+            for i in range(20)
+        )
+
+    def assertSameJSON(self, serializer_class, row_serializer_class, queryset):
+        expected = JSONRenderer().render(serializer_class(queryset, many=True).data)
+        self.assertEqual(JSONRenderer().render(row_serializer_class().from_queryset(queryset)), expected)
+        self.assertEqual(JSONRenderer().render(row_serializer_class().from_instances(queryset)), expected)
+
+    def test_byte_identical(self):
+        for tz in ('Asia/Tokyo', 'America/New_York', 'UTC'):
+            with timezone.override(tz):
+                self.assertSameJSON(TransactionSerializer, TransactionRowSerializer,
+                                    Transaction.objects.order_by('id'))
+                self.assertSameJSON(EthTransactionSerializer, EthTransactionRowSerializer,
+                                    EthTransaction.objects.order_by('id'))
+        self.assertEqual(TransactionRowSerializer().from_queryset(Transaction.objects.none()), [])
+
+
+class ExportTests(TestCase):
+    url = '/api/v1/transactions/export/'
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        self.address = Account.objects.create(user=self.user, address='UT' + 'a' * 40).address
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        # 同じ作成日時の行を含む (チャンクの境界をまたぐ)
+        self.start = datetime(2018, 4, 1, tzinfo=utc)
+        Transaction.objects.bulk_create(
+            Transaction(from_address=self.address if i % 2 else 'UT' + 'b' * 40,
+                        to_address='UT' + 'b' * 40 if i % 2 else self.address,
+                        amount=i + 1, created_at=self.start + timedelta(hours=i // 4))
+            for i in range(30)
+        )
+        Transaction.objects.create(from_address='UT' + 'c' * 40, to_address='UT' + 'b' * 40, amount=1,
+                                   created_at=self.start)
+
+    def read(self, response):
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_ndjson_in_chunks(self):
+        queryset = history.involving(Transaction.objects.all(), self.address).order_by('created_at', 'id')
+        expected = TransactionRowSerializer().from_queryset(queryset)
+        chunks = list(exports.iter_rows(Transaction.objects.all(), TransactionRowSerializer(), self.address,
+                                        chunk_size=7))
+        self.assertEqual([len(chunk) for chunk in chunks], [7, 7, 7, 7, 2])
+        self.assertEqual(sum(chunks, []), expected)
+
+        response = self.client.get(self.url, {'type': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        self.assertEqual([json.loads(line) for line in self.read(response).splitlines()], expected)
+
+    def test_csv_with_date_filter(self):
+        response = self.client.get(self.url, {'since': '2018-04-01T03:00:00Z', 'until': '2018-04-01T05:00:00Z'})
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="transaction.csv"')
+        rows = list(csv.DictReader(StringIO(self.read(response))))
+        self.assertEqual([row['amount'] for row in rows], ['0.%03d' % i for i in range(13, 21)])
+        self.assertEqual(rows[0]['is_active'], 'True')
+
+        self.assertEqual(self.client.get(self.url, {'type': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'since': 'yesterday'}).status_code, 400)
+
+    def test_address_scope(self):
+        # 一般ユーザは他のアドレスを指定しても自分の履歴だけ
+        response = self.client.get(self.url, {'type': 'ndjson', 'address': 'UT' + 'c' * 40})
+        self.assertEqual(len(self.read(response).splitlines()), 30)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(len(self.read(self.client.get(self.url, {'type': 'ndjson'})).splitlines()), 31)
+        response = self.client.get(self.url, {'type': 'ndjson', 'address': 'UT' + 'c' * 40})
+        self.assertEqual(len(self.read(response).splitlines()), 1)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('export_transactions', type='csv', address=self.address, since='2018-04-01', chunk_size=4,
+                     stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], ','.join(TransactionRowSerializer.fields))
+        self.assertEqual(len(lines), 31)
+
+
+class QueryCountTests(TestCase):
+    """
+    一覧のクエリ数がページの件数に依存しないこと (N+1 クエリの検出)
+    エンドポイントや関連オブジェクトを参照するフィールドを追加した場合はここにも追加する
+    """
+    endpoints = (
+        '/api/v1/transactions/',
+        '/api/v1/eth_transactions/',
+        '/api/v1/eth_transfers/',
+        '/api/v1/contracts/',
+    )
+    viewsets = (AccountViewSet, EthAccountViewSet, EthOutboxViewSet, ContractViewSet)
+    admin_models = (Account, EthAccount, Posting, EthOutbox, Contract)
+    rows = 10
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='alice', email='alice@example.com', password='hogehoge')
+        self.account = Account.objects.create(user=self.user, address='UT' + 'a' * 40)
+        self.eth_address = EthAccount.objects.create(user=self.user, address='0x' + 'a' * 40, password='x').address
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for i in range(self.rows):
+            self.create_rows(i)
+
+    def create_rows(self, i):
+        other = User.objects.create_user(username=f'user{i}', email=f'user{i}@example.com', password='hogehoge')
+        Account.objects.create(user=other, address=f'UT{i:040d}')
+        EthAccount.objects.create(user=other, address=f'0x{i:040x}', password='x')
+        tx = Transaction.objects.create(from_address=self.account.address, to_address=f'UT{i:040d}', amount=1)
+        eth_tx = EthTransaction.objects.create(
+            tx_hash=f'0x{i:064x}', from_address=self.eth_address, to_address=f'0x{i:040x}', amount=1, gas=1,
+            gas_price=1, value=0, network_id=3
+        )
+        Posting.objects.create(transaction=tx, address=tx.from_address, amount=-1)
+        EthOutbox.objects.create(account=self.account, from_address=self.eth_address, to_address=f'0x{i:040x}',
+                                 amount=1, eth_transaction=eth_tx)
+        Contract.objects.create(user=self.user, address=f'UT{i:039d}c', name=f'contract{i}')
+
+    def count_queries(self, request):
+        with CaptureQueriesContext(connection) as context:
+            request()
+        return len(context)
+
+    def test_endpoints(self):
+        for url in self.endpoints:
+            counts = []
+            for limit in (1, self.rows):
+                response = None
+
+                def get():
+                    nonlocal response
+                    response = self.client.get(url, {'limit': limit})
+                counts.append(self.count_queries(get))
+                self.assertEqual(len(response.data['results']), limit, url)
+            self.assertEqual(counts[0], counts[1], url)
+
+    def test_nested_serializers(self):
+        # 認証ユーザのアカウントだけを返すビューも、複数件をまとめて返す場合に行ごとのクエリがないこと
+        for viewset in self.viewsets:
+            serializer_class = viewset.serializer_class
+            queryset = viewset().with_related(serializer_class.Meta.model.objects.order_by('id'))
+            for limit in (1, self.rows):
+                self.assertEqual(self.count_queries(lambda: serializer_class(queryset[:limit], many=True).data), 1,
+                                 viewset.__name__)
 
-# Create your tests here.
+    def test_admin_changelists(self):
+        self.client.force_login(self.user)
+        counts = []
+        for rows in (self.rows, self.rows * 2):
+            for i in range(self.rows, rows):
+                self.create_rows(i)
+            counts.append([
+                self.count_queries(lambda: self.client.get(f'/admin/accounts/{model._meta.model_name}/'))
+                for model in self.admin_models
+            ])
+        self.assertEqual(counts[0], counts[1])
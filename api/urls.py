@@ -13,6 +13,7 @@ router.register(r'accounts', AccountViewSet, base_name='account')
 router.register(r'eth_accounts', EthAccountViewSet, base_name='eth_account')
 router.register(r'transactions', TransactionViewSet, base_name='transaction')
 router.register(r'eth_transactions', EthTransactionViewSet, base_name='eth_transaction')
+router.register(r'eth_transfers', EthOutboxViewSet, base_name='eth_transfer')
 router.register(r'contracts', ContractViewSet, base_name='contract')
 
 urlpatterns = [
@@ -21,4 +22,5 @@ urlpatterns = [
     path('token-refresh/', refresh_jwt_token),
     path('token-verify/', verify_jwt_token),
     path('register/', RegisterView.as_view()),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
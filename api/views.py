@@ -1,18 +1,101 @@
 import json
-from decimal import *
 
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Q, Sum
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import permissions, generics, status, viewsets, filters
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.response import Response
-
-from callback_functions.transfer_callback import transfer_callback
+from rest_framework.views import APIView
+from web3 import Web3
+
+from accounts import activity, addresses, balances, history, keypool, ledger, money, outbox
+from utpay import chain, profiling
+from . import exports
+from .decorators import idempotent
+from .filters import TransactionFilter
+from .pagination import KeysetPagination
 from .serializer import *
 
 
+class QueryAwareMixin:
+    """
+    シリアライザが参照する関連オブジェクトを宣言し、一覧・詳細で一括取得する (N+1 クエリの防止)
+    """
+    # select_related / prefetch_related に渡すフィールド
+    select_related = ()
+    prefetch_related = ()
+
+    def with_related(self, queryset):
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        return queryset
+
+    def filter_queryset(self, queryset):
+        return self.with_related(super(QueryAwareMixin, self).filter_queryset(queryset))
+
+
+class RowListMixin:
+    """
+    一覧を row_serializer_class (RowSerializer) で返す (出力は serializer_class と同じ)
+    """
+    row_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer = self.row_serializer_class()
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer.from_instances(page))
+        return Response(serializer.from_queryset(queryset))
+
+
+class ExportMixin:
+    """
+    履歴を CSV または JSON Lines で逐次出力する (/export/?type=csv|ndjson&since=&until=&address=)
+    一般ユーザは自分のアドレスの履歴だけ、管理者は address を省略すると全件を出力する。
+    """
+
+    @list_route()
+    def export(self, request):
+        params = request.query_params
+        fmt = params.get('type', 'csv')
+        if fmt not in exports.FORMATS:
+            return self.export_error('形式は csv または ndjson を指定してください。')
+        try:
+            since = exports.parse_time(params['since']) if params.get('since') else None
+            until = exports.parse_time(params['until']) if params.get('until') else None
+        except ValueError:
+            return self.export_error('日時が不正です。')
+
+        if request.user.is_staff:
+            queryset = self.get_serializer_class().Meta.model.objects.all()
+            address = params.get('address') or None
+        else:
+            queryset = self.get_queryset()
+            address = self.history_address
+        queryset = exports.filter_queryset(queryset, since, until)
+
+        response = StreamingHttpResponse(exports.export(queryset, self.row_serializer_class(), fmt, address),
+                                         content_type=exports.FORMATS[fmt])
+        response['Content-Disposition'] = f'attachment; filename="{self.basename}.{fmt}"'
+        return response
+
+    @staticmethod
+    def export_error(error_msg):
+        print('Error:', error_msg)
+        context = {
+            'success': False,
+            'detail': error_msg
+        }
+        return Response(context, status=status.HTTP_400_BAD_REQUEST)
+
+
 class RegisterView(generics.CreateAPIView):
     """
     Create User
@@ -30,6 +113,16 @@ class RegisterView(generics.CreateAPIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class MetricsView(APIView):
+    """
+    リクエストの計測結果 (Prometheus のテキスト形式)
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request):
+        return HttpResponse(profiling.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 class UserViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = UserSerializer
@@ -38,17 +131,30 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
         return User.objects.filter(pk=self.request.user.id)
 
 
-class AccountViewSet(viewsets.ReadOnlyModelViewSet):
+class AccountViewSet(QueryAwareMixin, viewsets.ReadOnlyModelViewSet):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = AccountSerializer
+    select_related = ('user',)
 
     def get_queryset(self):
         return Account.objects.filter(user=self.request.user)
 
+    def list(self, request, *args, **kwargs):
+        # 認証されたユーザのアカウントだけなので、キャッシュした読み取りモデルから返す
+        account = activity.get(request.user).account
+        page = self.paginate_queryset([account] if account is not None else [])
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @list_route(permission_classes=(permissions.IsAdminUser,))
+    def activity_stats(self, request):
+        return Response(activity.stats.snapshot())
 
-class EthAccountViewSet(viewsets.ReadOnlyModelViewSet):
+
+class EthAccountViewSet(QueryAwareMixin, viewsets.ReadOnlyModelViewSet):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = EthAccountSerializer
+    select_related = ('user',)
 
     def get_queryset(self):
         return EthAccount.objects.filter(user=self.request.user)
@@ -59,69 +165,116 @@ class EthAccountViewSet(viewsets.ReadOnlyModelViewSet):
         address = pk
 
         # Get UTCoin balance
-        num_suffix = 1000
-        w3 = Web3(HTTPProvider(settings.WEB3_PROVIDER))
-        eth_balance = w3.fromWei(w3.eth.getBalance(address), 'ether')
-        abi = self.load_abi(settings.ARTIFACT_PATH)
-        UTCoin = w3.eth.contract(abi=abi, address=settings.UTCOIN_ADDRESS)
-        balance_int = UTCoin.call().balanceOf(address)
-        balance = float(balance_int / num_suffix)
+        balance = balances.get_balance(address)
+        if balance is None:
+            error_msg = '残高を取得できませんでした。'
+            print('Error:', error_msg)
+            context = {
+                'success': False,
+                'detail': error_msg
+            }
+            return Response(context)
+        context = self.balance_context(address, *balance)
+        return Response(context)
+
+    @list_route(methods=['post'])
+    def get_balances(self, request):
+        batch_size_max = 100
+
+        # Receive params
+        body = json.loads(request.body)
+        address_list = body.get('addresses')
+        if not isinstance(address_list, list) or not address_list:
+            error_msg = 'アドレスが入力されていません。'
+            print('Error:', error_msg)
+            context = {
+                'success': False,
+                'detail': error_msg
+            }
+            return Response(context)
+
+        if len(address_list) > batch_size_max:
+            error_msg = f'一度に取得できるのは{batch_size_max}件までです。'
+            print('Error:', error_msg)
+            context = {
+                'success': False,
+                'detail': error_msg
+            }
+            return Response(context)
+
+        valid = [address for address in address_list if addresses.is_eth_address(address)]
+        registered = set(EthAccount.objects.filter(address__in=valid).values_list('address', flat=True))
+
+        # Get UTCoin balances (キャッシュにない残高は1回のバッチリクエストで取得)
+        fetched = balances.get_balances(sorted(registered))
+        results = []
+        for address in address_list:
+            if fetched.get(address) is not None:
+                results.append(dict({'success': True}, **self.balance_context(address, *fetched[address])))
+            elif address in fetched:
+                results.append({
+                    'success': False,
+                    'address': address,
+                    'detail': '残高を取得できませんでした。'
+                })
+            else:
+                results.append({
+                    'success': False,
+                    'address': address,
+                    'detail': 'アドレスが存在しません。'
+                })
 
         context = {
+            'success': any(result['success'] for result in results),
+            'results': results
+        }
+        return Response(context)
+
+    @list_route(permission_classes=(permissions.IsAdminUser,))
+    def balance_stats(self, request):
+        return Response(balances.stats.snapshot())
+
+    @list_route(permission_classes=(permissions.IsAdminUser,))
+    def keypool_stats(self, request):
+        context = keypool.stats.snapshot()
+        context['available'] = keypool.available()
+        return Response(context)
+
+    @staticmethod
+    def balance_context(address, eth_balance_wei, balance_int):
+        return {
             'address': address,
-            'eth_balance': eth_balance,
-            'balance': balance,
+            'eth_balance': Web3.fromWei(eth_balance_wei, 'ether'),
+            'balance': money.Amount(balance_int).fixed,
             'balance_int': balance_int
         }
-        return Response(context)
 
     @detail_route()
     def get_qrcode(self, request, pk=None):
         eth_account = get_object_or_404(EthAccount, address=pk)
-        address = pk
-        eth_qrcode = eth_account.qrcode
-
-        if not eth_qrcode:
-            # Generate QR code
-            img = qrcode.make(address)
-            file_name = address + '.png'
-            file_path = '/images/qrcode/' + file_name
-            img.save(settings.MEDIA_ROOT + file_path)
-            eth_account.qrcode = file_path
-            eth_account.save()
-            eth_qrcode = eth_account.qrcode
-
         context = {
-            'address': address,
-            'qrcode_url': eth_qrcode.url
+            'address': eth_account.address,
+            'qrcode_url': reverse('accounts:qrcode', args=[eth_account.address])
         }
         return Response(context)
 
-    @staticmethod
-    def load_abi(file_path):
-        """
-        :param str file_path:
-        :return dict: abi
-        """
-        artifact = open(file_path, 'r')
-        json_dict = json.load(artifact)
-        abi = json_dict['abi']
-        return abi
-
-
-class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
+
+class TransactionViewSet(ExportMixin, RowListMixin, viewsets.ReadOnlyModelViewSet):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = TransactionSerializer
+    row_serializer_class = TransactionRowSerializer
+    pagination_class = KeysetPagination
     filter_backends = (DjangoFilterBackend, filters.OrderingFilter)
-    filter_fields = ('from_address', 'to_address', 'amount', 'is_active', 'created_at')
+    filter_class = TransactionFilter
     ordering_fields = ('id', 'amount', 'created_at')
 
     def get_queryset(self):
-        address = self.request.user.account.address
-        return Transaction.objects.filter(Q(from_address=address) | Q(to_address=address))
+        # KeysetPagination は history_address の送金元と送金先のインデックスを UNION ALL で検索する
+        self.history_address = self.request.user.account.address
+        return history.involving(Transaction.objects.all(), self.history_address)
 
     @list_route(methods=['post'])
-    @transaction.atomic
+    @idempotent
     def transfer(self, request):
         from_account = request.user.account
 
@@ -129,18 +282,35 @@ class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
         body = json.loads(request.body)
         to_address = body['address']
         amount = body['amount']
-        if not (to_address and amount):
-            error_msg = 'アドレスまたは金額が入力されていません。'
-            print('Error:', error_msg)
+
+        # UTCoin 送金
+        result = ledger.transfer(from_account, to_address, amount)
+        if not result.success:
+            print('Error:', result.detail)
             context = {
                 'success': False,
-                'detail': error_msg
+                'detail': result.detail
             }
             return Response(context)
+        tx = result.transaction
 
-        # Validate address
-        if not self.is_ut_address(to_address):
-            error_msg = '無効なアドレスです。'
+        context = {
+            'success': True,
+            'transaction': TransactionSerializer(tx).data
+        }
+        return Response(context, status=status.HTTP_201_CREATED)
+
+    @list_route(methods=['post'])
+    @idempotent
+    def transfer_batch(self, request):
+        from_account = request.user.account
+        batch_size_max = 1000
+
+        # Receive params
+        body = json.loads(request.body)
+        transfers = body.get('transfers')
+        if not isinstance(transfers, list) or not transfers:
+            error_msg = '送金先が入力されていません。'
             print('Error:', error_msg)
             context = {
                 'success': False,
@@ -148,12 +318,8 @@ class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
             }
             return Response(context)
 
-        amount = Decimal(amount)
-        to_account = Account.objects.get(address=to_address)
-
-        # Validate amount
-        if from_account.balance < amount:
-            error_msg = '送金可能額を超えています。'
+        if len(transfers) > batch_size_max:
+            error_msg = f'一度に送金できるのは{batch_size_max}件までです。'
             print('Error:', error_msg)
             context = {
                 'success': False,
@@ -161,58 +327,33 @@ class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
             }
             return Response(context)
 
-        # UTCoin 送金
-        with transaction.atomic():
-            from_account.balance -= amount
-            to_account.balance += amount
-            from_account.save()
-            to_account.save()
-
-            # Create Transaction
-            tx = Transaction.objects.create(
-                from_address=from_account.address,
-                to_address=to_address,
-                amount=amount
-            )
-
-        # TODO: コントラクト実行
-        # try:
-        #     transfer_callback(tx_hash, from_address, to_address, amount_int, amount)
-        # except Exception as e:
-        #     print(e)
-        #     error_msg = 'コールバック処理に失敗しました。'
-        #     print('Error:', error_msg)
-        #
-        # else:
-        #     error_msg = 'アカウントのアンロックに失敗しました。'
-        #     print('Error:', error_msg)
-        #     context = {
-        #         'success': False,
-        #         'detail': error_msg
-        #     }
-        #     return Response(context)
+        # UTCoin 一括送金
+        results = []
+        for result in ledger.transfer_batch(from_account, transfers):
+            if result.success:
+                results.append({
+                    'success': True,
+                    'transaction': TransactionSerializer(result.transaction).data
+                })
+            else:
+                results.append({
+                    'success': False,
+                    'detail': result.detail
+                })
 
+        success = any(result['success'] for result in results)
         context = {
-            'success': True,
-            'transaction': TransactionSerializer(tx).data
+            'success': success,
+            'results': results
         }
-        return Response(context, status=status.HTTP_201_CREATED)
+        return Response(context, status=status.HTTP_201_CREATED if success else status.HTTP_200_OK)
 
-    @staticmethod
-    def is_ut_address(address):
-        """
-        :param str address:
-        :return bool:
-        """
-        if address[0:2] == 'UT' and len(address) == 42:
-            if Account.objects.filter(address=address).exists():
-                return True
-        return False
-
-
-class EthTransactionViewSet(viewsets.ReadOnlyModelViewSet):
+
+class EthTransactionViewSet(ExportMixin, RowListMixin, viewsets.ReadOnlyModelViewSet):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = EthTransactionSerializer
+    row_serializer_class = EthTransactionRowSerializer
+    pagination_class = KeysetPagination
     filter_backends = (DjangoFilterBackend, filters.OrderingFilter)
     filter_fields = (
         'tx_hash', 'from_address', 'to_address', 'amount', 'gas', 'gas_price', 'value', 'network_id', 'is_active',
@@ -221,17 +362,15 @@ class EthTransactionViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         eth_account = get_object_or_404(EthAccount, user=self.request.user)
-        address = eth_account.address
-        return EthTransaction.objects.filter(Q(from_address=address) | Q(to_address=address))
+        self.history_address = eth_account.address
+        return history.involving(EthTransaction.objects.all(), self.history_address)
 
     @list_route(methods=['post'])
-    @transaction.atomic
+    @idempotent
     def transfer(self, request):
         eth_account = get_object_or_404(EthAccount, user=request.user)
         from_address = eth_account.address
-        num_suffix = 1000
-        amount_min = 1 / num_suffix
-        fee = 0.001
+        fee = money.Amount(1)  # 0.001 UTC
 
         # Receive params
         body = json.loads(request.body)
@@ -246,12 +385,10 @@ class EthTransactionViewSet(viewsets.ReadOnlyModelViewSet):
             }
             return Response(context)
 
-        amount = float(amount)
-        amount_int = int(amount * num_suffix)
+        amount = money.parse(amount)
 
         # Validate address
-        w3 = Web3(HTTPProvider(settings.WEB3_PROVIDER))
-        if not w3.isAddress(to_address):
+        if not addresses.is_eth_address(to_address):
             error_msg = '無効なアドレスです。'
             print('Error:', error_msg)
             context = {
@@ -261,7 +398,7 @@ class EthTransactionViewSet(viewsets.ReadOnlyModelViewSet):
             return Response(context)
 
         # Validate amount
-        if amount < amount_min:
+        if amount is None or amount <= 0:
             error_msg = '金額が不正です。'
             print('Error:', error_msg)
             context = {
@@ -270,12 +407,15 @@ class EthTransactionViewSet(viewsets.ReadOnlyModelViewSet):
             }
             return Response(context)
 
-        # Get UTCoin balance
-        abi = self.load_abi(settings.ARTIFACT_PATH)
-        UTCoin = w3.eadth.contract(abi=abi, address=settings.UTCOIN_ADDRESS)
+        # Get UTCoin balance (送信待ちの送金を除く)
+        money.check_token_decimals()
+        UTCoin = chain.get_utcoin()
         balance = UTCoin.call().balanceOf(from_address)
+        pending = EthOutbox.objects.filter(from_address=from_address, status__in=[
+            EthOutbox.STATUS_QUEUED, EthOutbox.STATUS_SENDING, EthOutbox.STATUS_SENT
+        ]).aggregate(total=Sum('amount'))['total'] or 0
 
-        if balance < amount + fee:
+        if balance - pending < amount + fee:
             error_msg = '残高が不足しています。'
             print('Error:', error_msg)
             context = {
@@ -284,78 +424,41 @@ class EthTransactionViewSet(viewsets.ReadOnlyModelViewSet):
             }
             return Response(context)
 
-        # Transfer UTCoin
-        if w3.personal.unlockAccount(from_address, eth_account.password, duration=hex(300)):
-            try:
-                tx_hash = UTCoin.transact({'from': from_address}).transfer(to_address, amount_int)
-
-                # Create Transaction
-                transaction_info = w3.eth.getTransaction(tx_hash)
-                Transaction.objects.create(
-                    tx_hash=tx_hash,
-                    from_address=from_address,
-                    to_address=to_address,
-                    amount=amount_int,
-                    gas=transaction_info['gas'],
-                    gas_price=transaction_info['gasPrice'],
-                    value=transaction_info['value'],
-                    network_id=transaction_info['networkId']
-                )
-            except Exception as e:
-                print(e)
-                error_msg = 'トランザクションに失敗しました。'
-                print('Error:', error_msg)
-                context = {
-                    'success': False,
-                    'detail': error_msg
-                }
-                return Response(context)
-
-            # Execute callback function
-            try:
-                transfer_callback(tx_hash, from_address, to_address, amount_int, amount)
-            except Exception as e:
-                print(e)
-                error_msg = 'コールバック処理に失敗しました。'
-                print('Error:', error_msg)
-
-        else:
-            error_msg = 'アカウントのアンロックに失敗しました。'
-            print('Error:', error_msg)
-            context = {
-                'success': False,
-                'detail': error_msg
-            }
-            return Response(context)
+        # Transfer UTCoin (送信は process_eth_outbox が行う)
+        pending_transfer = outbox.enqueue(from_address, to_address, int(amount))
 
         context = {
             'success': True,
             'address': to_address,
-            'amount': amount,
-            'fee': fee,
-            'transaction': TransactionSerializer(transaction).data
+            'amount': amount.fixed,
+            'fee': fee.fixed,
+            'transfer': EthOutboxSerializer(pending_transfer).data
         }
-        return Response(context, status=status.HTTP_201_CREATED)
+        return Response(context, status=status.HTTP_202_ACCEPTED)
 
-    @staticmethod
-    def load_abi(file_path):
-        """
-        :param str file_path:
-        :return dict: abi
-        """
-        artifact = open(file_path, 'r')
-        json_dict = json.load(artifact)
-        abi = json_dict['abi']
-        return abi
-
-
-class ContractViewSet(viewsets.ModelViewSet):
+
+class EthOutboxViewSet(QueryAwareMixin, viewsets.ReadOnlyModelViewSet):
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = EthOutboxSerializer
+    # tx_hash
+    select_related = ('eth_transaction',)
+
+    def get_queryset(self):
+        # 鍵の割り当て待ちで EthAccount がなくても、UTアカウントからの送金は返す
+        condition = Q(account__user=self.request.user)
+        eth_address = EthAccount.objects.filter(user=self.request.user).values_list('address', flat=True).first()
+        if eth_address is not None:
+            condition |= Q(from_address=eth_address)
+        return EthOutbox.objects.filter(condition)
+
+
+class ContractViewSet(QueryAwareMixin, viewsets.ModelViewSet):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = ContractSerializer
     queryset = Contract.objects.all()
 
     def list(self, request):
-        queryset = Contract.objects.filter(user=self.request.user)
+        queryset = self.filter_queryset(Contract.objects.filter(user=self.request.user))
 
         page = self.paginate_queryset(queryset)
         if page is not None:
@@ -366,7 +469,7 @@ class ContractViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
     def retrieve(self, request, pk=None):
-        queryset = Contract.objects.all()
+        queryset = self.with_related(Contract.objects.all())
         contract = get_object_or_404(queryset, address=pk)
         serializer = ContractSerializer(contract)
         return Response(serializer.data)
@@ -0,0 +1,230 @@
+"""
+Process-wide Ethereum client
+
+Web3 インスタンス、UTCoin の ABI とコントラクトオブジェクトをプロセス内で共有する。
+HTTP 接続は keep-alive のコネクションプールを使い回し、JSON-RPC 呼び出しごとの
+レイテンシを RPCMetrics に記録する。
+"""
+import json
+import threading
+import time
+
+import requests
+from django.conf import settings
+from web3 import Web3, HTTPProvider
+from web3.middleware import attrdict_middleware, pythonic_middleware
+
+from . import profiling
+
+
+class RPCMetrics:
+    """
+    JSON-RPC メソッドごとの呼び出し回数とレイテンシ (秒)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def record(self, method, elapsed, error=False):
+        with self._lock:
+            entry = self._methods.get(method)
+            if entry is None:
+                entry = self._methods[method] = {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0}
+            entry['count'] += 1
+            entry['total'] += elapsed
+            if elapsed > entry['max']:
+                entry['max'] = elapsed
+            if error:
+                entry['errors'] += 1
+        profiling.record_rpc(elapsed)
+
+    def snapshot(self):
+        """
+        :return dict: {method: {'count', 'errors', 'total', 'max', 'mean'}}
+        """
+        with self._lock:
+            return {
+                method: dict(entry, mean=entry['total'] / entry['count'])
+                for method, entry in self._methods.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._methods.clear()
+
+
+metrics = RPCMetrics()
+
+
+def metrics_middleware(make_request, web3):
+    """
+    JSON-RPC 呼び出しのレイテンシを metrics に記録する web3 middleware
+    """
+    def middleware(method, params):
+        start = time.perf_counter()
+        error = True
+        try:
+            response = make_request(method, params)
+            error = 'error' in response
+            return response
+        finally:
+            metrics.record(method, time.perf_counter() - start, error=error)
+    return middleware
+
+
+class PooledHTTPProvider(HTTPProvider):
+    """
+    keep-alive のコネクションプールを持つ HTTPProvider
+    """
+
+    def __init__(self, endpoint_uri, pool_size=10, timeout=10):
+        super(PooledHTTPProvider, self).__init__(endpoint_uri, request_kwargs={'timeout': timeout})
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        response = self.session.post(self.endpoint_uri, data=request_data, **self.get_request_kwargs())
+        response.raise_for_status()
+        return self.decode_rpc_response(response.content)
+
+    def make_batch_request(self, calls):
+        """
+        複数の JSON-RPC 呼び出しを1回の HTTP リクエストで送信
+        :param list calls: [(method, params), ...]
+        :return list: calls と同じ順序のレスポンス
+        """
+        first_id = next(self.request_counter)
+        payload = [
+            {'jsonrpc': '2.0', 'method': method, 'params': params or [], 'id': first_id + i}
+            for i, (method, params) in enumerate(calls)
+        ]
+        response = self.session.post(self.endpoint_uri, data=json.dumps(payload), **self.get_request_kwargs())
+        response.raise_for_status()
+        responses = {item.get('id'): item for item in self.decode_rpc_response(response.content)}
+        return [responses.get(first_id + i, {'error': 'no response'}) for i in range(len(calls))]
+
+
+_lock = threading.RLock()
+_provider = None
+_web3 = None
+_abi = None
+_utcoin = None
+_decimals = None
+
+
+def configure(provider=None):
+    """
+    使用する provider を差し替え、キャッシュを破棄する (テスト・ベンチマーク用)
+    :param provider: None の場合は settings.WEB3_PROVIDER に接続する
+    """
+    global _provider, _web3, _utcoin, _decimals
+    with _lock:
+        _provider = provider
+        _web3 = None
+        _utcoin = None
+        _decimals = None
+
+
+def get_web3():
+    """
+    :return Web3: プロセス内で共有する Web3 インスタンス
+    """
+    global _web3
+    if _web3 is None:
+        with _lock:
+            if _web3 is None:
+                provider = _provider or PooledHTTPProvider(
+                    settings.WEB3_PROVIDER,
+                    pool_size=settings.WEB3_POOL_SIZE,
+                    timeout=settings.WEB3_TIMEOUT
+                )
+                _web3 = Web3(provider, middlewares=[metrics_middleware, attrdict_middleware, pythonic_middleware])
+    return _web3
+
+
+def batch_request(calls):
+    """
+    複数の JSON-RPC 呼び出しをまとめて実行 (結果は整形されない生の JSON-RPC レスポンス)
+
+    バッチに対応していない provider (eth-tester など) では1件ずつ呼び出す。
+    :param list calls: [(method, params), ...]
+    :return list: [{'result': ...} or {'error': ...}, ...]
+    """
+    if not calls:
+        return []
+    web3 = get_web3()
+    provider = web3.providers[0]
+    start = time.perf_counter()
+    error = True
+    try:
+        if hasattr(provider, 'make_batch_request'):
+            responses = provider.make_batch_request(calls)
+        else:
+            request_func = provider.request_func(web3, ())
+            responses = [request_func(method, params) for method, params in calls]
+        error = any('error' in response for response in responses)
+        return responses
+    finally:
+        metrics.record('batch', time.perf_counter() - start, error=error)
+
+
+def to_int(value):
+    """
+    JSON-RPC の数値 (16進数文字列) を int に変換
+    :param value: str, int or None
+    :return int:
+    """
+    if value is None or isinstance(value, int):
+        return value
+    return int(value, 16)
+
+
+def to_hex(value):
+    """
+    :param value: str or bytes
+    :return str: 0x から始まる16進数文字列
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return '0x' + bytes(value).hex()
+    return value
+
+
+def load_abi():
+    """
+    :return list: UTCoin の ABI (初回のみ settings.ARTIFACT_PATH を読み込む)
+    """
+    global _abi
+    if _abi is None:
+        with _lock:
+            if _abi is None:
+                with open(settings.ARTIFACT_PATH, 'r') as artifact:
+                    _abi = json.load(artifact)['abi']
+    return _abi
+
+
+def get_utcoin():
+    """
+    :return: プロセス内で共有する UTCoin コントラクト
+    """
+    global _utcoin
+    if _utcoin is None:
+        with _lock:
+            if _utcoin is None:
+                _utcoin = get_web3().eth.contract(abi=load_abi(), address=settings.UTCOIN_ADDRESS)
+    return _utcoin
+
+
+def get_decimals():
+    """
+    :return int: UTCoin の decimals (初回のみコントラクトに問い合わせる)
+    """
+    global _decimals
+    if _decimals is None:
+        with _lock:
+            if _decimals is None:
+                _decimals = get_utcoin().call().decimals()
+    return _decimals
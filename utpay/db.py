@@ -0,0 +1,12 @@
+from django.db import connections
+
+
+def skip_locked(queryset):
+    """
+    他のトランザクションがロック中の行を飛ばして select_for_update
+    (SKIP LOCKED に対応していないバックエンドではロック待ちする)
+    :param QuerySet queryset:
+    :return QuerySet:
+    """
+    features = connections[queryset.db].features
+    return queryset.select_for_update(skip_locked=features.has_select_for_update_skip_locked)
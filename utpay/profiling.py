@@ -0,0 +1,268 @@
+"""
+Request profiling
+
+ProfilingMiddleware がビューごとの処理時間、DB クエリの回数と時間、JSON-RPC の呼び出し回数と
+時間をプロセス内の HDR 形式のヒストグラムに集計し、Prometheus のテキスト形式で出力する。
+計測するリクエストは PROFILING_SAMPLE_RATE の割合で抽出する (リクエスト数は全件数える)。
+DB クエリは connection.execute_wrapper、JSON-RPC は chain.RPCMetrics から record_rpc で記録する。
+"""
+import random
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+# 2のべき乗ごとのバケット数 (2 ** SUB_BUCKET_BITS)、相対誤差は 1 / 2 ** (SUB_BUCKET_BITS - 1) 以内
+SUB_BUCKET_BITS = 5
+
+# Prometheus に出力するバケットの上限 (秒、回)
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """
+    HDR 形式のヒストグラム (0 以上の整数。時間はマイクロ秒で記録する)
+
+    小さい値はそのまま、それ以外は2のべき乗ごとに 2 ** SUB_BUCKET_BITS 個の等幅のバケットに数えるため、
+    値の範囲に関わらずバケット数は少なく、記録は O(1) で済む。
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def index(value):
+        shift = value.bit_length() - SUB_BUCKET_BITS
+        if shift <= 0:
+            return value
+        return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+    @staticmethod
+    def bounds(index):
+        """
+        :return tuple: バケットに含まれる値の (最小値, 最大値)
+        """
+        shift = index >> SUB_BUCKET_BITS
+        if shift == 0:
+            return index, index
+        mantissa = index & ((1 << SUB_BUCKET_BITS) - 1)
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def record(self, value):
+        value = max(0, int(value))
+        i = self.index(value)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        :param float p: 0 - 100
+        :return int: p パーセンタイルの値 (バケットの最大値)
+        """
+        if not self.count:
+            return 0
+        rank = max(1, -(-self.count * p // 100))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(self.bounds(i)[1], self.max)
+        return self.max
+
+    def cumulative(self, limits):
+        """
+        :param iterable limits: バケットの上限 (昇順)
+        :return list: 各上限以下の件数 (上限をまたぐバケットは最大値で判定する)
+        """
+        indexes = sorted(self.counts)
+        result = []
+        seen = 0
+        position = 0
+        for limit in limits:
+            while position < len(indexes) and self.bounds(indexes[position])[1] <= limit:
+                seen += self.counts[indexes[position]]
+                position += 1
+            result.append(seen)
+        return result
+
+
+class Sample:
+    """
+    計測中のリクエストの DB クエリと JSON-RPC 呼び出し
+    """
+    __slots__ = ('db_queries', 'db_time', 'rpc_calls', 'rpc_time')
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.rpc_calls = 0
+        self.rpc_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_queries += 1
+            self.db_time += time.perf_counter() - start
+
+
+# (メトリクス名, 説明, 単位が秒かどうか)
+METRICS = (
+    ('utpay_request_duration_seconds', 'Wall time of sampled requests.', True),
+    ('utpay_request_db_queries', 'Database queries per sampled request.', False),
+    ('utpay_request_db_duration_seconds', 'Database time per sampled request.', True),
+    ('utpay_request_rpc_calls', 'JSON-RPC round trips per sampled request.', False),
+    ('utpay_request_rpc_duration_seconds', 'JSON-RPC time per sampled request.', True),
+)
+
+
+class Registry:
+    """
+    (ビュー, HTTP メソッド) ごとのヒストグラムとリクエスト数
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def count(self, view, method, status):
+        key = (view, method, status)
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def record(self, view, method, elapsed, sample):
+        values = (
+            elapsed * 1000000, sample.db_queries, sample.db_time * 1000000, sample.rpc_calls,
+            sample.rpc_time * 1000000,
+        )
+        with self._lock:
+            histograms = self.histograms.get((view, method))
+            if histograms is None:
+                histograms = self.histograms[(view, method)] = [Histogram() for _ in METRICS]
+            for histogram, value in zip(histograms, values):
+                histogram.record(value)
+
+    def snapshot(self):
+        """
+        :return dict: {(view, method): {メトリクス名: {'count', 'p50', 'p99', 'max'}}} (時間は秒)
+        """
+        with self._lock:
+            return {
+                key: {
+                    name: {
+                        'count': histogram.count,
+                        'p50': histogram.percentile(50) / (1000000 if seconds else 1),
+                        'p99': histogram.percentile(99) / (1000000 if seconds else 1),
+                        'max': histogram.max / (1000000 if seconds else 1),
+                    }
+                    for (name, _, seconds), histogram in zip(METRICS, histograms)
+                }
+                for key, histograms in self.histograms.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+            self.histograms = {}
+
+    def render(self):
+        """
+        :return str: Prometheus のテキスト形式 (0.0.4)
+        """
+        lines = [
+            '# HELP utpay_profile_sample_rate Fraction of requests recorded in the utpay_request_* histograms.',
+            '# TYPE utpay_profile_sample_rate gauge',
+            f'utpay_profile_sample_rate {float(settings.PROFILING_SAMPLE_RATE)}',
+            '# HELP utpay_requests_total Requests by view, method and status (not sampled).',
+            '# TYPE utpay_requests_total counter',
+        ]
+        with self._lock:
+            for (view, method, status), count in sorted(self.requests.items()):
+                lines.append(f'utpay_requests_total{{{labels(view=view, method=method, status=status)}}} {count}')
+
+            for i, (name, help_text, seconds) in enumerate(METRICS):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                limits = SECONDS_BUCKETS if seconds else COUNT_BUCKETS
+                scale = 1000000 if seconds else 1
+                for (view, method), histograms in sorted(self.histograms.items()):
+                    histogram = histograms[i]
+                    label = labels(view=view, method=method)
+                    cumulative = histogram.cumulative([limit * scale for limit in limits])
+                    for limit, count in zip(limits, cumulative):
+                        lines.append(f'{name}_bucket{{{label},le="{limit}"}} {count}')
+                    lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{{label}}} {histogram.total / scale if seconds else histogram.total}')
+                    lines.append(f'{name}_count{{{label}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+_local = threading.local()
+
+
+def labels(**values):
+    return ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in values.items()
+    )
+
+
+def record_rpc(elapsed):
+    """
+    計測中のリクエストの JSON-RPC 呼び出しを記録 (chain.RPCMetrics から呼び出す)
+    :param float elapsed: 秒
+    """
+    sample = getattr(_local, 'sample', None)
+    if sample is not None:
+        sample.rpc_calls += 1
+        sample.rpc_time += elapsed
+
+
+class ProfilingMiddleware:
+    """
+    ビューごとの処理時間・DB クエリ・JSON-RPC 呼び出しを registry に記録する
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.PROFILING_SAMPLE_RATE:
+            response = self.get_response(request)
+            registry.count(view_name(request), request.method, response.status_code)
+            return response
+
+        sample = _local.sample = Sample()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(sample))
+                response = self.get_response(request)
+        finally:
+            _local.sample = None
+        elapsed = time.perf_counter() - start
+
+        view = view_name(request)
+        registry.count(view, request.method, response.status_code)
+        registry.record(view, request.method, elapsed, sample)
+        return response
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    return match.view_name or match.func.__name__
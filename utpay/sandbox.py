@@ -0,0 +1,293 @@
+"""
+Sandboxed execution of untrusted Python code
+
+コードは親プロセスでコンパイルして marshal したバイト列で受け渡し、起動済みのワーカープロセスで
+制限した builtins のもとで実行する。ワーカーには CPU 時間 (RLIMIT_CPU)・メモリ (RLIMIT_AS)・
+実行時間 (SIGALRM) の上限をかけ、応答しなくなったワーカーは親プロセスが強制終了して起動し直す。
+builtins を制限するだけでは内部オブジェクトをたどって抜け出せるため、import と
+アンダースコアやフレーム・コードオブジェクトの属性へのアクセスはコンパイル時に拒否する
+(str.format は書式の中で属性をたどれるため、format と format_map も拒否する)。
+コードに渡す print は、__globals__ に組み込み関数しか含まない名前空間で定義する。
+ワーカーは Django を読み込まない forkserver から起動する。
+"""
+import ast
+import builtins
+import io
+import marshal
+import math
+import multiprocessing
+import os
+import queue
+import resource
+import signal
+import time
+from typing import NamedTuple
+
+SAFE_BUILTIN_NAMES = (
+    'abs', 'all', 'any', 'bool', 'dict', 'divmod', 'enumerate', 'filter', 'float', 'frozenset', 'int', 'isinstance',
+    'len', 'list', 'map', 'max', 'min', 'pow', 'range', 'repr', 'reversed', 'round', 'set', 'sorted', 'str', 'sum',
+    'tuple', 'zip',
+    'Exception', 'ArithmeticError', 'IndexError', 'KeyError', 'LookupError', 'TypeError', 'ValueError',
+    'ZeroDivisionError',
+)
+SAFE_BUILTINS = {name: getattr(builtins, name) for name in SAFE_BUILTIN_NAMES}
+
+# フレーム・ジェネレータ・コードオブジェクト・トレースバックの属性 (呼び出し元の globals にたどり着ける)
+FORBIDDEN_ATTRIBUTE_PREFIXES = ('_', 'f_', 'gi_', 'cr_', 'ag_', 'co_', 'tb_')
+
+# 実行時に任意の属性をたどれる属性 ("{0.__globals__}".format(f))
+FORBIDDEN_ATTRIBUTES = ('format', 'format_map')
+
+# コードに渡す print (sandbox モジュールの globals にたどり着けないよう make_print で定義する)
+PRINT_SOURCE = """
+def print(*args, sep=' ', end='\\n'):
+    write(sep.join(map(str, args)) + end)
+"""
+
+# 返す出力 (print) の最大文字数
+MAX_OUTPUT = 4096
+
+# ワーカー内でキャッシュするコードオブジェクトの数
+CODE_CACHE_SIZE = 256
+
+
+class CodeError(ValueError):
+    """
+    コンパイルできない、または使用できない構文を含むコード
+    """
+
+
+class CPUTimeExceeded(BaseException):
+    pass
+
+
+class WallTimeExceeded(BaseException):
+    pass
+
+
+class Limits(NamedTuple):
+    """
+    1回の実行あたりの上限
+    """
+    cpu_time: int = 1
+    memory: int = 64 * 1024 * 1024
+    wall_time: float = 2.0
+
+
+class Result(NamedTuple):
+    """
+    実行結果
+    """
+    success: bool
+    detail: str = ''
+    output: str = ''
+    elapsed: float = 0.0
+
+
+def find_problems(tree):
+    """
+    使用できない構文
+    :param ast.AST tree:
+    :return list: エラーメッセージ
+    """
+    problems = []
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            problems.append(f'{node.lineno}行目: import は使用できません。')
+        elif isinstance(node, ast.Attribute) and (node.attr.startswith(FORBIDDEN_ATTRIBUTE_PREFIXES) or
+                                                  node.attr in FORBIDDEN_ATTRIBUTES):
+            problems.append(f'{node.lineno}行目: 属性 {node.attr} は使用できません。')
+        elif isinstance(node, ast.Name) and node.id.startswith('__'):
+            problems.append(f'{node.lineno}行目: 名前 {node.id} は使用できません。')
+    return problems
+
+
+def check(tree):
+    """
+    使用できない構文が含まれていれば CodeError
+    :param ast.AST tree:
+    """
+    problems = find_problems(tree)
+    if problems:
+        raise CodeError(problems[0])
+
+
+def compile_code(source, filename='<sandbox>'):
+    """
+    コードを検査してコンパイル
+    :param str source:
+    :param str filename:
+    :return bytes: marshal したコードオブジェクト
+    """
+    try:
+        tree = ast.parse(source, filename, 'exec')
+    except SyntaxError as e:
+        raise CodeError(f'{e.lineno}行目: {e.msg}')
+    check(tree)
+    return marshal.dumps(compile(tree, filename, 'exec'))
+
+
+def make_print(write):
+    """
+    :param write: 出力先 (io.StringIO.write)
+    :return function: __globals__ が map, str, write だけの print
+    """
+    namespace = {'__builtins__': {}, 'map': map, 'str': str, 'write': write}
+    exec(PRINT_SOURCE, namespace)
+    return namespace['print']
+
+
+def _raise(exception):
+    def handler(signum, frame):
+        raise exception()
+    return handler
+
+
+def _set_cpu_limit(seconds):
+    """
+    このプロセスの CPU 時間の上限を、これまでの使用時間 + seconds にする (None の場合は解除)
+    """
+    hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    if seconds is None:
+        soft = hard
+    else:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft = math.ceil(usage.ru_utime + usage.ru_stime) + seconds
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _set_memory_limit(memory):
+    """
+    このプロセスの仮想メモリの上限を、起動時の使用量 + memory にする
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            base = int(f.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        base = 0
+    hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+    soft = base + memory
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+def _execute(codes, limits, key, code, variables):
+    """
+    ワーカー内でコードを実行
+    :return tuple: Result のフィールド
+    """
+    code_object = codes.get(key)
+    if code_object is None:
+        if len(codes) >= CODE_CACHE_SIZE:
+            codes.clear()
+        code_object = codes[key] = marshal.loads(code)
+
+    output = io.StringIO()
+    namespace = dict(variables, __builtins__=dict(SAFE_BUILTINS, print=make_print(output.write)))
+    start = time.perf_counter()
+    try:
+        _set_cpu_limit(limits.cpu_time)
+        signal.setitimer(signal.ITIMER_REAL, limits.wall_time)
+        exec(code_object, namespace)
+        success, detail = True, ''
+    except CPUTimeExceeded:
+        success, detail = False, 'CPU 時間の上限を超えました。'
+    except WallTimeExceeded:
+        success, detail = False, '実行時間の上限を超えました。'
+    except MemoryError:
+        success, detail = False, 'メモリの上限を超えました。'
+    except Exception as e:
+        success, detail = False, f'{type(e).__name__}: {e}'
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        _set_cpu_limit(None)
+    return success, detail, output.getvalue()[:MAX_OUTPUT], time.perf_counter() - start
+
+
+def _serve(conn, limits):
+    """
+    ワーカープロセスのメインループ
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGXCPU, _raise(CPUTimeExceeded))
+    signal.signal(signal.SIGALRM, _raise(WallTimeExceeded))
+    _set_memory_limit(limits.memory)
+    codes = {}
+    while True:
+        try:
+            key, code, variables = conn.recv()
+        except EOFError:
+            return
+        conn.send(_execute(codes, limits, key, code, variables))
+
+
+class _Worker:
+    def __init__(self, context, limits):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_conn, limits), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        try:
+            os.kill(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.join()
+        self.conn.close()
+
+
+class Sandbox:
+    """
+    起動済みのワーカープロセスのプール (スレッドセーフ)
+    """
+
+    # 実行時間の上限を超えてから、ワーカーを強制終了するまでの猶予 (秒)
+    grace = 1.0
+
+    def __init__(self, workers, limits=Limits()):
+        self.limits = limits
+        self.restarts = 0
+        self._context = multiprocessing.get_context('forkserver')
+        self._context.set_forkserver_preload([__name__])
+        self._idle = queue.Queue()
+        for _ in range(workers):
+            self._idle.put(_Worker(self._context, limits))
+
+    def run(self, key, code, variables):
+        """
+        空いているワーカーでコードを実行 (空くまで待つ)
+        :param key: コードを識別するキー (同じキーのコードはワーカー内でキャッシュされる)
+        :param bytes code: compile_code の戻り値
+        :param dict variables: グローバル変数 (pickle できる値)
+        :return Result:
+        """
+        worker = self._idle.get()
+        try:
+            try:
+                worker.conn.send((key, code, variables))
+                if worker.conn.poll(self.limits.wall_time + self.grace):
+                    return Result(*worker.conn.recv())
+                detail = '実行時間の上限を超えました。'
+            except (EOFError, OSError):
+                detail = 'ワーカープロセスが終了しました。'
+            worker.kill()
+            worker = _Worker(self._context, self.limits)
+            self.restarts += 1
+            return Result(False, detail)
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        """
+        実行中でないワーカーを終了
+        """
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            worker.kill()
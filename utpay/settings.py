@@ -48,6 +48,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # ビューごとの処理時間・DB クエリ・JSON-RPC 呼び出しの計測 (/api/v1/metrics/)
+    'utpay.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -90,6 +92,18 @@ LOGIN_REDIRECT_URL = 'accounts:mypage'
 # Load DATABASES from local_settings.py
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+
+# プロセス内のキャッシュ。キャッシュの破棄をワーカーと Web のプロセス間で共有する場合は
+# local_settings.py で memcached や FileBasedCache などを設定する
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -134,6 +148,10 @@ STATICFILES_DIRS = (
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# QRコードのディスクキャッシュ、プロセス内にキャッシュする件数
+QRCODE_CACHE_DIR = os.path.join(MEDIA_ROOT, 'cache', 'qrcode')
+QRCODE_LRU_SIZE = 1000
+
 
 MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
 
@@ -172,12 +190,51 @@ JWT_AUTH = {
 # django-cors-headers
 CORS_ORIGIN_ALLOW_ALL = True
 
+# ProfilingMiddleware で計測するリクエストの割合 (0 - 1)
+PROFILING_SAMPLE_RATE = 0.1
+
+# Idempotency-Key を付けた送金のレスポンスを保存する期間 (秒)、プロセス内にキャッシュする件数
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+IDEMPOTENCY_CACHE_SIZE = 10000
+
+
+# Ledger
+
+# UTアドレスの存在確認キャッシュ (件数, 存在しないアドレスの保持秒数)
+UT_ADDRESS_CACHE_SIZE = 100000
+UT_ADDRESS_CACHE_TTL = 60
+
+# マイページ・送金フォーム・アカウント API の読み取りモデル (直近の送金の件数, キャッシュの保持秒数)
+ACTIVITY_RECENT_SIZE = 10
+ACTIVITY_CACHE_TTL = 5 * 60
+
+# 1アドレスあたり何件の Posting ごとに残高のチェックポイントを作成するか
+LEDGER_CHECKPOINT_INTERVAL = 1000
+
+# 作成から何秒経過した Posting をチェックポイントの集計対象にするか (未コミットの取りこぼし防止)
+LEDGER_SETTLE_SECONDS = 60
+
 
 # Ethereum
 
 # web3 provider
 WEB3_PROVIDER = 'http://localhost:8545' # development
 
+# keep-alive connections kept per process, request timeout (seconds)
+WEB3_POOL_SIZE = 10
+WEB3_TIMEOUT = 10
+
+# トランザクションを確定とみなすブロック数 (これより浅い reorg に追従する)
+ETH_CONFIRMATIONS = 12
+
+# ETH / UTCoin 残高のキャッシュ (秒)
+ETH_BALANCE_CACHE_TTL = 30
+
+# 事前に生成しておく鍵の数、補充を始める残り数、1回のタスクで生成する数
+KEYPOOL_SIZE = 100
+KEYPOOL_LOW_WATERMARK = 20
+KEYPOOL_REFILL_BATCH = 10
+
 # Contract settings
 ARTIFACT_PATH = 'static/contracts/UTCoin.json'
 
@@ -185,6 +242,31 @@ ARTIFACT_PATH = 'static/contracts/UTCoin.json'
 # UTCOIN_ADDRESS = '0xb899ca31b7008c16e7779d399dc1c42c2bae75fc' # Ropsten
 UTCOIN_ADDRESS = '0x345ca3e014aaf5dca488057592ee47305d9b3e10' # Truffle
 
+# Transfer イベントの取り込みを開始するブロック (コントラクトのデプロイ時のブロック)
+UTCOIN_START_BLOCK = 0
+
+
+# User contracts
+
+# コントラクトを実行するワーカープロセス数
+CONTRACT_WORKERS = 4
+
+# 1回の実行あたりの CPU 時間 (秒)、メモリ (バイト)、実行時間 (秒) の上限
+CONTRACT_CPU_TIME = 1
+CONTRACT_MEMORY = 64 * 1024 * 1024
+CONTRACT_WALL_TIME = 2.0
+
+# 登録されたコードの計算量の見積もりと文字数の上限、解析結果のキャッシュ (秒)
+CONTRACT_COMPLEXITY_BUDGET = 10000
+CONTRACT_MAX_CODE_LENGTH = 10000
+CONTRACT_ANALYSIS_CACHE_TTL = 60 * 60 * 24
+
+# 作成から何秒経過した TransferEvent をコントラクトに配信するか (未コミットの取りこぼし防止)
+EVENT_SETTLE_SECONDS = 5
+
+# ディスパッチャがコントラクトへの配信を独占する期間 (秒、配信ごとに延長する)
+EVENT_LEASE_SECONDS = 60
+
 
 # Load all local settings
 try:
@@ -0,0 +1,155 @@
+import marshal
+import random
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from eth_tester import EthereumTester
+from rest_framework.test import APIClient
+from web3.providers.eth_tester import EthereumTesterProvider
+
+from . import chain, profiling, sandbox
+
+
+class ChainClientTests(SimpleTestCase):
+    def setUp(self):
+        self.tester = EthereumTester()
+        chain.configure(EthereumTesterProvider(self.tester))
+        chain.metrics.reset()
+
+    def tearDown(self):
+        chain.configure(None)
+
+    def test_web3_is_shared(self):
+        self.assertIs(chain.get_web3(), chain.get_web3())
+        self.assertIs(chain.load_abi(), chain.load_abi())
+        self.assertIs(chain.get_utcoin(), chain.get_utcoin())
+
+    def test_metrics(self):
+        address = self.tester.get_accounts()[0]
+        chain.get_web3().eth.getBalance(address)
+        chain.get_web3().eth.getBalance(address)
+        entry = chain.metrics.snapshot()['eth_getBalance']
+        self.assertEqual(entry['count'], 2)
+        self.assertEqual(entry['errors'], 0)
+
+
+class SandboxTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.sandbox = sandbox.Sandbox(1, sandbox.Limits(cpu_time=1, memory=32 * 1024 * 1024, wall_time=0.5))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sandbox.close()
+        super().tearDownClass()
+
+    def run_code(self, source, **variables):
+        return self.sandbox.run(source, sandbox.compile_code(source), variables)
+
+    def test_run(self):
+        result = self.run_code('print(amount * 2, sum(range(4)))', amount=5)
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, '10 6\n')
+
+        result = self.run_code('open("/etc/passwd")')
+        self.assertFalse(result.success)
+        self.assertIn('NameError', result.detail)
+
+    def test_compile_rejects(self):
+        for source in ('import os', '().__class__', 'g = (i for i in [1])\ng.gi_frame', '__import__("os")',
+                       'def f(:'):
+            with self.assertRaises(sandbox.CodeError):
+                sandbox.compile_code(source)
+
+    def test_format_escape(self):
+        # str.format は書式の中でアンダースコアの属性をたどれる
+        for source in ('print("{0.__globals__[os].environ}".format(print))', 'str.format("{0.__globals__}", print)',
+                       '"{x.__globals__}".format_map({"x": print})'):
+            with self.assertRaises(sandbox.CodeError):
+                sandbox.compile_code(source)
+
+        # 検査を通さないコードでも、print の __globals__ から os にはたどり着けない
+        source = 'print(sorted(print.__globals__), "{0.__globals__}".format(print).count("\'os\'"))'
+        result = self.sandbox.run(source, marshal.dumps(compile(source, '<test>', 'exec')), {})
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, "['__builtins__', 'map', 'print', 'str', 'write'] 0\n")
+        self.assertEqual(self.run_code('print(1, 2, sep="-", end="!")').output, '1-2!')
+
+    def test_limits(self):
+        result = self.run_code('x = "a" * (10 ** 9)')
+        self.assertEqual(result.detail, 'メモリの上限を超えました。')
+
+        # 上限の例外を握りつぶすコードはワーカーごと終了し、起動し直す
+        restarts = self.sandbox.restarts
+        result = self.run_code('while True:\n    try:\n        while True:\n            pass\n    except:\n        pass')
+        self.assertEqual(result.detail, '実行時間の上限を超えました。')
+        self.assertEqual(self.sandbox.restarts, restarts + 1)
+        self.assertTrue(self.run_code('pass').success)
+
+
+class HistogramTests(SimpleTestCase):
+    def test_relative_error(self):
+        histogram = profiling.Histogram()
+        values = [random.randrange(10 ** 7) for _ in range(1000)] + [0, 1, 31, 32, 33]
+        for value in values:
+            histogram.record(value)
+            low, high = histogram.bounds(histogram.index(value))
+            self.assertTrue(low <= value <= high)
+            self.assertLessEqual(high - low, value / 2 ** (profiling.SUB_BUCKET_BITS - 1))
+
+        values.sort()
+        for p in (50, 90, 99, 100):
+            exact = values[max(0, -(-len(values) * p // 100) - 1)]
+            self.assertTrue(exact <= histogram.percentile(p) <= exact * 1.0625)
+        self.assertEqual(histogram.cumulative([-1, 31, 10 ** 8]), [0, sum(v <= 31 for v in values), len(values)])
+
+
+@override_settings(PROFILING_SAMPLE_RATE=1.0)
+class ProfilingMiddlewareTests(TestCase):
+    def setUp(self):
+        profiling.registry.reset()
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_record_view(self):
+        self.client.get('/api/v1/users/')
+        stats = profiling.registry.snapshot()[('api:user-list', 'GET')]
+        self.assertEqual(stats['utpay_request_duration_seconds']['count'], 1)
+        self.assertGreater(stats['utpay_request_duration_seconds']['max'], 0)
+        self.assertGreaterEqual(stats['utpay_request_db_queries']['max'], 1)
+        self.assertEqual(stats['utpay_request_rpc_calls']['max'], 0)
+
+        with override_settings(PROFILING_SAMPLE_RATE=0):
+            self.client.get('/api/v1/users/')
+        self.assertEqual(profiling.registry.snapshot()[('api:user-list', 'GET')]
+                         ['utpay_request_duration_seconds']['count'], 1)
+        self.assertEqual(profiling.registry.requests[('api:user-list', 'GET', 200)], 2)
+
+    def test_record_rpc(self):
+        tester = EthereumTester()
+        chain.configure(EthereumTesterProvider(tester))
+        try:
+            sample = profiling._local.sample = profiling.Sample()
+            chain.get_web3().eth.getBalance(tester.get_accounts()[0])
+            chain.batch_request([('eth_blockNumber', [])])
+        finally:
+            profiling._local.sample = None
+            chain.configure(None)
+        self.assertEqual(sample.rpc_calls, 2)
+
+    def test_metrics_endpoint(self):
+        self.client.get('/api/v1/users/')
+        self.assertEqual(self.client.get('/api/v1/metrics/').status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get('/api/v1/metrics/')
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        body = response.content.decode()
+        self.assertIn('# TYPE utpay_request_duration_seconds histogram', body)
+        self.assertIn('utpay_request_duration_seconds_count{view="api:user-list",method="GET"} 1', body)
+        self.assertIn('utpay_request_db_queries_bucket{view="api:user-list",method="GET",le="+Inf"} 1', body)
+        self.assertIn('utpay_request_db_queries_sum{view="api:user-list",method="GET"} 2', body)
+        self.assertIn('utpay_requests_total{view="api:metrics",method="GET",status="403"} 1', body)
@@ -1,11 +1,23 @@
-import json
-
 from django import forms
-from django.conf import settings
 from django.core.exceptions import ValidationError
-from web3 import Web3, HTTPProvider
 
-from accounts.models import Account
+from accounts import addresses, money
+from accounts.models import Account, EthAccount
+
+
+class AmountField(forms.CharField):
+    """
+    UTC の金額を最小単位 (money.Amount) で返す
+    """
+
+    def to_python(self, value):
+        value = super(AmountField, self).to_python(value)
+        if value in self.empty_values:
+            return None
+        amount = money.parse(value)
+        if amount is None or amount <= 0:
+            raise ValidationError('金額が不正です。')
+        return amount
 
 
 class TransferForm(forms.Form):
@@ -15,19 +27,17 @@ class TransferForm(forms.Form):
         help_text='例) UT... or 0x...',
         widget=forms.TextInput(attrs={'class': 'mdl-textfield__input'}),
     )
-    amount = forms.FloatField(
+    amount = AmountField(
         label='金額 (UTC)',
-        min_value=0.001,
         help_text='例) 10.123',
         widget=forms.NumberInput(attrs={'class': 'mdl-textfield__input', 'step': '0.001'}),
     )
-    fee = forms.FloatField(
+    fee = forms.CharField(
         label='手数料 (UTC)',
         widget=forms.TextInput(attrs={'class': 'mdl-textfield__input', 'readonly': 'readonly'}),
     )
-    balance = forms.FloatField(
+    balance = forms.CharField(
         label='送金可能額 (UTC)',
-        min_value=0,
         widget=forms.TextInput(attrs={'class': 'mdl-textfield__input', 'readonly': 'readonly'}),
     )
     password = forms.CharField(
@@ -54,12 +64,17 @@ class TransferForm(forms.Form):
         if address is None:
             raise ValidationError('アドレスを入力してください。')
 
-        web3 = Web3(HTTPProvider(settings.WEB3_PROVIDER))
-        if self.is_ut_address(address):
-            if address != self.user.account.address:
+        # 形式が不正な場合は DB に問い合わせない
+        address_type = addresses.address_type(address)
+        if address_type == addresses.UT:
+            if address != self.user.account.address and addresses.is_ut_address(address):
                 return address
-        elif web3.isAddress(address):
-            if address != self.user.ethaccount.address:
+        elif address_type == addresses.ETH:
+            # プールが空だった場合、EthAccount はサインアップ後にワーカーで作成される
+            eth_account = EthAccount.objects.filter(user=self.user).first()
+            if eth_account is None:
+                raise ValidationError('ETH アカウントを準備中です。しばらくしてから再度お試しください。')
+            if address != eth_account.address:
                 return address
 
         raise ValidationError('正しいアドレスを入力してください。')
@@ -74,25 +89,3 @@ class TransferForm(forms.Form):
             raise ValidationError('送金可能額を超えています。')
 
         return amount
-
-    @staticmethod
-    def load_abi(file_path):
-        """
-        :param str file_path:
-        :return dict: abi
-        """
-        artifact = open(file_path, 'r')
-        json_dict = json.load(artifact)
-        abi = json_dict['abi']
-        return abi
-
-    @staticmethod
-    def is_ut_address(address):
-        """
-        :param str address:
-        :return bool:
-        """
-        if address[0:2] == 'UT' and len(address) == 42:
-            if Account.objects.filter(address=address).exists():
-                return True
-        return False
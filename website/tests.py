@@ -1,9 +1,13 @@
 import json
 
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.test import TestCase
 from web3 import Web3, HTTPProvider
 
+from accounts.models import Account, EthAccount
+from .forms import TransferForm
+
 
 class TestTotalSupply(TestCase):
     def __init__(self, *args, **kwargs):
@@ -90,3 +94,23 @@ class TestTransfer(TestCase):
         self.assertEqual(self.UTCoin.call().balanceOf(from_address),
                          from_starting_balance - amount)  # 99,900,989.877 UTC
         self.assertEqual(self.UTCoin.call().balanceOf(to_address), to_starting_balance + amount)  # 10.123 UTC
+
+
+class TransferFormTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='hogehoge')
+        Account.objects.create(user=self.user, address='UT' + 'a' * 40, balance=10000)
+
+    def make_form(self, address):
+        return TransferForm(user=self.user, data={'address': address, 'amount': '1', 'fee': '0', 'balance': '10',
+                                                  'password': 'hogehoge'})
+
+    def test_eth_account_not_created_yet(self):
+        # サインアップ時にプールが空で、EthAccount がまだ作成されていない
+        form = self.make_form('0x' + '1' * 40)
+        self.assertFalse(form.is_valid())
+        self.assertIn('address', form.errors)
+
+        EthAccount.objects.create(user=self.user, address='0x' + '2' * 40, password='password')
+        self.assertTrue(self.make_form('0x' + '1' * 40).is_valid())
+        self.assertFalse(self.make_form('0x' + '2' * 40).is_valid())
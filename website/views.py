@@ -1,14 +1,11 @@
-from decimal import *
-
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.db import transaction
 from django.shortcuts import render
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.generic import TemplateView
 
-from accounts.models import Transaction, EthTransaction
+from accounts import activity, addresses, ledger, money, outbox
 from .forms import *
 
 
@@ -33,65 +30,23 @@ class TransferView(View):
         form = TransferForm(user=request.user, data=request.POST)
         if form.is_valid():
             to_address = form.cleaned_data['address']
-            if self.is_ut_address(to_address):
+            if addresses.is_ut_address_format(to_address):
                 # UT address -> UT address
                 from_account = request.user.account
-                to_account = Account.objects.get(address=to_address)
-                amount = Decimal(form.cleaned_data['amount'])
-
-                # UTCoin 送金
-                with transaction.atomic():
-                    from_account.balance -= amount
-                    to_account.balance += amount
-                    from_account.save()
-                    to_account.save()
-
-                    # Create OffChainTransaction
-                    Transaction.objects.create(
-                        from_address=from_account.address,
-                        to_address=to_address,
-                        amount=amount
-                    )
+                result = ledger.transfer(from_account, to_address, form.cleaned_data['amount'])
+                if not result.success:
+                    print('Error:', result.detail)
 
             else:
                 # UT address -> ETH address
-                num_suffix = 1000
                 from_account = request.user.account
                 admin = User.objects.get(pk=1)
                 admin_eth_account = admin.ethaccount
-                amount = int(form.cleaned_data['amount'] * num_suffix)
-                fee = 0
-
-                # UTCoin 送金
-                w3 = Web3(HTTPProvider(settings.WEB3_PROVIDER))
-                abi = self.load_abi(settings.ARTIFACT_PATH)
-                UTCoin = w3.eth.contract(abi=abi, address=settings.UTCOIN_ADDRESS)
-                if w3.personal.unlockAccount(admin_eth_account.address, admin_eth_account.password, duration=hex(60)):
-                    try:
-                        tx_hash = UTCoin.transact({'from': admin_eth_account.address}).transfer(to_address,
-                                                                                                amount - fee)
-
-                        with transaction.atomic():
-                            from_account.balance -= amount
-                            from_account.save()
-
-                            # Create Transaction
-                            tx_info = w3.eth.getTransaction(tx_hash)
-                            EthTransaction.objects.create(
-                                tx_hash=tx_hash,
-                                from_address=admin_eth_account.address,
-                                to_address=to_address,
-                                amount=amount,
-                                gas=tx_info['gas'],
-                                gas_price=tx_info['gasPrice'],
-                                value=tx_info['value'],
-                                network_id=tx_info['networkId']
-                            )
-                    except Exception as e:
-                        print(e)
+                amount = form.cleaned_data['amount']
 
-                else:
-                    print('failed to unlock account')
+                # UTCoin 送金を登録 (送信は process_eth_outbox が行う)
+                if outbox.enqueue_withdrawal(from_account, admin_eth_account.address, to_address, amount) is None:
+                    print('Error:', '送金可能額を超えています。')
 
             # フォーム初期化 (送金可能額を再計算)
             form = self.init_form()
@@ -104,38 +59,14 @@ class TransferView(View):
 
     def init_form(self, fee=0):
         """
-        :param int fee:
+        :param int fee: milli-UTC
         :return class 'website.forms.TransferForm':
         """
-        account = self.request.user.account
-        fee = str(fee)
+        account = activity.get(self.request.user).account
 
         # 送金可能額を計算
-        balance = account.balance - Decimal(fee)
-        if balance < 0:
-            balance = 0
+        balance = max(account.balance - fee, 0)
 
-        form = TransferForm(user=self.request.user, initial={'fee': fee, 'balance': balance})
+        form = TransferForm(user=self.request.user,
+                            initial={'fee': money.render(fee), 'balance': money.render(balance)})
         return form
-
-    @staticmethod
-    def is_ut_address(address: str) -> bool:
-        """
-        :param str address:
-        :return bool:
-        """
-        if address[0:2] == 'UT' and len(address) == 42:
-            if Account.objects.filter(address=address).exists():
-                return True
-        return False
-
-    @staticmethod
-    def load_abi(file_path: str):
-        """
-        :param str file_path:
-        :return dict: abi
-        """
-        artifact = open(file_path, 'r')
-        json_dict = json.load(artifact)
-        abi = json_dict['abi']
-        return abi